@@ -1,5 +1,5 @@
-CAPTURE_INTERFACE = 'wlan0'
-CAPTURE_FILTER = 'tcp port 9050 or tcp port 9051'
+CAPTURE_INTERFACE = 'wlan0'  # or a list of interfaces
+CAPTURE_FILTER = 'auto'
 CAPTURE_DURATION = 60
 
 TIMEOUT = 120
@@ -6,12 +6,6 @@ import os
 import json
 from datetime import datetime
 from config.settings import TIMEOUT
-import geoip2.database 
-import requests 
-import time 
-
-# Configuration for GeoLite2 Database (!!! UPDATE THIS PATH !!!)
-GEOIP_DB_PATH = os.path.join(os.path.dirname(__file__), "config", "GeoLite2-City.mmdb")
 
 logging.basicConfig(level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s")
@@ -27,52 +21,34 @@ from pattern_analyzer import PatternAnalyzer
 from confidence_scorer import ConfidenceScorer
 
 from part_d.reports.report_generator import ReportGenerator
+from part_a.config.settings import CAPTURE_MODE
+from part_a.geolocation.geolocation import get_geolocation_service, load_relay_locations
 
 # =========================================================
 # GEO LOCATION ENRICHMENT HELPERS
 # =========================================================
-def get_ip_geolocation(ip, reader):
-    """Fetches geolocation (lat/lon) for a given IP address."""
-    if not ip or ip.startswith(('192.168.', '10.', '172.16.')):
-        return None, None, None 
-    
+def get_ip_geolocation(ip, relay_locations=None):
+    """Fetches geolocation (lat/lon) for a given IP address, from the relay database or the shared cache."""
+    location = (relay_locations or {}).get(ip) or get_geolocation_service().lookup(ip)
+    return location["lat"], location["lon"], location["country"]
+
+def load_stored_relay_locations():
+    """Relay locations saved with the TOR node database at build time."""
     try:
-        response = reader.city(ip)
-        lat = response.location.latitude
-        lon = response.location.longitude
-        country = response.country.name
-        logging.debug(f"GeoIP success for {ip} via DB.")
-        return lat, lon, country
-    except geoip2.errors.AddressNotFoundError:
-        try:
-            time.sleep(0.5) 
-            url = f"http://ip-api.com/json/{ip}"
-            res = requests.get(url, timeout=5)
-            data = res.json()
-            if data['status'] == 'success':
-                lat = data['lat']
-                lon = data['lon']
-                country = data['country']
-                logging.warning(f"GeoIP success for {ip} via API fallback.")
-                return lat, lon, country
-        except (requests.exceptions.RequestException, KeyError):
-            logging.error(f"Failed to get geolocation for IP: {ip}")
-    except Exception as e:
-        logging.error(f"General GeoIP error for {ip}: {e}")
-
-    return None, None, None
+        return load_relay_locations()
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read relay locations from the TOR node database: {e}")
+        return {}
 
 def enrich_detections_with_geolocation(detections):
     """Iterates through detections and adds 'lat', 'lon', and 'country' fields."""
-    if not os.path.exists(GEOIP_DB_PATH):
-        logging.critical(f"GeoIP Database not found at {GEOIP_DB_PATH}. Skipping geolocation.")
-        return detections
-
-    try:
-        reader = geoip2.database.Reader(GEOIP_DB_PATH)
-    except Exception as e:
-        logging.critical(f"Error initializing GeoIP reader: {e}. Skipping geolocation.")
-        return detections
+    # Relays are located in the node database; resolve any other IPs in one
+    # batch up front so the lookups below are cache hits
+    relay_locations = load_stored_relay_locations()
+    node_ips = [node['ip'] for det in detections if isinstance(det, dict)
+                for node in (det.get('entry_node'), det.get('exit_node'))
+                if node and isinstance(node, dict) and node.get('ip') and not relay_locations.get(node['ip'])]
+    get_geolocation_service().lookup_many(node_ips)
 
     final_enriched_detections = []
     
@@ -88,7 +64,7 @@ def enrich_detections_with_geolocation(detections):
         # Enrich Entry Node
         if entry_node and isinstance(entry_node, dict) and entry_node.get('ip'):
             ip = entry_node['ip']
-            lat, lon, country = get_ip_geolocation(ip, reader)
+            lat, lon, country = get_ip_geolocation(ip, relay_locations)
             if lat and lon:
                 det['entry_node']['lat'] = lat
                 det['entry_node']['lon'] = lon
@@ -97,7 +73,7 @@ def enrich_detections_with_geolocation(detections):
         # Enrich Exit Node
         if exit_node and isinstance(exit_node, dict) and exit_node.get('ip'):
             ip = exit_node['ip']
-            lat, lon, country = get_ip_geolocation(ip, reader)
+            lat, lon, country = get_ip_geolocation(ip, relay_locations)
             if lat and lon:
                 det['exit_node']['lat'] = lat
                 det['exit_node']['lon'] = lon
@@ -106,8 +82,8 @@ def enrich_detections_with_geolocation(detections):
         final_enriched_detections.append(det)
 
 
-    reader.close()
-    logging.info(f"Successfully enriched {len(final_enriched_detections)} detection entries.")
+    logging.info(f"Successfully enriched {len(final_enriched_detections)} detection entries. "
+                 f"Geolocation cache: {get_geolocation_service().stats()}")
     return final_enriched_detections
 # =========================================================
 
@@ -149,10 +125,14 @@ def main():
     
     # 1. Run core detection pipeline
     run_command([sys.executable, "part_a/tor_database/fetch_nodes.py"], timeout=300)
-    run_command([sys.executable, "part_a/network_capture/capture.py"], timeout=TIMEOUT + 20)
-    
-    # *** FINAL TIMEOUT ADJUSTMENT ***
-    run_command([sys.executable, "-m", "part_a.tor_detection.detector"], timeout=900)
+    if CAPTURE_MODE == "stream":
+        # Capture and detection run together, detections arrive while capturing
+        run_command([sys.executable, "-m", "part_a.tor_detection.detector", "--stream"], timeout=TIMEOUT + 900)
+    else:
+        run_command([sys.executable, "part_a/network_capture/capture.py"], timeout=TIMEOUT + 20)
+
+        # *** FINAL TIMEOUT ADJUSTMENT ***
+        run_command([sys.executable, "-m", "part_a.tor_detection.detector"], timeout=900)
 
     # 2. Get the RAW detection results 
     raw_detections = get_latest_detection_results()
@@ -5,10 +5,54 @@ Configuration settings for TOR Analysis System - Part A
 # ====================
 # Network Capture Settings
 # ====================
-CAPTURE_INTERFACE = "wlan0"       # Change as needed: e.g., "eth0", "en0"
-CAPTURE_FILTER = ""               # BPF filter if needed; empty means no filter
+CAPTURE_INTERFACE = "wlan0"       # Change as needed: e.g., "eth0", "en0", or a list like ["eth0", "eth1"]
+CAPTURE_FILTER = "auto"           # BPF filter; "auto" = build from relay database, empty means no filter
 PACKET_COUNT = 0                  # 0 = unlimited packets, or set a specific number
 TIMEOUT = 120                     # Duration (seconds) for the capture and pipeline timeout
+CAPTURE_MODE = "pcap"             # "pcap" = capture to file then detect, "stream" = detect while capturing,
+                                  # "flows" = aggregate to flow records (FLOW_FILE) instead of a pcap
+BPF_MAX_INSTRUCTIONS = 4096       # Kernel limit for a socket filter program
+BPF_MAX_PORTS = 32                # Skip the OR port clause if relays use more distinct ports than this
+CAPTURE_BACKEND = "pyshark"       # "pyshark" (tshark, portable) or "afpacket" (Linux mmap ring, high rate)
+AFPACKET_BLOCK_SIZE = 1 << 20     # Bytes per TPACKET_V3 ring block
+AFPACKET_BLOCK_COUNT = 64         # Blocks in the ring (ring size = block size * count)
+MULTI_CAPTURE_BATCH_SIZE = 512    # Packets per batch sent from an interface worker process
+MULTI_CAPTURE_BATCH_INTERVAL = 0.1  # Max seconds a worker holds a partial batch
+DUPLICATE_WINDOW = 0.005          # Seconds within which the same packet on two interfaces is a duplicate
+SHED_THRESHOLDS = (0.5, 0.75)     # Queue fill ratios at which to drop non-TOR-port traffic, then sample flows
+FLOW_SAMPLE_RATE = 8              # Keep 1 in this many flows while sampling under overload
+
+# ====================
+# Capture Storage Settings
+# ====================
+PCAP_RING_DIR = "part_a/logs"                   # Pcap segments and their manifest.json live here
+PCAP_RING_MAX_BYTES = 2 * 1024 ** 3             # Total disk budget; oldest segments are deleted first
+PCAP_SEGMENT_BYTES = 100 * 1024 ** 2            # Start a new segment after this many bytes (0 = no limit)
+PCAP_SEGMENT_SECONDS = 0                        # Start a new segment after this many seconds (0 = one per run)
+
+# ====================
+# Flow Aggregation Settings
+# ====================
+FLOW_FILE = "part_a/logs/flows.jsonl"           # Flow records of the latest capture, one JSON object per line
+FLOW_IDLE_TIMEOUT = 30                          # Export a flow after this many seconds without packets
+FLOW_ACTIVE_TIMEOUT = 300                       # Split flows open longer than this into several records
+FLOW_VECTOR_LENGTH = 64                         # Packet sizes / inter-arrival times kept per flow
+
+# ====================
+# Geolocation Settings
+# ====================
+GEOIP_DB_PATH = "config/GeoLite2-City.mmdb"     # Local GeoLite2 database, ip-api is used when it has no answer
+GEO_BACKEND = "ip-api-batch"                    # Remote resolver: "ip-api-batch" (100 IPs per request) or "ip-api"
+GEO_API_URL = "http://ip-api.com/json/{ip}?fields=status,lat,lon,country"
+GEO_API_BATCH_URL = "http://ip-api.com/batch?fields=status,query,lat,lon,country"
+GEO_API_BATCH_SIZE = 100                        # IPs per batch request (ip-api accepts up to 100)
+GEO_API_CONCURRENCY = 4                         # Requests in flight at once
+GEO_API_RATE = 0.25                             # Sustained requests per second (ip-api batch allows 15/minute)
+GEO_API_BURST = 15                              # Requests allowed back to back before GEO_API_RATE applies
+GEO_CACHE_FILE = "part_a/logs/geolocation.db"   # SQLite cache shared by the detector and main.py across runs
+GEO_CACHE_TTL = 7 * 86400                       # Keep a resolved location for a week (seconds)
+GEO_CACHE_NEGATIVE_TTL = 86400                  # Don't retry an unresolvable IP for a day (seconds)
+GEO_CACHE_LRU_SIZE = 4096                       # Locations kept in memory in front of the SQLite cache
 
 # ====================
 # TOR Database Settings
@@ -16,12 +60,26 @@ TIMEOUT = 120                     # Duration (seconds) for the capture and pipel
 TOR_DIRECTORY_URL = "https://onionoo.torproject.org/details"
 DATABASE_UPDATE_INTERVAL = 3600             # Update every 1 hour (seconds)
 DATABASE_FILE = "part_a/tor_database/tor_nodes.json"
+RELAY_STORE_FILE = "part_a/tor_database/tor_nodes.bin"   # Binary, mmap-able copy written next to DATABASE_FILE
+RELAY_BOOTSTRAP_FILE = "tor_relays.txt"     # Bundled onionoo summary, used when there is no database yet
+EXIT_BOOTSTRAP_FILE = "tor_exit_ips.txt"    # Bundled exit IP list (one per line) for the same offline bootstrap
+RELAY_PREFILTER_FP_RATE = 0.01              # Bloom filter false-positive rate in front of relay lookups (0 = no filter)
+RELAY_RELOAD_INTERVAL = 60                  # Seconds between checks for a newer relay store during streaming detection
+HISTORY_DIR = "part_a/tor_database/history" # One relay store per consensus plus the role interval index
+HISTORY_RETENTION_DAYS = 30                 # Snapshots older than this are deleted (~1 MB per hourly snapshot)
+HISTORY_OPEN_SNAPSHOTS = 4                  # Snapshots kept mapped at once when replaying archived captures
+RELAY_PREFIX_V4 = 24                        # Hosting prefix length grouped around each IPv4 relay address
+RELAY_PREFIX_V6 = 48                        # Same for IPv6 relay addresses
+WATCHLIST_FILE = "part_a/config/watchlist.txt"  # Analyst CIDRs, one per line with an optional label (optional file)
+PREFIX_CACHE_SIZE = 65536                   # Addresses whose prefix match is memoised at packet rate
 
 # ====================
 # TOR Detection Settings
 # ====================
 TOR_PORTS = [9001, 9030, 9050, 9051, 443, 80]      # Common TOR ports
 DETECTION_CONFIDENCE_THRESHOLD = 70                # Minimum confidence % to flag as TOR
+ANALYSIS_WORKERS = 1                               # Processes for pcap analysis (1 = in-process, 0 = one per CPU)
+ANALYSIS_SHARD_BYTES = 64 * 1024 ** 2              # Smallest byte range of a pcap handed to one worker
 
 # ====================
 # Alerting Settings
@@ -40,5 +98,5 @@ LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 # ====================
 # Performance Settings
 # ====================
-MAX_PACKETS_IN_MEMORY = 10000
-CLEANUP_INTERVAL = 300             # Clean old data every 5 minutes (seconds)
+MAX_PACKETS_IN_MEMORY = 10000      # Max packets buffered between capture and detection (stream/flows mode)
+CLEANUP_INTERVAL = 300             # Clean old data and log load shedding counters every 5 minutes (seconds)
@@ -0,0 +1,199 @@
+"""
+A5: Asynchronous Geolocation Resolver
+Resolves many IPs at once: misses are deduplicated, grouped into batches
+when the backend supports batch queries, and sent with bounded concurrency
+behind a token bucket so the remote API's rate limit is respected
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import (GEO_BACKEND, GEO_API_URL, GEO_API_BATCH_URL, GEO_API_BATCH_SIZE,
+                                    GEO_API_CONCURRENCY, GEO_API_RATE, GEO_API_BURST)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `burst` requests back to back, then `rate` requests per second"""
+
+    def __init__(self, rate=GEO_API_RATE, burst=GEO_API_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class IpApiBackend:
+    """One GET per IP against ip-api's JSON endpoint"""
+
+    batch_size = 1
+
+    def __init__(self, url=GEO_API_URL, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self, ips):
+        """Map each IP to a location dict, or None if the API does not know it"""
+        ip = ips[0]
+        with urllib.request.urlopen(self.url.format(ip=ip), timeout=self.timeout) as response:
+            return {ip: _ip_api_location(json.load(response))}
+
+
+class IpApiBatchBackend:
+    """POSTs up to batch_size IPs at once to ip-api's batch endpoint"""
+
+    def __init__(self, url=GEO_API_BATCH_URL, batch_size=GEO_API_BATCH_SIZE, timeout=10):
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+    def fetch(self, ips):
+        request = urllib.request.Request(self.url, data=json.dumps(ips).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            results = json.load(response)
+        locations = {ip: None for ip in ips}
+        for result in results:
+            if result.get('query') in locations:
+                locations[result['query']] = _ip_api_location(result)
+        return locations
+
+
+def _ip_api_location(data):
+    if data.get('status') == 'success':
+        return {"lat": data["lat"], "lon": data["lon"], "country": data["country"]}
+    return None
+
+
+BACKENDS = {
+    'ip-api': IpApiBackend,
+    'ip-api-batch': IpApiBatchBackend,
+}
+
+
+class AsyncGeolocationResolver:
+    """
+    Resolves a set of IPs through a backend. Backends expose batch_size and a
+    blocking fetch(ips) -> {ip: location or None}; fetches run in worker
+    threads, at most `concurrency` at a time and each behind the token bucket.
+    """
+
+    def __init__(self, backend=None, concurrency=GEO_API_CONCURRENCY, bucket=None):
+        self.backend = backend or BACKENDS[GEO_BACKEND]()
+        self.concurrency = concurrency
+        # Shared across resolve() calls so the rate limit holds for the whole run
+        self.bucket = bucket or TokenBucket()
+        self.requests = 0
+        self.failed_requests = 0
+
+    async def resolve(self, ips):
+        """
+        Returns {ip: location or None} for every IP the backend answered. IPs of
+        failed requests are left out so callers do not cache them.
+        """
+        ips = list(dict.fromkeys(ips))
+        size = max(1, self.backend.batch_size)
+        batches = [ips[i:i + size] for i in range(0, len(ips), size)]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+
+        async def fetch(batch):
+            async with semaphore:
+                await self.bucket.acquire()
+                self.requests += 1
+                try:
+                    return await loop.run_in_executor(None, self.backend.fetch, batch)
+                except Exception as e:
+                    self.failed_requests += 1
+                    logger.error(f"Geolocation request for {len(batch)} IP(s) failed: {e}")
+                    return {}
+
+        results = {}
+        for locations in await asyncio.gather(*(fetch(batch) for batch in batches)):
+            results.update(locations)
+        return results
+
+    def resolve_sync(self, ips):
+        """resolve() for callers without an event loop"""
+        return asyncio.run(self.resolve(ips))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Answers ip-api's /json/<ip> and /batch endpoints with made-up locations"""
+
+    def _location(self, ip):
+        if ip.startswith('0.'):
+            return {'status': 'fail', 'query': ip}
+        last = int(ip.rsplit('.', 1)[-1]) if '.' in ip else 0
+        return {'status': 'success', 'query': ip, 'lat': last / 10.0, 'lon': -last / 10.0, 'country': 'Stubland'}
+
+    def _reply(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(self._location(self.path.split('?')[0].rsplit('/', 1)[-1]))
+
+    def do_POST(self):
+        ips = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self._reply([self._location(ip) for ip in ips])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port=0):
+    """Run a local stand-in for ip-api on 127.0.0.1; returns (server, base_url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    """Resolve 1,000 IPs against the local stub server with both backends"""
+    print("="*70)
+    print("PART A - A5: Asynchronous Geolocation Resolver (stub server)")
+    print("="*70)
+
+    server, base_url = start_stub_server()
+    ips = [f"203.0.{i // 256}.{i % 256}" for i in range(1000)] + ["0.0.0.1"]
+    backends = [
+        IpApiBatchBackend(url=f"{base_url}/batch"),
+        IpApiBackend(url=f"{base_url}/json/{{ip}}"),
+    ]
+    for backend in backends:
+        resolver = AsyncGeolocationResolver(backend, concurrency=16, bucket=TokenBucket(rate=1000, burst=1000))
+        start = time.monotonic()
+        locations = resolver.resolve_sync(ips + ips[:100])
+        elapsed = time.monotonic() - start
+        resolved = sum(1 for location in locations.values() if location)
+        print(f"{type(backend).__name__}: {resolved}/{len(locations)} IPs resolved, "
+              f"{resolver.requests} request(s) in {elapsed:.2f}s")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+A5: Geolocation Service
+Resolves IP addresses to (lat, lon, country) once and remembers the answer:
+an in-memory LRU sits in front of a SQLite cache with per-entry TTLs, and
+IPs that cannot be resolved are cached too so they are not retried every run
+"""
+
+import ipaddress
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import (GEOIP_DB_PATH, GEO_CACHE_FILE, GEO_CACHE_TTL, GEO_CACHE_NEGATIVE_TTL,
+                                    GEO_CACHE_LRU_SIZE, DATABASE_FILE)
+from part_a.geolocation.async_resolver import AsyncGeolocationResolver
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = {"lat": None, "lon": None, "country": "-"}
+
+
+def is_public_ip(ip):
+    try:
+        return ipaddress.ip_address(ip).is_global
+    except ValueError:
+        return False
+
+
+class GeolocationCache:
+    """
+    Two-level cache of geolocation results.
+
+    get() returns a location dict, UNKNOWN for a cached negative result, or
+    None if the IP is not cached (or its entry expired).
+    """
+
+    def __init__(self, db_file=GEO_CACHE_FILE, ttl=GEO_CACHE_TTL, negative_ttl=GEO_CACHE_NEGATIVE_TTL,
+                 lru_size=GEO_CACHE_LRU_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lru_size = lru_size
+        self.memory = OrderedDict()          # ip -> (expires, location)
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+        # Shared by the detector and main.py, which may run at the same time
+        self.db = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS geolocation (
+                ip TEXT PRIMARY KEY,
+                lat REAL,
+                lon REAL,
+                country TEXT,
+                found INTEGER NOT NULL,
+                expires REAL NOT NULL
+            )
+        """)
+        self.db.commit()
+
+    def get(self, ip):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(ip)
+            if entry and entry[0] > now:
+                self.memory.move_to_end(ip)
+                self.memory_hits += 1
+                return entry[1]
+
+            row = self.db.execute(
+                "SELECT lat, lon, country, found, expires FROM geolocation WHERE ip = ? AND expires > ?",
+                (ip, now)
+            ).fetchone()
+            if row is None:
+                self.memory.pop(ip, None)
+                self.misses += 1
+                return None
+            lat, lon, country, found, expires = row
+            location = {"lat": lat, "lon": lon, "country": country} if found else UNKNOWN
+            self._remember(ip, expires, location)
+            self.disk_hits += 1
+            return location
+
+    def put(self, ip, location):
+        """Cache a resolved location, or a negative result if location is None"""
+        self.put_many({ip: location})
+
+    def put_many(self, locations):
+        """put() for {ip: location or None}, in a single SQLite transaction"""
+        now = time.time()
+        rows = []
+        with self.lock:
+            for ip, location in locations.items():
+                found = location is not None
+                expires = now + (self.ttl if found else self.negative_ttl)
+                location = location or UNKNOWN
+                rows.append((ip, location["lat"], location["lon"], location["country"], int(found), expires))
+                self._remember(ip, expires, location)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO geolocation (ip, lat, lon, country, found, expires) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.db.commit()
+
+    def _remember(self, ip, expires, location):
+        self.memory[ip] = (expires, location)
+        self.memory.move_to_end(ip)
+        while len(self.memory) > self.lru_size:
+            self.memory.popitem(last=False)
+
+    def purge_expired(self):
+        """Delete expired entries from the SQLite cache"""
+        with self.lock:
+            deleted = self.db.execute("DELETE FROM geolocation WHERE expires <= ?", (time.time(),)).rowcount
+            self.db.commit()
+        return deleted
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "lookups": lookups,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0
+        }
+
+    def close(self):
+        self.db.close()
+
+
+class GeolocationService:
+    """
+    Looks IPs up in the cache, then the local GeoLite2 database (if geoip2 and
+    the database file are available), then the remote API through an
+    AsyncGeolocationResolver. Non-public IPs are never looked up.
+    """
+
+    def __init__(self, cache=None, geoip_db=GEOIP_DB_PATH, resolver=None):
+        self.cache = cache or GeolocationCache()
+        self.resolver = resolver or AsyncGeolocationResolver()
+        self.reader = None
+        self.db_lookups = 0
+        self.api_lookups = 0
+        self.failures = 0
+        if geoip_db and os.path.exists(geoip_db):
+            try:
+                import geoip2.database
+                self.reader = geoip2.database.Reader(geoip_db)
+            except Exception as e:
+                logger.warning(f"GeoLite2 database {geoip_db} unavailable, using the remote API only: {e}")
+
+    def lookup(self, ip):
+        """Return a {"lat", "lon", "country"} dict for ip, UNKNOWN if it cannot be resolved"""
+        return self.lookup_many([ip])[ip]
+
+    def lookup_many(self, ips, remote=True):
+        """
+        Resolve a batch of IPs, e.g. all relays of a run, in one go. Returns
+        {ip: location} with UNKNOWN for IPs that could not be resolved. Each
+        distinct cache miss is sent to the remote API at most once, or not at
+        all with remote=False.
+        """
+        locations = {}
+        misses = []
+        for ip in dict.fromkeys(ips):
+            if not is_public_ip(ip):
+                locations[ip] = UNKNOWN
+                continue
+            location = self.cache.get(ip)
+            if location is not None:
+                locations[ip] = location
+                continue
+            location = self._resolve_local(ip)
+            if location is not None:
+                self.cache.put(ip, location)
+                locations[ip] = location
+            else:
+                misses.append(ip)
+
+        if misses and not remote:
+            locations.update((ip, UNKNOWN) for ip in misses)
+        elif misses:
+            self.api_lookups += len(misses)
+            resolved = self.resolver.resolve_sync(misses)
+            self.cache.put_many(resolved)
+            for ip in misses:
+                if ip in resolved:
+                    locations[ip] = resolved[ip] or UNKNOWN
+                else:
+                    # Transient failures are not cached, the next run tries again
+                    self.failures += 1
+                    locations[ip] = UNKNOWN
+        return locations
+
+    def _resolve_local(self, ip):
+        """Location from the GeoLite2 database, or None"""
+        if self.reader is None:
+            return None
+        import geoip2.errors
+        try:
+            response = self.reader.city(ip)
+        except geoip2.errors.AddressNotFoundError:
+            return None
+        self.db_lookups += 1
+        if response.location.latitude is None:
+            return None
+        return {"lat": response.location.latitude, "lon": response.location.longitude,
+                "country": response.country.name}
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({"db_lookups": self.db_lookups, "api_lookups": self.api_lookups, "failures": self.failures,
+                      "api_requests": self.resolver.requests})
+        return stats
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.cache.close()
+
+
+def node_location(node):
+    """Location stored with a TOR node database entry, or None if it has none"""
+    if node.get('lat') is None or node.get('lon') is None:
+        return None
+    return {"lat": node['lat'], "lon": node['lon'], "country": node.get('country_name') or node.get('country') or "-"}
+
+
+def load_relay_locations(database_file=DATABASE_FILE):
+    """
+    {relay ip: location or None} for every relay in the TOR node database.
+    Locations are stored when the database is built, so relays need no lookup.
+    """
+    from part_a.tor_database.relay_store import open_relay_nodes
+    return {ip: node_location(node) for ip, node in open_relay_nodes(database_file).items()}
+
+
+_service = None
+
+
+def get_geolocation_service():
+    """The process-wide GeolocationService, created on first use"""
+    global _service
+    if _service is None:
+        _service = GeolocationService()
+    return _service
+
+
+def main():
+    """Resolve the IPs given on the command line and print cache statistics"""
+    service = get_geolocation_service()
+    for ip in sys.argv[1:]:
+        print(f"{ip}: {service.lookup(ip)}")
+    print(f"Cache: {service.stats()}")
+    print(f"Expired entries purged: {service.cache.purge_expired()}")
+    service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+A1: Capture Filter Compiler
+Builds a BPF capture filter from the TOR relay database so that only
+packets to or from relays are copied to userspace
+"""
+
+import heapq
+import ipaddress
+import json
+import logging
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import (DATABASE_FILE, RELAY_STORE_FILE, BPF_MAX_INSTRUCTIONS, BPF_MAX_PORTS,
+                                    WATCHLIST_FILE)
+from part_a.tor_database.relay_index import node_addresses
+from part_a.tor_database.relay_store import RelayStore, store_is_current
+from part_a.tor_database.prefix_trie import read_watchlist
+
+logger = logging.getLogger(__name__)
+
+# Rough cost of one term in the compiled program, used to stay under the
+# kernel's instruction limit without having to invoke libpcap
+INSTRUCTIONS_PER_NET = 6
+INSTRUCTIONS_PER_PORT = 6
+BASE_INSTRUCTIONS = 20
+
+
+def load_relay_endpoints(database_file=None):
+    """
+    Read relay IPs and OR ports from the TOR node database
+
+    Returns:
+        (set of ip_address objects, set of int ports)
+    """
+    if database_file is None and store_is_current(DATABASE_FILE, RELAY_STORE_FILE):
+        # The shared store fetch_nodes.py wrote: no JSON to parse
+        try:
+            store = RelayStore(RELAY_STORE_FILE)
+            nodes = store.nodes
+        except (OSError, ValueError):
+            nodes = None
+    else:
+        nodes = None
+    if nodes is None:
+        with open(database_file or DATABASE_FILE, 'r') as f:
+            nodes = json.load(f).get('nodes', [])
+
+    addresses = set()
+    ports = set()
+    for node in nodes:
+        # Every OR and exit address, IPv4 and IPv6
+        for ip, port in node_addresses(node):
+            try:
+                addresses.add(ipaddress.ip_address(ip))
+            except ValueError:
+                continue
+            if port:
+                ports.add(int(port))
+    return addresses, ports
+
+
+def load_watchlist_networks(watchlist_file=WATCHLIST_FILE):
+    """Analyst watchlist CIDRs, collapsed, or an empty list without a watchlist file"""
+    if not watchlist_file or not os.path.exists(watchlist_file):
+        return []
+    networks = [network for network, _ in read_watchlist(watchlist_file)]
+    return [net for version in (4, 6)
+            for net in ipaddress.collapse_addresses(net for net in networks if net.version == version)]
+
+
+def _merge_closest(networks, max_networks):
+    """
+    Greedily merge neighbouring networks into their smallest common supernet,
+    cheapest first (fewest extra addresses covered), until at most max_networks remain
+    """
+    nets = sorted(networks)
+    prev = list(range(-1, len(nets) - 1))
+    nxt = list(range(1, len(nets) + 1))
+    nxt[-1] = -1
+    alive = len(nets)
+
+    def supernet(left, right):
+        span = int(left.network_address) ^ int(right.broadcast_address)
+        return left.supernet(new_prefix=left.max_prefixlen - span.bit_length()) if span else left
+
+    def push(i):
+        j = nxt[i]
+        if i >= 0 and j >= 0:
+            sup = supernet(nets[i], nets[j])
+            cost = sup.num_addresses - nets[i].num_addresses - nets[j].num_addresses
+            heapq.heappush(heap, (cost, i, nets[i], nets[j]))
+
+    def unlink(k):
+        if prev[k] >= 0:
+            nxt[prev[k]] = nxt[k]
+        if nxt[k] >= 0:
+            prev[nxt[k]] = prev[k]
+        nets[k] = None
+
+    heap = []
+    for i in range(len(nets) - 1):
+        push(i)
+
+    while alive > max_networks and heap:
+        _, i, left, right = heapq.heappop(heap)
+        j = nxt[i]
+        if nets[i] != left or j < 0 or nets[j] != right:
+            continue  # stale entry, one side has been merged since
+        sup = supernet(left, right)
+        nets[i] = sup
+        unlink(j)
+        alive -= 1
+        # The supernet can swallow further neighbours on either side
+        while nxt[i] >= 0 and nets[nxt[i]].subnet_of(sup):
+            unlink(nxt[i])
+            alive -= 1
+        while prev[i] >= 0 and nets[prev[i]].subnet_of(sup):
+            unlink(prev[i])
+            alive -= 1
+        push(prev[i])
+        push(i)
+
+    return [net for net in nets if net is not None]
+
+
+def aggregate_networks(addresses, max_networks):
+    """
+    Collapse addresses into at most max_networks CIDR blocks.
+
+    Exact aggregation is tried first; if that still leaves too many blocks the
+    closest neighbours are merged into wider prefixes. Widening lets some
+    non-relay traffic through, which the detector discards anyway.
+    """
+    families = []
+    for version in (4, 6):
+        family = [ipaddress.ip_network(addr) for addr in addresses if addr.version == version]
+        families.append(list(ipaddress.collapse_addresses(family)))
+
+    total = sum(len(nets) for nets in families)
+    if total <= max_networks:
+        return [net for nets in families for net in nets]
+
+    # Share the budget between IPv4 and IPv6 in proportion to their size
+    networks = []
+    for nets in families:
+        if nets:
+            share = max(1, max_networks * len(nets) // total)
+            networks.extend(_merge_closest(nets, share))
+    logger.info(f"Widened {total} relay networks to {len(networks)} to fit the BPF instruction limit")
+    return networks
+
+
+def _net_terms(networks):
+    return [f"host {net.network_address}" if net.prefixlen == net.max_prefixlen else f"net {net}"
+            for net in networks]
+
+
+def build_relay_filter(addresses, ports=None, max_instructions=BPF_MAX_INSTRUCTIONS, watchlist=()):
+    """
+    Build a BPF filter expression matching TCP traffic to or from the given relays,
+    plus any traffic to or from the `watchlist` networks.
+
+    The port clause is only added when there are few enough distinct OR ports to
+    be worth the instructions; the address clause alone is already selective.
+    Watchlist networks are kept exact and their instructions come out of the
+    relays' budget, since a widened watchlist term would only add noise.
+    """
+    ports = sorted(ports or [])
+    if len(ports) > BPF_MAX_PORTS:
+        ports = []
+
+    budget = (max_instructions - BASE_INSTRUCTIONS - len(ports) * INSTRUCTIONS_PER_PORT
+              - len(watchlist) * INSTRUCTIONS_PER_NET)
+    networks = aggregate_networks(addresses, max(1, budget // INSTRUCTIONS_PER_NET))
+
+    expression = f"tcp and ({' or '.join(_net_terms(networks))})"
+    if ports:
+        expression += f" and ({' or '.join(f'port {port}' for port in ports)})"
+    if watchlist:
+        # Watchlist groups count traffic on any port, so this clause is not limited to TCP
+        expression = f"({expression}) or {' or '.join(_net_terms(watchlist))}"
+
+    logger.info(f"Built relay capture filter: {len(addresses)} relays -> {len(networks)} networks, {len(ports)} ports, "
+                f"{len(watchlist)} watchlist networks")
+    return expression
+
+
+def resolve_capture_filter(capture_filter, database_file=None):
+    """
+    Turn the CAPTURE_FILTER setting into a BPF expression for the capture backend
+
+    "" means no filter, "auto" compiles one from the relay database and the
+    watchlist (WATCHLIST_FILE), anything else is used as a literal BPF expression.
+    """
+    if not capture_filter:
+        return None
+    if capture_filter != "auto":
+        return capture_filter
+
+    try:
+        addresses, ports = load_relay_endpoints(database_file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not load relay database for capture filter, capturing unfiltered: {e}")
+        return None
+    if not addresses:
+        logger.warning("Relay database is empty, capturing unfiltered")
+        return None
+    try:
+        watchlist = load_watchlist_networks()
+    except OSError as e:
+        # The detector would not see watchlist traffic through a filter without it
+        logger.warning(f"Could not read watchlist for capture filter, capturing unfiltered: {e}")
+        return None
+    return build_relay_filter(addresses, ports, watchlist=watchlist)
+
+
+def compile_bpf(expression, interface=None):
+    """
+    Compile a filter expression to classic BPF instructions with tcpdump -ddd,
+    for backends that attach the program to their own socket.
+
+    Returns:
+        list of (code, jt, jf, k) tuples, or None if tcpdump could not compile it
+    """
+    command = ["tcpdump", "-ddd"]
+    if interface:
+        command += ["-i", interface]
+    command.append(expression)
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Could not run tcpdump to compile capture filter: {e}")
+        return None
+    if result.returncode != 0:
+        logger.warning(f"tcpdump rejected capture filter: {result.stderr.strip()}")
+        return None
+
+    lines = result.stdout.split("\n")
+    count = int(lines[0])
+    program = [tuple(int(field) for field in line.split()) for line in lines[1:count + 1]]
+    if count > BPF_MAX_INSTRUCTIONS:
+        logger.warning(f"Compiled capture filter has {count} instructions, over the kernel limit")
+        return None
+    return program
+
+
+def main():
+    """Print the filter generated from the current relay database"""
+    expression = resolve_capture_filter("auto")
+    if expression:
+        print(f"Filter length: {len(expression)} characters")
+        print(expression)
+    else:
+        print("No relay database available to build a filter from")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,24 @@
+import asyncio
 import logging
 import sys
 import os
+import threading
+import time
 import pyshark
-from datetime import datetime
 
 # Fix sys.path to import config from project root
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
 
-from config.settings import CAPTURE_INTERFACE, TIMEOUT
+from config.settings import CAPTURE_INTERFACE, CAPTURE_FILTER, TIMEOUT
+from part_a.config.settings import (CAPTURE_MODE, CAPTURE_BACKEND, AFPACKET_BLOCK_SIZE, AFPACKET_BLOCK_COUNT,
+                                    PCAP_SEGMENT_BYTES, PCAP_SEGMENT_SECONDS, FLOW_FILE, TOR_PORTS)
+from part_a.network_capture.records import PacketRecord, STREAM_END, decode_ethernet
+from part_a.network_capture.bpf_filter import resolve_capture_filter, compile_bpf, load_relay_endpoints
+from part_a.network_capture.afpacket import AFPacketCapture
+from part_a.network_capture.pcap_ring import PcapRing, RingWriter
+from part_a.network_capture.multi_capture import interface_list, aggregate_interfaces
+from part_a.network_capture.flow_aggregator import aggregate_stream
+from part_a.network_capture.overload import SheddingQueue
 
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
@@ -18,14 +29,177 @@ os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
-def capture_packets(interface, duration_sec):
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    filename = f"part_a/logs/packets_{timestamp}_pyshark.pcap"
-    logger.info(f"Starting capture on {interface} for {duration_sec} seconds")
-    capture = pyshark.LiveCapture(interface=interface, output_file=filename)
-    capture.sniff(timeout=duration_sec)
-    logger.info(f"Capture completed, saved to {filename}")
-    print(f"Capture completed, saved to {filename}")
+def open_afpacket(interface, bpf_filter=None):
+    """Open an AF_PACKET ring on interface with bpf_filter compiled into the kernel"""
+    program = None
+    if bpf_filter:
+        program = compile_bpf(bpf_filter, interface)
+        if program is None:
+            logger.warning("Capture filter could not be compiled, AF_PACKET capture is unfiltered")
+    return AFPacketCapture(interface, AFPACKET_BLOCK_SIZE, AFPACKET_BLOCK_COUNT, bpf_program=program)
+
+def capture_packets(interface, duration_sec, bpf_filter=None, backend=CAPTURE_BACKEND):
+    """Capture to pcap segments in the ring; returns the segment paths of this run"""
+    ring = PcapRing()
+    ring.start_run()
+    interfaces = interface_list(interface)
+    logger.info(f"Starting {backend} capture on {', '.join(interfaces)} for {duration_sec} seconds")
+    if len(interfaces) > 1:
+        if backend == "afpacket":
+            raise ValueError("Multi-interface AF_PACKET capture is only supported in stream mode")
+        # tshark captures all interfaces into one file itself
+        interface = interfaces
+    if backend == "afpacket":
+        with open_afpacket(interface, bpf_filter) as capture, RingWriter(ring, backend) as writer:
+            for ts, offset, caplen, length in capture.frames(duration_sec):
+                writer.write(ts, capture.ring[offset:offset + caplen], length)
+            stats = capture.stats()
+        logger.info(f"Ring counters: {stats}")
+        print(f"Captured {stats['packets']} packets, {stats['drops']} dropped by the ring")
+    else:
+        _capture_pyshark_segments(ring, interface, duration_sec, bpf_filter)
+
+    segments = ring.run_segments(ring.run)
+    logger.info(f"Capture completed, saved {len(segments)} segment(s): {segments}")
+    print(f"Capture completed, saved to {', '.join(segments) or 'nothing (no packets)'}")
+    return segments
+
+def _capture_pyshark_segments(ring, interface, duration_sec, bpf_filter):
+    """
+    Run tshark once per segment. tshark stops itself when the segment reaches
+    PCAP_SEGMENT_BYTES; PCAP_SEGMENT_SECONDS caps the duration of each one.
+    """
+    custom_parameters = None
+    if PCAP_SEGMENT_BYTES:
+        custom_parameters = {'-a': f'filesize:{max(1, PCAP_SEGMENT_BYTES // 1024)}'}
+
+    deadline = time.time() + duration_sec
+    while time.time() < deadline:
+        remaining = deadline - time.time()
+        segment_sec = min(PCAP_SEGMENT_SECONDS or remaining, remaining)
+        filename = ring.next_segment_path("pyshark")
+        start = time.time()
+        capture = pyshark.LiveCapture(interface=interface, output_file=filename, bpf_filter=bpf_filter,
+                                      custom_parameters=custom_parameters)
+        try:
+            # Packets are only written to the file, not kept in memory like sniff() does
+            capture.apply_on_packets(lambda pkt: None, timeout=segment_sec)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            capture.close()
+        ring.add_segment(filename, start, time.time())
+
+def packet_to_record(pkt):
+    """Reduce a pyshark packet to a PacketRecord, or None if it has no IP layer"""
+    if 'IP' in pkt:
+        ip_layer = pkt.ip
+    elif 'IPV6' in pkt:
+        ip_layer = pkt.ipv6
+    else:
+        return None
+
+    src_port = dst_port = None
+    protocol = pkt.transport_layer
+    if protocol:
+        transport = pkt[protocol]
+        src_port = int(transport.srcport)
+        dst_port = int(transport.dstport)
+
+    return PacketRecord(
+        timestamp=float(pkt.sniff_timestamp),
+        src_ip=ip_layer.src,
+        dst_ip=ip_layer.dst,
+        src_port=src_port,
+        dst_port=dst_port,
+        protocol=protocol,
+        length=int(pkt.length)
+    )
+
+def stream_packets(interface, duration_sec, packet_queue, bpf_filter=None, backend=CAPTURE_BACKEND, stats=None):
+    """
+    Capture packets and push a PacketRecord for each onto packet_queue as it arrives.
+
+    packet_queue should be bounded so memory stays flat however long the capture
+    runs: with a plain queue.Queue put() blocks while the consumer catches up, with
+    an overload.SheddingQueue it sheds load instead. STREAM_END is put when done.
+    If a stats dict is given it is filled with the backend's capture counters.
+    """
+    if backend == "afpacket":
+        return _stream_afpacket(interface, duration_sec, packet_queue, bpf_filter, stats)
+
+    logger.info(f"Starting streaming capture on {interface} for {duration_sec} seconds")
+    capture = pyshark.LiveCapture(interface=interface, bpf_filter=bpf_filter)
+    streamed = 0
+
+    def on_packet(pkt):
+        nonlocal streamed
+        record = packet_to_record(pkt)
+        if record is not None:
+            packet_queue.put(record)
+            streamed += 1
+
+    try:
+        capture.apply_on_packets(on_packet, timeout=duration_sec)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        capture.close()
+        packet_queue.put(STREAM_END)
+        logger.info(f"Streaming capture completed, {streamed} packets streamed")
+        if stats is not None:
+            stats.update({'backend': 'pyshark', 'interface': interface, 'packets': streamed})
+
+def _stream_afpacket(interface, duration_sec, packet_queue, bpf_filter, stats):
+    logger.info(f"Starting AF_PACKET streaming capture on {interface} for {duration_sec} seconds")
+    try:
+        with open_afpacket(interface, bpf_filter) as capture:
+            for ts, offset, caplen, length in capture.frames(duration_sec):
+                record = decode_ethernet(capture.ring, offset, caplen, length, ts)
+                if record is not None:
+                    packet_queue.put(record)
+            ring_stats = capture.stats()
+    finally:
+        packet_queue.put(STREAM_END)
+    logger.info(f"AF_PACKET streaming capture completed: {ring_stats}")
+    if stats is not None:
+        stats.update(ring_stats)
+
+def capture_flows(interface, duration_sec, flow_file=FLOW_FILE, bpf_filter=None, backend=CAPTURE_BACKEND):
+    """
+    Capture and aggregate packets into flow records in flow_file; no pcap is
+    written. With several interfaces each capture worker aggregates its own
+    packets and only flow records reach this process.
+    """
+    # Under overload keep packets on the relays' own OR ports as well as the usual TOR ports
+    try:
+        _, relay_ports = load_relay_endpoints()
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not load relay ports for load shedding: {e}")
+        relay_ports = set()
+    tor_ports = set(TOR_PORTS) | relay_ports
+    capture_stats = {}
+    if len(interface_list(interface)) > 1:
+        flow_count = aggregate_interfaces(interface, duration_sec, flow_file, bpf_filter,
+                                          backend=backend, tor_ports=tor_ports, stats=capture_stats)
+    else:
+        packet_queue = SheddingQueue(tor_ports=tor_ports)
+        producer = threading.Thread(
+            target=stream_packets,
+            args=(interface, duration_sec, packet_queue, bpf_filter),
+            kwargs={'backend': backend, 'stats': capture_stats},
+            daemon=True
+        )
+        producer.start()
+        flow_count = aggregate_stream(packet_queue, flow_file)
+        producer.join()
+        capture_stats['load_shedding'] = packet_queue.stats()
+    logger.info(f"Capture counters: {capture_stats}")
+    print(f"Capture completed, {flow_count} flow records saved to {flow_file}")
+    return flow_file
 
 if __name__ == "__main__":
-    capture_packets(CAPTURE_INTERFACE, TIMEOUT)
+    if CAPTURE_MODE == "flows":
+        capture_flows(CAPTURE_INTERFACE, TIMEOUT, bpf_filter=resolve_capture_filter(CAPTURE_FILTER))
+    else:
+        capture_packets(CAPTURE_INTERFACE, TIMEOUT, resolve_capture_filter(CAPTURE_FILTER))
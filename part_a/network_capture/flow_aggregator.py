@@ -0,0 +1,154 @@
+"""
+A1: Flow Aggregation
+Builds a 5-tuple flow table from captured packets and exports one compact
+record per flow (counters, first/last timestamps and truncated size and
+inter-arrival vectors) for Part B and Part C instead of raw packets
+"""
+
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import FLOW_IDLE_TIMEOUT, FLOW_ACTIVE_TIMEOUT, FLOW_VECTOR_LENGTH
+from part_a.network_capture.records import STREAM_END
+
+logger = logging.getLogger(__name__)
+
+
+class _Flow:
+    __slots__ = ('first_seen', 'last_seen', 'packets', 'volume', 'sizes', 'intervals')
+
+    def __init__(self, timestamp, length):
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.packets = 1
+        self.volume = length
+        self.sizes = [length]
+        self.intervals = []
+
+
+class FlowTable:
+    """
+    Unidirectional flow table keyed by (src_ip, dst_ip, src_port, dst_port, protocol).
+
+    A flow is exported when it has been idle for idle_timeout seconds, when it
+    has been open for active_timeout seconds (long TOR circuits are split into
+    several records), or on flush(). push() checks for idle flows every
+    expire_interval seconds of capture time.
+    """
+
+    def __init__(self, idle_timeout=FLOW_IDLE_TIMEOUT, active_timeout=FLOW_ACTIVE_TIMEOUT,
+                 vector_length=FLOW_VECTOR_LENGTH, expire_interval=None):
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.vector_length = vector_length
+        self.expire_interval = expire_interval or idle_timeout
+        self.flows = {}
+        self.packets_seen = 0
+        self.flows_exported = 0
+        self._next_expiry = None
+
+    def add(self, record):
+        """Account one PacketRecord; returns a flow record if this closed one on active timeout"""
+        self.packets_seen += 1
+        key = (record.src_ip, record.dst_ip, record.src_port, record.dst_port, record.protocol)
+        flow = self.flows.get(key)
+        if flow is None:
+            self.flows[key] = _Flow(record.timestamp, record.length)
+            return None
+
+        if record.timestamp - flow.first_seen >= self.active_timeout:
+            self.flows[key] = _Flow(record.timestamp, record.length)
+            return self._export(key, flow)
+
+        if len(flow.sizes) < self.vector_length:
+            flow.sizes.append(record.length)
+            flow.intervals.append(round(record.timestamp - flow.last_seen, 6))
+        flow.packets += 1
+        flow.volume += record.length
+        flow.last_seen = max(flow.last_seen, record.timestamp)
+        return None
+
+    def push(self, record):
+        """add() plus idle expiry as capture time advances: the flow records exported meanwhile"""
+        exported = []
+        closed = self.add(record)
+        if closed:
+            exported.append(closed)
+        if self._next_expiry is None:
+            self._next_expiry = record.timestamp + self.expire_interval
+        elif record.timestamp >= self._next_expiry:
+            exported.extend(self.expire(record.timestamp))
+            self._next_expiry = record.timestamp + self.expire_interval
+        return exported
+
+    def expire(self, now):
+        """Export and remove flows idle since before now - idle_timeout"""
+        horizon = now - self.idle_timeout
+        idle = [key for key, flow in self.flows.items() if flow.last_seen < horizon]
+        return [self._export(key, self.flows.pop(key)) for key in idle]
+
+    def flush(self):
+        """Export every open flow, e.g. at the end of a capture"""
+        exported = [self._export(key, flow) for key, flow in self.flows.items()]
+        self.flows = {}
+        return exported
+
+    def _export(self, key, flow):
+        self.flows_exported += 1
+        src_ip, dst_ip, src_port, dst_port, protocol = key
+        return {
+            'src_ip': src_ip,
+            'dst_ip': dst_ip,
+            'src_port': src_port,
+            'dst_port': dst_port,
+            'protocol': protocol,
+            'timestamp': datetime.fromtimestamp(flow.first_seen).isoformat(),
+            'first_seen': flow.first_seen,
+            'last_seen': flow.last_seen,
+            'duration': round(flow.last_seen - flow.first_seen, 6),
+            'packets': flow.packets,
+            'volume': flow.volume,
+            'sizes': flow.sizes,
+            'intervals': flow.intervals
+        }
+
+
+def aggregate_stream(packet_queue, flow_file, expire_interval=None, stats=None):
+    """
+    Consume PacketRecords from packet_queue until STREAM_END, writing one JSON
+    line per exported flow to flow_file. Idle flows are expired as capture time
+    advances so the table only holds currently active flows.
+    """
+    table = FlowTable(expire_interval=expire_interval)
+    os.makedirs(os.path.dirname(flow_file) or ".", exist_ok=True)
+    with open(flow_file, 'w') as f:
+        def write(flows):
+            for flow in flows:
+                f.write(json.dumps(flow) + "\n")
+
+        while True:
+            record = packet_queue.get()
+            if record is STREAM_END:
+                break
+            write(table.push(record))
+        write(table.flush())
+
+    logger.info(f"Aggregated {table.packets_seen} packets into {table.flows_exported} flow records in {flow_file}")
+    if stats is not None:
+        stats.update({'packets': table.packets_seen, 'flows': table.flows_exported})
+    return table.flows_exported
+
+
+def load_flow_records(flow_file):
+    """
+    Read flow records written by aggregate_stream. They carry the same
+    src_ip/dst_ip/src_port/dst_port/timestamp keys as packet info dicts, so they
+    can be passed to EntryNodeDetector.find_all_entries and friends, or
+    RelayClassifier.classify, directly.
+    """
+    with open(flow_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,325 @@
+"""
+A1: Multi-Interface Capture
+Captures several interfaces in parallel, one worker process each, and merges
+their packets into a single time-ordered stream for the detector, or, in flows
+mode, has each worker aggregate its own packets and merges the flow records
+"""
+
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import (CAPTURE_BACKEND, MAX_PACKETS_IN_MEMORY, MULTI_CAPTURE_BATCH_SIZE,
+                                    MULTI_CAPTURE_BATCH_INTERVAL, DUPLICATE_WINDOW, FLOW_IDLE_TIMEOUT)
+from part_a.network_capture.records import STREAM_END
+from part_a.network_capture.flow_aggregator import FlowTable
+from part_a.network_capture.overload import SheddingQueue
+
+logger = logging.getLogger(__name__)
+
+# How long after capture a packet may still be on its way to the worker
+# (kernel block timeout plus scheduling delay)
+WATERMARK_SLACK = 0.5
+
+
+def interface_list(interface):
+    """Accept CAPTURE_INTERFACE as a single name, a comma separated string or a list"""
+    if isinstance(interface, str):
+        return [name.strip() for name in interface.split(",") if name.strip()]
+    return list(interface)
+
+
+def _capture_worker(interface, duration_sec, out_queue, bpf_filter, backend, tor_ports=None):
+    """
+    Runs in its own process: captures one interface and sends its packets
+    on in time-sorted batches, so the parent pays one IPC message per batch
+    instead of one per packet.
+
+    With tor_ports set (flows mode) the worker instead feeds its packets
+    through a SheddingQueue into its own FlowTable, and the batches carry the
+    flow records as they are exported; watermarks are then unused.
+
+    Each message is (interface, batch, watermark) where every packet this
+    interface delivers later has a timestamp >= watermark, or watermark is
+    None while the interface has delivered nothing. Watermarks are capture
+    timestamps: an idle interface moves its own on from the last packet it
+    saw by the time since, less WATERMARK_SLACK. The final message is
+    (interface, None, capture_stats).
+    """
+    from part_a.network_capture.capture import stream_packets
+
+    if tor_ports is None:
+        local_queue = queue.Queue(maxsize=MAX_PACKETS_IN_MEMORY)
+        table = None
+    else:
+        local_queue = SheddingQueue(tor_ports=tor_ports)
+        table = FlowTable()
+    stats = {}
+    producer = threading.Thread(
+        target=stream_packets,
+        args=(interface, duration_sec, local_queue, bpf_filter),
+        kwargs={'backend': backend, 'stats': stats},
+        daemon=True
+    )
+    producer.start()
+
+    batch = []
+    last_timestamp = None        # Newest capture timestamp seen on this interface
+    last_arrival = None          # time.monotonic() when it arrived
+    flush_at = time.monotonic() + MULTI_CAPTURE_BATCH_INTERVAL
+    while True:
+        try:
+            record = local_queue.get(timeout=max(0.0, flush_at - time.monotonic()))
+        except queue.Empty:
+            record = False
+        if record is STREAM_END:
+            break
+        if record:
+            if table is None:
+                batch.append(record)
+            else:
+                batch.extend(table.push(record))
+            if last_timestamp is None or record.timestamp >= last_timestamp:
+                last_timestamp = record.timestamp
+                last_arrival = time.monotonic()
+
+        if len(batch) >= MULTI_CAPTURE_BATCH_SIZE or time.monotonic() >= flush_at:
+            if table is None:
+                batch.sort(key=lambda r: r.timestamp)
+            watermark = None
+            if last_timestamp is not None:
+                watermark = last_timestamp + max(0.0, time.monotonic() - last_arrival - WATERMARK_SLACK)
+            out_queue.put((interface, batch, watermark))
+            batch = []
+            flush_at = time.monotonic() + MULTI_CAPTURE_BATCH_INTERVAL
+
+    producer.join()
+    if table is None:
+        batch.sort(key=lambda r: r.timestamp)
+    else:
+        batch.extend(table.flush())
+        stats.update({'load_shedding': local_queue.stats(),
+                      'packets_aggregated': table.packets_seen, 'flows': table.flows_exported})
+    out_queue.put((interface, batch, float('inf')))
+    out_queue.put((interface, None, stats))
+
+
+class DuplicateSuppressor:
+    """
+    Drops a packet seen on one interface if an identical packet (same
+    addresses, ports, protocol and length) was already seen on a different
+    interface within DUPLICATE_WINDOW seconds, as happens with mirrored SPAN
+    ports. Repeats on the same interface are real traffic and are kept.
+    """
+
+    def __init__(self, window=DUPLICATE_WINDOW):
+        self.window = window
+        self.recent = {}
+        self.order = deque()
+        self.suppressed = 0
+
+    def is_duplicate(self, record, interface):
+        # Records arrive in timestamp order, so expiry is a pop from the left
+        horizon = record.timestamp - self.window
+        while self.order and self.order[0][0] < horizon:
+            ts, key = self.order.popleft()
+            if self.recent.get(key, (None,))[0] == ts:
+                del self.recent[key]
+
+        key = (record.src_ip, record.dst_ip, record.src_port, record.dst_port, record.protocol, record.length)
+        seen = self.recent.get(key)
+        if seen and seen[1] != interface:
+            self.suppressed += 1
+            return True
+        self.recent[key] = (record.timestamp, interface)
+        self.order.append((record.timestamp, key))
+        return False
+
+
+class FlowDuplicateSuppressor:
+    """
+    DuplicateSuppressor for flow records aggregated by the interface workers:
+    a flow with the same addresses, ports, protocol, packet count and volume
+    as one already merged from a different interface, starting within
+    DUPLICATE_WINDOW of it, is the same traffic seen through a mirror port.
+
+    Workers export a flow at about the same time as its mirror image (idle
+    expiry runs on capture time), so flows are only remembered for
+    horizon seconds after they arrive.
+    """
+
+    def __init__(self, window=DUPLICATE_WINDOW, horizon=2 * FLOW_IDLE_TIMEOUT):
+        self.window = window
+        self.horizon = horizon
+        self.recent = {}
+        self.order = deque()
+        self.suppressed = 0
+
+    def is_duplicate(self, flow, interface):
+        now = time.monotonic()
+        while self.order and self.order[0][0] < now - self.horizon:
+            _, key, entry = self.order.popleft()
+            entries = self.recent[key]
+            entries.remove(entry)
+            if not entries:
+                del self.recent[key]
+
+        key = (flow['src_ip'], flow['dst_ip'], flow['src_port'], flow['dst_port'], flow['protocol'],
+               flow['packets'], flow['volume'])
+        entries = self.recent.setdefault(key, [])
+        for first_seen, seen_on in entries:
+            if seen_on != interface and abs(first_seen - flow['first_seen']) <= self.window:
+                self.suppressed += 1
+                return True
+        entry = (flow['first_seen'], interface)
+        entries.append(entry)
+        self.order.append((now, key, entry))
+        return False
+
+
+def _start_workers(interfaces, duration_sec, bpf_filter, backend, tor_ports=None):
+    """One _capture_worker process per interface, all sending on one queue"""
+    out_queue = multiprocessing.Queue(maxsize=max(4, MAX_PACKETS_IN_MEMORY // MULTI_CAPTURE_BATCH_SIZE))
+    workers = {}
+    for interface in interfaces:
+        worker = multiprocessing.Process(
+            target=_capture_worker,
+            args=(interface, duration_sec, out_queue, bpf_filter, backend, tor_ports),
+            daemon=True
+        )
+        worker.start()
+        workers[interface] = worker
+    return out_queue, workers
+
+
+def stream_interfaces(interfaces, duration_sec, packet_queue, bpf_filter=None, backend=CAPTURE_BACKEND, stats=None):
+    """
+    Capture every interface in its own process and put one merged,
+    time-ordered, de-duplicated stream of PacketRecords onto packet_queue,
+    followed by STREAM_END. Same contract as capture.stream_packets.
+    """
+    interfaces = interface_list(interfaces)
+    logger.info(f"Starting multi-interface capture on {', '.join(interfaces)} for {duration_sec} seconds")
+    out_queue, workers = _start_workers(interfaces, duration_sec, bpf_filter, backend)
+
+    watermarks = {interface: None for interface in interfaces}
+    interface_stats = {}
+    pending = []          # heap of (timestamp, sequence, interface, record)
+    sequence = 0
+    suppressor = DuplicateSuppressor()
+    merged = 0
+
+    def low_watermark():
+        # Everything older than the slowest live interface's watermark is final.
+        # An interface that has delivered nothing yet only holds the merge
+        # WATERMARK_SLACK behind the others instead of stalling it.
+        if not watermarks:
+            return float('inf')
+        seen = [mark for mark in watermarks.values() if mark is not None]
+        if not seen:
+            return float('-inf')
+        return min(seen) - (WATERMARK_SLACK if len(seen) < len(watermarks) else 0)
+
+    def release(up_to):
+        nonlocal merged
+        while pending and pending[0][0] <= up_to:
+            _, _, interface, record = heapq.heappop(pending)
+            if not suppressor.is_duplicate(record, interface):
+                packet_queue.put(record)
+                merged += 1
+
+    try:
+        while watermarks:
+            try:
+                interface, batch, extra = out_queue.get(timeout=1)
+            except queue.Empty:
+                for interface in [name for name in watermarks if not workers[name].is_alive()]:
+                    logger.error(f"Capture worker for {interface} exited without finishing")
+                    del watermarks[interface]
+                release(low_watermark())
+                continue
+            if batch is None:
+                interface_stats[interface] = extra
+                del watermarks[interface]
+            else:
+                for record in batch:
+                    heapq.heappush(pending, (record.timestamp, sequence, interface, record))
+                    sequence += 1
+                if extra is not None:
+                    watermarks[interface] = extra if watermarks[interface] is None else max(watermarks[interface], extra)
+            release(low_watermark())
+    finally:
+        for worker in workers.values():
+            worker.join(timeout=5)
+        packet_queue.put(STREAM_END)
+
+    logger.info(f"Multi-interface capture completed: {merged} packets merged, "
+                f"{suppressor.suppressed} cross-interface duplicates suppressed")
+    if stats is not None:
+        stats.update({
+            'backend': backend,
+            'interfaces': interface_stats,
+            'packets': merged,
+            'duplicates_suppressed': suppressor.suppressed
+        })
+
+
+def aggregate_interfaces(interfaces, duration_sec, flow_file, bpf_filter=None, backend=CAPTURE_BACKEND,
+                         tor_ports=None, stats=None):
+    """
+    Capture every interface in its own process, each aggregating its own
+    packets with a FlowTable, and write the flow records of all of them to
+    flow_file, one JSON line each, with cross-interface duplicates dropped.
+    Same output as flow_aggregator.aggregate_stream over stream_interfaces,
+    without shipping every packet to the parent. Returns the flow count.
+    """
+    interfaces = interface_list(interfaces)
+    logger.info(f"Starting multi-interface flow capture on {', '.join(interfaces)} for {duration_sec} seconds")
+    out_queue, workers = _start_workers(interfaces, duration_sec, bpf_filter, backend,
+                                        tor_ports=frozenset(tor_ports or ()))
+    live = set(interfaces)
+    interface_stats = {}
+    suppressor = FlowDuplicateSuppressor()
+    written = 0
+
+    os.makedirs(os.path.dirname(flow_file) or ".", exist_ok=True)
+    try:
+        with open(flow_file, 'w') as f:
+            while live:
+                try:
+                    interface, batch, extra = out_queue.get(timeout=1)
+                except queue.Empty:
+                    for interface in [name for name in live if not workers[name].is_alive()]:
+                        logger.error(f"Capture worker for {interface} exited without finishing")
+                        live.discard(interface)
+                    continue
+                if batch is None:
+                    interface_stats[interface] = extra
+                    live.discard(interface)
+                    continue
+                for flow in batch:
+                    if not suppressor.is_duplicate(flow, interface):
+                        f.write(json.dumps(flow) + "\n")
+                        written += 1
+    finally:
+        for worker in workers.values():
+            worker.join(timeout=5)
+
+    logger.info(f"Multi-interface flow capture completed: {written} flow records in {flow_file}, "
+                f"{suppressor.suppressed} cross-interface duplicates suppressed")
+    if stats is not None:
+        stats.update({
+            'backend': backend,
+            'interfaces': interface_stats,
+            'flows': written,
+            'duplicates_suppressed': suppressor.suppressed
+        })
+    return written
@@ -0,0 +1,121 @@
+"""
+A1: Overload Protection
+Bounded capture-to-detection queue that sheds load in steps when the
+consumer falls behind, and counts everything it sheds so each run's
+completeness is known
+"""
+
+import logging
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import (MAX_PACKETS_IN_MEMORY, CLEANUP_INTERVAL, TOR_PORTS,
+                                    SHED_THRESHOLDS, FLOW_SAMPLE_RATE)
+from part_a.network_capture.records import STREAM_END
+
+logger = logging.getLogger(__name__)
+
+LEVEL_NORMAL = 0
+LEVEL_TOR_PORTS_ONLY = 1
+LEVEL_SAMPLE_FLOWS = 2
+LEVEL_DROP = 3
+LEVEL_NAMES = ['normal', 'tor_ports_only', 'sample_flows', 'drop']
+
+# A level is only left once the fill ratio is this far below its threshold,
+# so the shedder does not flap around a boundary
+HYSTERESIS = 0.1
+
+
+class SheddingQueue(queue.Queue):
+    """
+    Queue that never blocks the capture side. put() admits a PacketRecord
+    depending on how full the queue is:
+
+        fill < thresholds[0]   admit everything
+        fill >= thresholds[0]  drop packets not on a TOR port
+        fill >= thresholds[1]  also keep only 1 in sample_rate flows (by 5-tuple hash)
+        queue full             drop the packet
+
+    STREAM_END is always delivered. While anything is being shed the counters
+    are logged every CLEANUP_INTERVAL seconds.
+    """
+
+    def __init__(self, maxsize=MAX_PACKETS_IN_MEMORY, tor_ports=None,
+                 thresholds=SHED_THRESHOLDS, sample_rate=FLOW_SAMPLE_RATE):
+        super().__init__(maxsize=maxsize)
+        self.tor_ports = frozenset(tor_ports or TOR_PORTS)
+        self.thresholds = thresholds
+        self.sample_rate = sample_rate
+        self.level = LEVEL_NORMAL
+        self.max_level = LEVEL_NORMAL
+        self.offered = 0
+        self.admitted = 0
+        self.shed_non_tor_port = 0
+        self.shed_by_sampling = 0
+        self.dropped_queue_full = 0
+        self.next_report = time.monotonic() + CLEANUP_INTERVAL
+
+    def put(self, item, block=True, timeout=None):
+        if item is STREAM_END:
+            return super().put(item, block, timeout)
+
+        self.offered += 1
+        level = self._update_level()
+        if level and time.monotonic() >= self.next_report:
+            logger.warning(f"Capture load shedding counters: {self.stats()}")
+            self.next_report = time.monotonic() + CLEANUP_INTERVAL
+        if level >= LEVEL_TOR_PORTS_ONLY and item.src_port not in self.tor_ports \
+                and item.dst_port not in self.tor_ports:
+            self.shed_non_tor_port += 1
+            return
+        if level >= LEVEL_SAMPLE_FLOWS and self._flow_hash(item) % self.sample_rate:
+            self.shed_by_sampling += 1
+            return
+        try:
+            super().put(item, block=False)
+        except queue.Full:
+            self._set_level(LEVEL_DROP)
+            self.dropped_queue_full += 1
+            return
+        self.admitted += 1
+
+    def _flow_hash(self, record):
+        # Same hash for both directions so sampled flows stay complete; a
+        # missing port (ICMP, fragments) is 0 so equal addresses still compare
+        a = (record.src_ip, record.src_port or 0)
+        b = (record.dst_ip, record.dst_port or 0)
+        return hash((a, b, record.protocol) if a <= b else (b, a, record.protocol))
+
+    def _update_level(self):
+        fill = self.qsize() / self.maxsize
+        level = self.level
+        while level < LEVEL_SAMPLE_FLOWS and fill >= self.thresholds[level]:
+            level += 1
+        while level > LEVEL_NORMAL and fill < self.thresholds[min(level, LEVEL_SAMPLE_FLOWS) - 1] - HYSTERESIS:
+            level -= 1
+        self._set_level(level)
+        return level
+
+    def _set_level(self, level):
+        if level != self.level:
+            logger.info(f"Capture load shedding level {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]}")
+            self.level = level
+            self.max_level = max(self.max_level, level)
+
+    def stats(self):
+        """Shedding counters for the run, for detection_results.json"""
+        shed = self.shed_non_tor_port + self.shed_by_sampling + self.dropped_queue_full
+        return {
+            'offered': self.offered,
+            'admitted': self.admitted,
+            'shed_non_tor_port': self.shed_non_tor_port,
+            'shed_by_sampling': self.shed_by_sampling,
+            'dropped_queue_full': self.dropped_queue_full,
+            'flow_sample_rate': self.sample_rate if self.shed_by_sampling else 1,
+            'max_level': LEVEL_NAMES[self.max_level],
+            'completeness_pct': round(100.0 * self.admitted / self.offered, 2) if self.offered else 100.0,
+            'shed_total': shed
+        }
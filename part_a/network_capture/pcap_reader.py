@@ -0,0 +1,315 @@
+"""
+A1: PCAP Reader
+Memory-maps pcap and pcapng files and decodes only the header fields the
+detector needs, so captures are read at disk speed without building a
+packet object per frame or loading the whole file first
+"""
+
+import logging
+import mmap
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.network_capture.records import (decode_ethernet, decode_ip, ETHERTYPE_IPV4, ETHERTYPE_IPV6)
+
+logger = logging.getLogger(__name__)
+
+# Classic pcap magics as read little-endian: (byte order, nanosecond timestamps)
+PCAP_MAGICS = {
+    0xA1B2C3D4: ('<', False),
+    0xD4C3B2A1: ('>', False),
+    0xA1B23C4D: ('<', True),
+    0x4D3CB2A1: ('>', True),
+}
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_IDB = 1
+PCAPNG_PB = 2           # obsolete Packet Block
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+IF_TSRESOL = 9
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+NULL_AF_INET6 = (24, 28, 30)     # BSD, FreeBSD and macOS values of AF_INET6
+
+_u16 = struct.Struct('!H').unpack_from
+
+
+def _decode_null(buf, offset, caplen, length, timestamp, prefilter=None):
+    family = buf[offset] or buf[offset + 3]      # 4-byte family in the writer's byte order
+    ethertype = ETHERTYPE_IPV6 if family in NULL_AF_INET6 else ETHERTYPE_IPV4
+    return decode_ip(buf, offset + 4, offset + caplen, ethertype, length, timestamp, prefilter)
+
+
+def _decode_raw(buf, offset, caplen, length, timestamp, prefilter=None):
+    if not caplen:
+        return None
+    ethertype = ETHERTYPE_IPV6 if buf[offset] >> 4 == 6 else ETHERTYPE_IPV4
+    return decode_ip(buf, offset, offset + caplen, ethertype, length, timestamp, prefilter)
+
+
+def _decode_sll(buf, offset, caplen, length, timestamp, prefilter=None):
+    if caplen < 16:
+        return None
+    return decode_ip(buf, offset + 16, offset + caplen, _u16(buf, offset + 14)[0], length, timestamp, prefilter)
+
+
+def _decode_sll2(buf, offset, caplen, length, timestamp, prefilter=None):
+    if caplen < 20:
+        return None
+    return decode_ip(buf, offset + 20, offset + caplen, _u16(buf, offset)[0], length, timestamp, prefilter)
+
+
+DECODERS = {
+    LINKTYPE_NULL: _decode_null,
+    LINKTYPE_ETHERNET: decode_ethernet,
+    LINKTYPE_LINUX_SLL: _decode_sll,
+    LINKTYPE_LINUX_SLL2: _decode_sll2,
+    LINKTYPE_IPV4: _decode_raw,
+    LINKTYPE_IPV6: _decode_raw,
+}
+DECODERS.update({linktype: _decode_raw for linktype in LINKTYPE_RAW})
+
+
+class PcapReader:
+    """
+    Reads a pcap or pcapng file through mmap.
+
+    frames() yields (timestamp, offset, caplen, wire_length, linktype) with
+    the frame data at self.view[offset:offset + caplen]; records() decodes
+    them into PacketRecords. self.packets counts every frame read, IP or not.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.map = None
+        self.view = memoryview(b'')
+        if os.fstat(self.file.fileno()).st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        self.packets = 0
+        self.skipped_linktypes = set()
+
+    def _format(self):
+        if len(self.view) < 4:
+            return None
+        magic = struct.unpack_from('<I', self.view)[0]
+        if magic == PCAPNG_SHB:
+            return 'pcapng'
+        if magic in PCAP_MAGICS:
+            return 'pcap'
+        raise ValueError(f"{self.filename} is not a pcap or pcapng file")
+
+    def frames(self, shard=None):
+        """Iterate over all frames, or only those of one shard from shards()"""
+        file_format = self._format()
+        if file_format is None:
+            return iter(())
+        start, end, state = shard or (None, None, None)
+        if file_format == 'pcapng':
+            return self._pcapng_frames(start, end, state)
+        order, nanoseconds = PCAP_MAGICS[struct.unpack_from('<I', self.view)[0]]
+        return self._pcap_frames(order, nanoseconds, start, end)
+
+    def _pcap_frames(self, order, nanoseconds, start=None, end=None):
+        view = self.view
+        linktype = struct.unpack_from(order + 'I', view, 20)[0] & 0x0FFFFFFF
+        record_header = struct.Struct(order + 'IIII')
+        divisor = 1e9 if nanoseconds else 1e6
+        pos, size = start or 24, len(view)
+        end = min(end or size, size)
+        while pos + 16 <= end:
+            seconds, fraction, caplen, length = record_header.unpack_from(view, pos)
+            pos += 16
+            if pos + caplen > size:
+                logger.warning(f"{self.filename} ends with a truncated packet")
+                break
+            self.packets += 1
+            yield seconds + fraction / divisor, pos, caplen, length, linktype
+            pos += caplen
+
+    def _pcapng_frames(self, start=None, end=None, state=None):
+        view = self.view
+        size = len(view)
+        pos = start or 0
+        end = min(end or size, size)
+        # Byte order and (linktype, timestamp units per second) per interface id
+        order, interfaces = state or ('<', [])
+        while pos + 12 <= end:
+            block_type = struct.unpack_from('<I', view, pos)[0]
+            if block_type == PCAPNG_SHB:
+                # Each section declares its own byte order and interface list
+                order = '<' if struct.unpack_from('<I', view, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+            else:
+                block_type = struct.unpack_from(order + 'I', view, pos)[0]
+            block_len = struct.unpack_from(order + 'I', view, pos + 4)[0]
+            if block_len < 12 or pos + block_len > size:
+                logger.warning(f"{self.filename} ends with a truncated block")
+                break
+            body = pos + 8
+
+            if block_type == PCAPNG_IDB:
+                linktype = struct.unpack_from(order + 'H', view, body)[0]
+                interfaces.append((linktype, self._tsresol(order, body + 8, pos + block_len - 4)))
+            elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+                if block_type == PCAPNG_EPB:
+                    interface_id, high, low, caplen, length = struct.unpack_from(order + '5I', view, body)
+                else:
+                    interface_id, _, high, low, caplen, length = struct.unpack_from(order + '2H4I', view, body)
+                linktype, units = interfaces[interface_id]
+                self.packets += 1
+                yield ((high << 32) | low) / units, body + 20, caplen, length, linktype
+            elif block_type == PCAPNG_SPB:
+                length = struct.unpack_from(order + 'I', view, body)[0]
+                linktype, _ = interfaces[0]
+                self.packets += 1
+                # Simple Packet Blocks carry no timestamp
+                yield 0.0, body + 4, min(length, block_len - 16), length, linktype
+            pos += block_len
+
+    def _tsresol(self, order, pos, end):
+        """Timestamp units per second from an IDB's if_tsresol option (default microseconds)"""
+        view = self.view
+        while pos + 4 <= end:
+            code, length = struct.unpack_from(order + 'HH', view, pos)
+            if code == 0:
+                break
+            if code == IF_TSRESOL and length >= 1:
+                value = view[pos + 4]
+                return 2 ** (value & 0x7F) if value & 0x80 else 10 ** value
+            pos += 4 + (length + 3) // 4 * 4
+        return 10 ** 6
+
+    def shards(self, count):
+        """
+        Split the file into up to count record-aligned (start, end, state) byte
+        ranges that can be read independently, e.g. by worker processes, via
+        frames(shard) / records(shard). state carries the pcapng byte order
+        and interface table in effect at start; it is None for classic pcap.
+        """
+        file_format = self._format()
+        size = len(self.view)
+        if file_format is None or count <= 1:
+            return [(None, None, None)]
+        if file_format == 'pcapng':
+            return self._pcapng_shards(count)
+
+        order, nanoseconds = PCAP_MAGICS[struct.unpack_from('<I', self.view)[0]]
+        snaplen = struct.unpack_from(order + 'I', self.view, 16)[0] or 262144
+        first = struct.unpack_from(order + 'I', self.view, 24)[0] if size >= 40 else 0
+        check = _PcapHeaderCheck(self.view, order, nanoseconds, snaplen, first)
+        bounds = [24]
+        for i in range(1, count):
+            target = 24 + (size - 24) * i // count
+            if target <= bounds[-1]:
+                continue
+            pos = check.resync(target)
+            if pos is not None and pos > bounds[-1]:
+                bounds.append(pos)
+        bounds.append(size)
+        return [(bounds[i], bounds[i + 1], None) for i in range(len(bounds) - 1)]
+
+    def _pcapng_shards(self, count):
+        # Blocks carry their own length, so walking the block headers is cheap
+        # and gives exact boundaries plus the section state at each one
+        view = self.view
+        size = len(view)
+        step = max(1, size // count)
+        shards = []
+        start, start_state = 0, None
+        pos, order, interfaces = 0, '<', []
+        while pos + 12 <= size:
+            if pos - start >= step:
+                shards.append((start, pos, start_state))
+                start, start_state = pos, (order, list(interfaces))
+            block_type = struct.unpack_from('<I', view, pos)[0]
+            if block_type == PCAPNG_SHB:
+                order = '<' if struct.unpack_from('<I', view, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+            elif struct.unpack_from(order + 'I', view, pos)[0] == PCAPNG_IDB:
+                block_len = struct.unpack_from(order + 'I', view, pos + 4)[0]
+                linktype = struct.unpack_from(order + 'H', view, pos + 8)[0]
+                interfaces.append((linktype, self._tsresol(order, pos + 16, pos + block_len - 4)))
+            block_len = struct.unpack_from(order + 'I', view, pos + 4)[0]
+            if block_len < 12:
+                break
+            pos += block_len
+        shards.append((start, size, start_state))
+        return shards
+
+    def records(self, shard=None, prefilter=None):
+        """
+        Yield a PacketRecord for every IP frame (of one shard, if given);
+        with a prefilter (see decode_ethernet) only for frames it accepts
+        """
+        view = self.view
+        for timestamp, offset, caplen, length, linktype in self.frames(shard):
+            decoder = DECODERS.get(linktype)
+            if decoder is None:
+                if linktype not in self.skipped_linktypes:
+                    logger.warning(f"{self.filename}: unsupported link type {linktype}, frames skipped")
+                    self.skipped_linktypes.add(linktype)
+                continue
+            record = decoder(view, offset, caplen, length, timestamp, prefilter)
+            if record is not None:
+                yield record
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _PcapHeaderCheck:
+    """Finds the next record header at or after an arbitrary offset of a classic pcap"""
+
+    # Consecutive plausible headers required before an offset is accepted
+    CHAIN = 8
+    # Give up on a split point after scanning this far
+    SCAN_LIMIT = 1 << 20
+
+    def __init__(self, view, order, nanoseconds, snaplen, first_seconds):
+        self.view = view
+        self.header = struct.Struct(order + 'IIII')
+        self.max_fraction = 10 ** 9 if nanoseconds else 10 ** 6
+        self.snaplen = snaplen
+        self.first_seconds = first_seconds
+
+    def _plausible(self, pos):
+        seconds, fraction, caplen, length = self.header.unpack_from(self.view, pos)
+        return (fraction < self.max_fraction and caplen <= self.snaplen and caplen <= length
+                and 0 <= seconds - self.first_seconds < 10 * 365 * 86400)
+
+    def resync(self, target):
+        size = len(self.view)
+        for pos in range(target, min(target + self.SCAN_LIMIT, size - 16)):
+            chain, check = 0, pos
+            while chain < self.CHAIN and check + 16 <= size and self._plausible(check):
+                check += 16 + self.header.unpack_from(self.view, check)[2]
+                chain += 1
+            if chain == self.CHAIN or (chain and check == size):
+                return pos
+        return None
+
+
+def read_pcap(filename):
+    """Yield the PacketRecords of a pcap/pcapng file; replaces scapy's rdpcap for detection"""
+    with PcapReader(filename) as reader:
+        yield from reader.records()
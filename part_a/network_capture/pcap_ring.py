@@ -0,0 +1,168 @@
+"""
+A1: PCAP Segment Ring
+Keeps captures as a ring of bounded pcap segments under a total byte budget,
+evicting the oldest first, and records them in a small manifest so readers
+can find segments without scanning the directory
+"""
+
+import bisect
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import PCAP_RING_DIR, PCAP_RING_MAX_BYTES, PCAP_SEGMENT_BYTES, PCAP_SEGMENT_SECONDS
+from part_a.network_capture.pcap_writer import PcapWriter
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+class PcapRing:
+    """
+    Ring of pcap segments described by manifest.json:
+
+        {"segments": [{"file", "run", "start", "end", "bytes", "packets"}, ...]}
+
+    Segments are listed oldest first; start/end are epoch seconds.
+    """
+
+    def __init__(self, directory=None, max_bytes=PCAP_RING_MAX_BYTES):
+        self.directory = directory or PCAP_RING_DIR
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(self.directory, MANIFEST_NAME)
+        os.makedirs(self.directory, exist_ok=True)
+        self.segments = self._load_manifest()
+        self.run = None
+        self.sequence = 0
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f).get('segments', [])
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logger.error(f"Unreadable pcap ring manifest {self.manifest_path}, starting a new one: {e}")
+            return []
+
+    def _save_manifest(self):
+        # Write then rename so readers never see a half-written manifest
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'segments': self.segments}, f, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+    def start_run(self):
+        """Begin a new capture run; its segments share a run id"""
+        self.run = datetime.now().strftime("%Y%m%d%H%M%S")
+        self.sequence = 0
+        return self.run
+
+    def next_segment_path(self, backend):
+        """File name for the next segment of the current run"""
+        if self.run is None:
+            self.start_run()
+        self.sequence += 1
+        return os.path.join(self.directory, f"packets_{self.run}_{self.sequence:04d}_{backend}.pcap")
+
+    def add_segment(self, path, start, end, packets=None):
+        """Register a finished segment, then evict old segments over the byte budget"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            logger.warning(f"Capture segment {path} was not written, skipping")
+            return
+        self.segments.append({
+            'file': os.path.basename(path),
+            'run': self.run,
+            'start': start,
+            'end': end,
+            'bytes': size,
+            'packets': packets
+        })
+        self.evict()
+        self._save_manifest()
+        logger.info(f"Added capture segment {path} ({size} bytes)")
+
+    def evict(self):
+        """Delete oldest segments until the ring fits its byte budget (the newest is always kept)"""
+        total = sum(segment['bytes'] for segment in self.segments)
+        while total > self.max_bytes and len(self.segments) > 1:
+            oldest = self.segments.pop(0)
+            total -= oldest['bytes']
+            try:
+                os.remove(os.path.join(self.directory, oldest['file']))
+            except FileNotFoundError:
+                pass
+            logger.info(f"Evicted capture segment {oldest['file']} ({oldest['bytes']} bytes)")
+
+    def path(self, segment):
+        return os.path.join(self.directory, segment['file'])
+
+    def latest_segment(self):
+        """Path of the newest segment, or None"""
+        return self.path(self.segments[-1]) if self.segments else None
+
+    def run_segments(self, run):
+        """Paths of all segments from capture run `run`, oldest first"""
+        return [self.path(segment) for segment in self.segments if segment['run'] == run]
+
+    def latest_run_segments(self):
+        """Paths of all segments from the most recent capture run, oldest first"""
+        return self.run_segments(self.segments[-1]['run']) if self.segments else []
+
+    def segments_between(self, start, end):
+        """Paths of segments overlapping the epoch time range [start, end], oldest first"""
+        # Segments are appended in time order, so binary search the first candidate
+        ends = [segment['end'] for segment in self.segments]
+        first = bisect.bisect_left(ends, start)
+        return [self.path(segment) for segment in self.segments[first:] if segment['start'] <= end]
+
+
+class RingWriter:
+    """
+    Writes frames into the ring, rolling over to a new segment when the
+    current one reaches PCAP_SEGMENT_BYTES or PCAP_SEGMENT_SECONDS
+    """
+
+    def __init__(self, ring, backend, segment_bytes=PCAP_SEGMENT_BYTES, segment_seconds=PCAP_SEGMENT_SECONDS):
+        self.ring = ring
+        self.backend = backend
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.writer = None
+        self.start = None
+        self.last = None
+
+    def write(self, timestamp, frame, length=None):
+        if self.writer and self._segment_full(timestamp):
+            self._finish_segment()
+        if self.writer is None:
+            self.writer = PcapWriter(self.ring.next_segment_path(self.backend))
+            self.start = timestamp
+        self.writer.write(timestamp, frame, length)
+        self.last = timestamp
+
+    def _segment_full(self, timestamp):
+        if self.segment_bytes and self.writer.bytes_written >= self.segment_bytes:
+            return True
+        return bool(self.segment_seconds) and timestamp - self.start >= self.segment_seconds
+
+    def _finish_segment(self):
+        self.writer.close()
+        self.ring.add_segment(self.writer.filename, self.start, self.last, self.writer.packets_written)
+        self.writer = None
+
+    def close(self):
+        if self.writer:
+            self._finish_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
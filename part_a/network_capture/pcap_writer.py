@@ -0,0 +1,42 @@
+"""
+A1: PCAP Writer
+Writes captured frames to a classic libpcap file
+"""
+
+import struct
+
+PCAP_MAGIC = 0xA1B2C3D4
+LINKTYPE_ETHERNET = 1
+
+_global_header = struct.Struct('=IHHiIII')
+_record_header = struct.Struct('=IIII')
+
+
+class PcapWriter:
+    """Appends frames to a pcap file readable by tshark, scapy and the detector"""
+
+    def __init__(self, filename, snaplen=65535, linktype=LINKTYPE_ETHERNET):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(_global_header.pack(PCAP_MAGIC, 2, 4, 0, 0, snaplen, linktype))
+        self.bytes_written = _global_header.size
+        self.packets_written = 0
+
+    def write(self, timestamp, frame, length=None):
+        """Write one frame; length is the original wire length if frame was truncated"""
+        seconds = int(timestamp)
+        micros = int((timestamp - seconds) * 1_000_000)
+        caplen = len(frame)
+        self.file.write(_record_header.pack(seconds, micros, caplen, length or caplen))
+        self.file.write(frame)
+        self.bytes_written += _record_header.size + caplen
+        self.packets_written += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
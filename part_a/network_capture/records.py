@@ -0,0 +1,87 @@
+"""
+A1: Packet Records
+Lightweight per-packet records passed from capture to detection
+"""
+
+import socket
+import struct
+from collections import namedtuple
+
+# Only the header fields the detector needs; everything else is dropped at capture time
+PacketRecord = namedtuple(
+    'PacketRecord',
+    ['timestamp', 'src_ip', 'dst_ip', 'src_port', 'dst_port', 'protocol', 'length']
+)
+
+# Marker put on a stream queue once the producer has finished
+STREAM_END = None
+
+ETH_HEADER_LEN = 14
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+TRANSPORT_NAMES = {6: 'TCP', 17: 'UDP'}
+
+# IPv4 addresses as prefilter keys, mapped into IPv6 like relay_index.ip_key()
+V4_MAPPED = 0xFFFF << 32
+
+_unpack_u16 = struct.Struct('!H').unpack_from
+_unpack_ports = struct.Struct('!HH').unpack_from
+_unpack_addresses = struct.Struct('!II').unpack_from
+
+
+def decode_ethernet(buf, offset, caplen, length, timestamp, prefilter=None):
+    """
+    Decode the Ethernet/IP/transport headers of one frame in buf into a PacketRecord.
+
+    buf can be bytes, an mmap or a memoryview; only the header fields are read,
+    the payload is never copied. Returns None for non-IP or truncated frames,
+    and for frames where prefilter (called with each address as an integer,
+    e.g. RelayStore.screen) accepts neither address.
+    """
+    end = offset + caplen
+    if caplen < ETH_HEADER_LEN:
+        return None
+    ethertype = _unpack_u16(buf, offset + 12)[0]
+    pos = offset + ETH_HEADER_LEN
+    while ethertype in ETHERTYPE_VLAN and pos + 4 <= end:
+        ethertype = _unpack_u16(buf, pos + 2)[0]
+        pos += 4
+    return decode_ip(buf, pos, end, ethertype, length, timestamp, prefilter)
+
+
+def decode_ip(buf, pos, end, ethertype, length, timestamp, prefilter=None):
+    """Decode an IPv4/IPv6 header starting at pos, see decode_ethernet"""
+    if ethertype == ETHERTYPE_IPV4:
+        if pos + 20 > end:
+            return None
+        if prefilter is not None:
+            src, dst = _unpack_addresses(buf, pos + 12)
+            if not prefilter(V4_MAPPED | src) and not prefilter(V4_MAPPED | dst):
+                return None
+        header_len = (buf[pos] & 0x0F) * 4
+        proto = buf[pos + 9]
+        src_ip = socket.inet_ntoa(buf[pos + 12:pos + 16])
+        dst_ip = socket.inet_ntoa(buf[pos + 16:pos + 20])
+        # Only the first fragment carries the transport header
+        fragmented = _unpack_u16(buf, pos + 6)[0] & 0x1FFF
+        transport = None if fragmented else pos + header_len
+    elif ethertype == ETHERTYPE_IPV6:
+        if pos + 40 > end:
+            return None
+        if prefilter is not None and not prefilter(int.from_bytes(buf[pos + 8:pos + 24], 'big')) \
+                and not prefilter(int.from_bytes(buf[pos + 24:pos + 40], 'big')):
+            return None
+        proto = buf[pos + 6]
+        src_ip = socket.inet_ntop(socket.AF_INET6, buf[pos + 8:pos + 24])
+        dst_ip = socket.inet_ntop(socket.AF_INET6, buf[pos + 24:pos + 40])
+        transport = pos + 40
+    else:
+        return None
+
+    protocol = TRANSPORT_NAMES.get(proto)
+    src_port = dst_port = None
+    if protocol and transport is not None and transport + 4 <= end:
+        src_port, dst_port = _unpack_ports(buf, transport)
+
+    return PacketRecord(timestamp, src_ip, dst_ip, src_port, dst_port, protocol, length)
@@ -0,0 +1,114 @@
+"""
+A2: Relay Address Prefilter
+Bloom filter over relay addresses, built with the relay store and mapped
+with it. Most captured packets never touch a relay; the filter turns them
+away after a hash or two instead of a full index probe
+"""
+
+import math
+
+_MASK64 = (1 << 64) - 1
+# Odd 64-bit multiplier, distinct from the relay store's hash table one
+_MULTIPLIER = 0xC2B2AE3D27D4EB4F
+
+
+def bloom_parameters(count, fp_rate):
+    """(bits, hashes) for count keys at fp_rate; bits is a power of two so positions are masked, not divided"""
+    count = max(1, count)
+    bits = -count * math.log(fp_rate) / math.log(2) ** 2
+    bits = 1 << max(6, (math.ceil(bits) - 1).bit_length())
+    # Rounding bits up already lowers the rate, so hashes stay at the optimum for fp_rate
+    hashes = max(1, round(-math.log2(fp_rate)))
+    return bits, hashes
+
+
+def _positions(key, bits, hashes):
+    # Double hashing from one product: the top bits give the first position,
+    # the low bits the (odd) step
+    product = (key >> 64 ^ key) * _MULTIPLIER & _MASK64
+    mask = bits - 1
+    position, step = product >> (64 - mask.bit_length()), product & mask | 1
+    return [(position + i * step) & mask for i in range(hashes)]
+
+
+def build_bloom(keys, fp_rate):
+    """Filter bytes over ip_key() integers: (data, bits, hashes)"""
+    keys = set(keys)
+    bits, hashes = bloom_parameters(len(keys), fp_rate)
+    data = bytearray(bits // 8)
+    for key in keys:
+        for position in _positions(key, bits, hashes):
+            data[position >> 3] |= 1 << (position & 7)
+    return bytes(data), bits, hashes
+
+
+class BloomFilter:
+    """
+    Read-only filter over `bits` bits of data starting at offset (a mapped
+    relay store, or bytes from build_bloom()). might_contain() answers False
+    for an address that is certainly not a relay and stops at the first
+    clear bit, so a miss usually costs one or two probes.
+
+    Counters are per process: checked, rejected, and false_positives as
+    reported back by the caller after a full lookup missed (see
+    RelayStore.screen()).
+    """
+
+    def __init__(self, data, bits, hashes, offset=0, fp_rate=None):
+        self.data = data
+        self.bits = bits
+        self.hashes = hashes
+        self.offset = offset
+        self.fp_rate = fp_rate
+        self._shift = 64 - (bits - 1).bit_length()
+        self._mask = bits - 1
+        self.checked = 0
+        self.rejected = 0
+        self.false_positives = 0
+
+    def might_contain(self, key):
+        """False if the ip_key() integer key is certainly not in the filter"""
+        self.checked += 1
+        product = (key >> 64 ^ key) * _MULTIPLIER & _MASK64
+        position = product >> self._shift
+        data, offset = self.data, self.offset
+        # About half the bits are set, so the first probe alone turns away half the misses
+        if not data[offset + (position >> 3)] >> (position & 7) & 1:
+            self.rejected += 1
+            return False
+        mask = self._mask
+        step = product & mask | 1
+        for _ in range(self.hashes - 1):
+            position = (position + step) & mask
+            if not data[offset + (position >> 3)] >> (position & 7) & 1:
+                self.rejected += 1
+                return False
+        return True
+
+    def take_counts(self):
+        """Counters since the last call, reset to zero, for merging into another filter's"""
+        counts = (self.checked, self.rejected, self.false_positives)
+        self.checked = self.rejected = self.false_positives = 0
+        return counts
+
+    def add_counts(self, counts):
+        checked, rejected, false_positives = counts
+        self.checked += checked
+        self.rejected += rejected
+        self.false_positives += false_positives
+
+    def stats(self):
+        passed = self.checked - self.rejected
+        negatives = self.rejected + self.false_positives
+        return {
+            'bits': self.bits,
+            'hashes': self.hashes,
+            'target_fp_rate': self.fp_rate,
+            'checked': self.checked,
+            'rejected': self.rejected,
+            'passed': passed,
+            'false_positives': self.false_positives,
+            'reject_rate': round(self.rejected / self.checked, 4) if self.checked else 0,
+            # Share of non-relay addresses the filter let through
+            'observed_fp_rate': round(self.false_positives / negatives, 6) if negatives else 0
+        }
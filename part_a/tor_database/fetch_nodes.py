@@ -47,6 +47,12 @@ from datetime import datetime
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.settings import *
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from part_a.geolocation.geolocation import get_geolocation_service
+from part_a.tor_database.onionoo_stream import OnionooStream, CHUNK_SIZE
+from part_a.tor_database.relay_index import RelayIndex, canonical_ip, split_address
+from part_a.tor_database.relay_history import RelayHistory
+from part_a.tor_database.relay_store import RelayStore, write_relay_store, store_is_current
 
 # Setup logging
 logging.basicConfig(
@@ -59,56 +65,112 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def family_id(relay):
+    """
+    Name for an onionoo relay's effective family: the lowest fingerprint in
+    it, so every member of the family gets the same one
+    """
+    members = {member.lstrip('$').upper() for member in relay.get('effective_family') or ()}
+    if relay.get('fingerprint'):
+        members.add(relay['fingerprint'].upper())
+    return min(members) if members else None
+
+
+# Database fields kept in the relay store, so a mapped store can answer refresh()
+STORE_META_FIELDS = ('last_checked', 'last_modified', 'relays_published')
+# Node fields RelayIndex looks at; a relay whose values change is re-indexed
+INDEXED_FIELDS = ('ip_address', 'or_port', 'or_addresses', 'exit_addresses', 'running', 'is_guard', 'is_exit',
+                  'country')
+
 
 class TORDatabase:
-    """Manages TOR node database"""
+    """
+    Manages TOR node database
+    
+    Lookups go through self.index, which is only ever replaced whole: a new
+    index is built (or a new relay store mapped) on the side and published
+    by rebinding the attribute, so a reader holding the old one finishes
+    against it and no reader sees a half-built index. `generation` counts
+    the swaps.
+    """
     
     def __init__(self):
         self.nodes = []
+        self.index = RelayIndex([])
+        self.generation = 0
+        self._store_stamp = None
         self.last_update = None
+        self.last_checked = None             # Last time the directory was asked for changes
+        self.last_modified = None            # Directory's Last-Modified, sent back as If-Modified-Since
+        self.relays_published = None
         logger.info("TOR Database initialized")
     
-    def fetch_tor_nodes(self):
+    def download_nodes(self, if_modified_since=None):
         """
-        Fetch current TOR relay list from official directory
+        Download the relay list from the official directory. Returns the
+        processed nodes, or None if the directory answered 304 Not Modified
+        to if_modified_since (a Last-Modified value from an earlier download).
+        Sets self.last_modified and self.relays_published from the response.
         """
         logger.info(f"Fetching TOR nodes from {TOR_DIRECTORY_URL}")
+        headers = {'If-Modified-Since': if_modified_since} if if_modified_since else {}
         
-        try:
-            response = requests.get(TOR_DIRECTORY_URL, timeout=30)
+        # Streamed: relays are parsed one at a time, the payload is never held whole
+        with requests.get(TOR_DIRECTORY_URL, headers=headers, timeout=30, stream=True) as response:
+            if response.status_code == 304:
+                logger.info(f"TOR directory unchanged since {if_modified_since}")
+                return None
             response.raise_for_status()
             
-            data = response.json()
-            relays = data.get('relays', [])
-            
-            logger.info(f"Successfully fetched {len(relays)} TOR relays")
-            
-            # Process each relay
-            processed_nodes = []
-            for relay in relays:
-                node = {
-                    'fingerprint': relay.get('fingerprint'),
-                    'nickname': relay.get('nickname'),
-                    'ip_address': relay.get('or_addresses', [''])[0].split(':')[0] if relay.get('or_addresses') else '',
-                    'or_port': relay.get('or_addresses', [''])[0].split(':')[1] if relay.get('or_addresses') and ':' in relay.get('or_addresses', [''])[0] else None,
-                    'country': relay.get('country'),
-                    'country_name': relay.get('country_name'),
-                    'as_number': relay.get('as_number'),
-                    'as_name': relay.get('as_name'),
-                    'bandwidth': relay.get('observed_bandwidth', 0),
-                    'flags': relay.get('flags', []),
-                    'first_seen': relay.get('first_seen'),
-                    'last_seen': relay.get('last_seen'),
-                    'running': relay.get('running', False),
-                    'is_guard': 'Guard' in relay.get('flags', []),
-                    'is_exit': 'Exit' in relay.get('flags', []),
-                    'is_fast': 'Fast' in relay.get('flags', []),
-                    'is_stable': 'Stable' in relay.get('flags', [])
-                }
-                processed_nodes.append(node)
+            stream = OnionooStream(response.iter_content(CHUNK_SIZE))
+            nodes = [self._node_from_relay(relay) for relay in stream]
+        self.last_modified = response.headers.get('Last-Modified')
+        self.relays_published = stream.meta.get('relays_published')
+        
+        logger.info(f"Successfully fetched {len(nodes)} TOR relays (published {self.relays_published})")
+        return nodes
+    
+    @staticmethod
+    def _node_from_relay(relay):
+        """Node dict for one onionoo details relay"""
+        or_addresses = [list(split_address(address)) for address in relay.get('or_addresses', [])]
+        or_addresses = [address for address in or_addresses if address[0]]
+        return {
+            'fingerprint': relay.get('fingerprint'),
+            'nickname': relay.get('nickname'),
+            'ip_address': or_addresses[0][0] if or_addresses else '',
+            'or_port': or_addresses[0][1] if or_addresses else None,
+            'or_addresses': or_addresses,
+            'exit_addresses': [ip for ip in map(canonical_ip, relay.get('exit_addresses', [])) if ip],
+            'country': relay.get('country'),
+            'country_name': relay.get('country_name'),
+            'lat': relay.get('latitude'),
+            'lon': relay.get('longitude'),
+            'as_number': relay.get('as_number'),
+            'as_name': relay.get('as_name'),
+            'family': family_id(relay),
+            'bandwidth': relay.get('observed_bandwidth', 0),
+            'flags': relay.get('flags', []),
+            'first_seen': relay.get('first_seen'),
+            'last_seen': relay.get('last_seen'),
+            'running': relay.get('running', False),
+            'is_guard': 'Guard' in relay.get('flags', []),
+            'is_exit': 'Exit' in relay.get('flags', []),
+            'is_fast': 'Fast' in relay.get('flags', []),
+            'is_stable': 'Stable' in relay.get('flags', [])
+        }
+    
+    def fetch_tor_nodes(self):
+        """
+        Fetch current TOR relay list from official directory
+        """
+        try:
+            processed_nodes = self.download_nodes()
             
-            self.nodes = processed_nodes
+            self.locate_nodes(processed_nodes)
+            self.publish(RelayIndex(processed_nodes))
             self.last_update = datetime.now().isoformat()
+            self.last_checked = self.last_update
             
             return processed_nodes
             
@@ -119,6 +181,209 @@ class TORDatabase:
             logger.error(f"Error processing TOR nodes: {e}")
             return []
     
+    def bootstrap_from_files(self, relays_file=RELAY_BOOTSTRAP_FILE, exits_file=EXIT_BOOTSTRAP_FILE):
+        """
+        Build the node list from the bundled onionoo summary and exit IP list,
+        without network access. The summary has no flags or ports, so relays
+        are marked running/exit only; the next online refresh fills them in.
+        """
+        exit_ips = set()
+        if os.path.exists(exits_file):
+            with open(exits_file, 'r') as f:
+                exit_ips = {canonical_ip(line.strip()) for line in f if line.strip() and not line.startswith('#')}
+            exit_ips.discard(None)
+        
+        nodes = []
+        with open(relays_file, 'rb') as f:
+            summary = OnionooStream.from_file(f)
+            for relay in summary:
+                addresses = [ip for ip in map(canonical_ip, relay.get('a') or []) if ip]
+                is_exit = any(ip in exit_ips for ip in addresses)
+                flags = (['Running'] if relay.get('r') else []) + (['Exit'] if is_exit else [])
+                nodes.append(self._bootstrap_node(relay.get('f'), relay.get('n'), addresses, relay.get('r', False), flags))
+        
+        # Exits often leave from an address other than their OR addresses
+        known_ips = {ip for node in nodes for ip, _ in node['or_addresses']}
+        for ip in sorted(exit_ips - known_ips):
+            node = self._bootstrap_node(None, None, [ip], True, ['Running', 'Exit'])
+            node['exit_addresses'] = [ip]
+            nodes.append(node)
+        
+        self.locate_nodes(nodes)
+        self.publish(RelayIndex(nodes))
+        self.last_update = datetime.now().isoformat()
+        self.relays_published = summary.meta.get('relays_published')
+        logger.info(f"Bootstrapped {len(nodes)} nodes from {relays_file} and {exits_file} "
+                    f"(published {self.relays_published})")
+        return nodes
+    
+    @staticmethod
+    def _bootstrap_node(fingerprint, nickname, addresses, running, flags):
+        return {
+            'fingerprint': fingerprint,
+            'nickname': nickname,
+            'ip_address': addresses[0] if addresses else '',
+            'or_port': None,
+            'or_addresses': [[ip, None] for ip in addresses],
+            'exit_addresses': [],
+            'country': None,
+            'country_name': None,
+            'lat': None,
+            'lon': None,
+            'as_number': None,
+            'as_name': None,
+            'family': fingerprint,
+            'bandwidth': 0,
+            'flags': flags,
+            'first_seen': None,
+            'last_seen': None,
+            'running': running,
+            'is_guard': False,
+            'is_exit': 'Exit' in flags,
+            'is_fast': False,
+            'is_stable': False
+        }
+    
+    def refresh(self, force=False):
+        """
+        Bring DATABASE_FILE up to date without downloading more than needed:
+        
+        - with no database yet, bootstrap it from the bundled files first
+        - skip the directory entirely within DATABASE_UPDATE_INTERVAL of the
+          last check (unless force), answering from the mapped relay store
+          without parsing the JSON database
+        - send If-Modified-Since and stop on 304 or an unchanged relays_published
+        - otherwise apply only the added, removed and changed relays to the index
+        
+        Returns True if the node list changed.
+        """
+        changed = False
+        loaded = self.load_from_file()
+        if loaded and isinstance(self.index, RelayStore):
+            if not force and self._checked_recently():
+                return changed
+            # Applying a diff needs the full, mutable node list
+            loaded = self.load_from_file(DATABASE_FILE)
+        if not loaded:
+            try:
+                self.bootstrap_from_files()
+                self.save_to_file()
+                self.record_snapshot()
+                changed = True
+            except (OSError, ValueError) as e:
+                logger.warning(f"Offline bootstrap failed: {e}")
+        
+        if not force and self._checked_recently():
+            return changed
+        
+        previous_published = self.relays_published
+        try:
+            nodes = self.download_nodes(self.last_modified if self.nodes else None)
+        except Exception as e:
+            logger.error(f"Failed to fetch TOR nodes, keeping {len(self.nodes)} known nodes: {e}")
+            return changed
+        self.last_checked = datetime.now().isoformat()
+        
+        if nodes is None or (self.nodes and self.relays_published == previous_published):
+            logger.info(f"TOR relay list unchanged (published {self.relays_published})")
+        else:
+            added, removed, updated = self.apply_nodes(nodes)
+            logger.info(f"Applied relay diff: {added} added, {removed} removed, {updated} changed")
+            changed = changed or bool(added or removed or updated)
+        self.save_to_file()
+        if nodes is not None and self.relays_published != previous_published:
+            self.record_snapshot()
+        return changed
+    
+    def _checked_recently(self):
+        """True (and say so) if the directory was asked within DATABASE_UPDATE_INTERVAL"""
+        if not self.last_checked:
+            return False
+        age = (datetime.now() - datetime.fromisoformat(self.last_checked)).total_seconds()
+        if age >= DATABASE_UPDATE_INTERVAL:
+            return False
+        logger.info(f"TOR database checked {age / 60:.0f} min ago, next check in "
+                    f"{(DATABASE_UPDATE_INTERVAL - age) / 60:.0f} min")
+        return True
+    
+    def record_snapshot(self):
+        """Keep the current node list as the version published at relays_published"""
+        try:
+            return RelayHistory().add_snapshot(self.nodes, self.relays_published, self.last_update)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to record relay snapshot: {e}")
+            return False
+    
+    def apply_nodes(self, nodes):
+        """
+        Replace the node list with `nodes` by diffing on fingerprint. The diff
+        is applied to a copy of the index, and updated relays get new node
+        dicts, so readers keep a consistent view until the copy is published.
+        Only relays whose indexed fields changed are re-indexed; the rest
+        just have their dict replaced. Returns (added, removed, changed)
+        counts, changed counting the re-indexed relays.
+        """
+        # A mapped RelayStore is read-only, so it is converted instead
+        index = self.index.copy() if isinstance(self.index, RelayIndex) else RelayIndex(list(self.nodes))
+        current = {node['fingerprint']: node for node in self.nodes if node.get('fingerprint')}
+        incoming = {node['fingerprint']: node for node in nodes if node.get('fingerprint')}
+        
+        # Synthetic bootstrap nodes have no fingerprint and are replaced by the full list
+        removed = [node for node in self.nodes if node.get('fingerprint') not in incoming]
+        added = []
+        refreshed = []
+        changed = 0
+        for fingerprint, node in incoming.items():
+            old = current.get(fingerprint)
+            if old is None:
+                added.append(node)
+                continue
+            if node.get('lat') is None and old.get('lat') is not None:
+                node.update(lat=old['lat'], lon=old['lon'], country_name=node.get('country_name') or old.get('country_name'))
+            # Never modify a node the published index hands out
+            node = dict(old, **node)
+            if any(old.get(field) != node.get(field) for field in INDEXED_FIELDS):
+                removed.append(old)
+                added.append(node)
+                changed += 1
+            elif node != old:
+                refreshed.append((old, node))
+        
+        missing = [node for node in added if node.get('lat') is None]
+        if missing:
+            self.locate_nodes(missing)
+        index.update(removed, added)
+        index.replace(refreshed)
+        self.publish(index)
+        self.last_update = datetime.now().isoformat()
+        return len(added) - changed, len(removed) - changed, changed
+    
+    def publish(self, index):
+        """
+        Make a fully built index (RelayIndex or RelayStore) the one lookups
+        use. Rebinding the attribute is atomic, so this never blocks readers.
+        """
+        self.index = index
+        self.nodes = index.nodes
+        self.generation += 1
+    
+    def reload(self):
+        """
+        Map RELAY_STORE_FILE again if fetch_nodes.py has replaced it since it
+        was mapped, and publish it. Meant to be polled by long-running
+        detectors; costs a stat() when nothing changed. Returns True if swapped.
+        """
+        try:
+            stat = os.stat(RELAY_STORE_FILE)
+        except OSError:
+            return False
+        if (stat.st_ino, stat.st_mtime_ns) == self._store_stamp:
+            return False
+        if not self.load_from_file():
+            return False
+        logger.info(f"Swapped in relay index generation {self.generation} ({len(self.nodes)} nodes)")
+        return True
+    
     def save_to_file(self, filename=None):
         """
         Save TOR nodes to JSON file
@@ -130,6 +395,9 @@ class TORDatabase:
         
         data = {
             'last_update': self.last_update,
+            'last_checked': self.last_checked,
+            'last_modified': self.last_modified,
+            'relays_published': self.relays_published,
             'total_nodes': len(self.nodes),
             'nodes': self.nodes
         }
@@ -139,6 +407,13 @@ class TORDatabase:
                 json.dump(data, f, indent=2)
             
             logger.info(f"Saved {len(self.nodes)} nodes to {filename}")
+            
+            # Binary copy every other process attaches to: mmap'd and shared through
+            # the page cache, no JSON parsing and no per-process index
+            if filename == DATABASE_FILE:
+                write_relay_store(self.nodes, RELAY_STORE_FILE, self.last_update,
+                                  meta={field: data[field] for field in STORE_META_FIELDS})
+                logger.info(f"Saved relay store to {RELAY_STORE_FILE}")
             return True
             
         except Exception as e:
@@ -147,16 +422,35 @@ class TORDatabase:
     
     def load_from_file(self, filename=None):
         """
-        Load TOR nodes from JSON file
+        Load TOR nodes from JSON file, or map the binary relay store
+        instead when no filename is given and the store is up to date
         """
+        if filename is None and store_is_current(DATABASE_FILE, RELAY_STORE_FILE):
+            try:
+                store = RelayStore(RELAY_STORE_FILE)
+                # The store previously published is left to be unmapped when its
+                # last reader lets go of it
+                self.publish(store)
+                self._store_stamp = store.stamp
+                self.last_update = store.last_update
+                for field in STORE_META_FIELDS:
+                    setattr(self, field, store.meta.get(field))
+                logger.info(f"Mapped {len(store.nodes)} nodes from {RELAY_STORE_FILE}")
+                return True
+            except (OSError, ValueError) as e:
+                logger.warning(f"Relay store unusable, reading {DATABASE_FILE}: {e}")
+        
         filename = filename or DATABASE_FILE
         
         try:
             with open(filename, 'r') as f:
                 data = json.load(f)
             
-            self.nodes = data.get('nodes', [])
+            self.publish(RelayIndex(data.get('nodes', [])))
             self.last_update = data.get('last_update')
+            self.last_checked = data.get('last_checked')
+            self.last_modified = data.get('last_modified')
+            self.relays_published = data.get('relays_published')
             
             logger.info(f"Loaded {len(self.nodes)} nodes from {filename}")
             return True
@@ -168,43 +462,52 @@ class TORDatabase:
             logger.error(f"Failed to load database: {e}")
             return False
     
+    def locate_nodes(self, nodes=None):
+        """
+        Fill lat/lon for relays onionoo has no location for, in one pass over
+        the local GeoLite2 database, so detection never has to look relays up
+        """
+        missing = [node for node in (self.nodes if nodes is None else nodes)
+                   if node['ip_address'] and node.get('lat') is None]
+        if not missing:
+            return 0
+        locations = get_geolocation_service().lookup_many([node['ip_address'] for node in missing], remote=False)
+        located = 0
+        for node in missing:
+            location = locations.get(node['ip_address'])
+            if location and location['lat'] is not None:
+                node['lat'] = location['lat']
+                node['lon'] = location['lon']
+                node['country_name'] = node.get('country_name') or location['country']
+                located += 1
+        logger.info(f"Located {located} of {len(missing)} relays without onionoo coordinates")
+        return located
+    
     def get_node_by_ip(self, ip_address):
         """
         Check if IP address is a TOR node
         """
-        for node in self.nodes:
-            if node['ip_address'] == ip_address:
-                return node
-        return None
+        return self.index.node_by_ip(ip_address)
+    
+    def get_node_by_endpoint(self, ip_address, port):
+        """Get the relay listening on ip_address:port"""
+        return self.index.node_by_endpoint(ip_address, port)
+    
+    def get_node_by_fingerprint(self, fingerprint):
+        """Get a relay by its fingerprint"""
+        return self.index.node_by_fingerprint(fingerprint)
     
     def get_guard_nodes(self):
         """Get all guard (entry) nodes"""
-        return [node for node in self.nodes if node['is_guard']]
+        return self.index.guard_nodes
     
     def get_exit_nodes(self):
         """Get all exit nodes"""
-        return [node for node in self.nodes if node['is_exit']]
+        return self.index.exit_nodes
     
     def get_statistics(self):
         """Get database statistics"""
-        total = len(self.nodes)
-        running = sum(1 for node in self.nodes if node['running'])
-        guards = sum(1 for node in self.nodes if node['is_guard'])
-        exits = sum(1 for node in self.nodes if node['is_exit'])
-        
-        countries = {}
-        for node in self.nodes:
-            country = node.get('country', 'Unknown')
-            countries[country] = countries.get(country, 0) + 1
-        
-        return {
-            'total_nodes': total,
-            'running_nodes': running,
-            'guard_nodes': guards,
-            'exit_nodes': exits,
-            'countries': len(countries),
-            'top_countries': sorted(countries.items(), key=lambda x: x[1], reverse=True)[:10]
-        }
+        return self.index.statistics
 
 
 def main():
@@ -217,16 +520,13 @@ def main():
     # Create database instance
     db = TORDatabase()
     
-    print("\nFetching TOR nodes from directory...")
-    nodes = db.fetch_tor_nodes()
+    print("\nRefreshing TOR nodes from directory...")
+    changed = db.refresh(force='--force' in sys.argv)
+    nodes = db.nodes
     
     if nodes:
-        print(f"✓ Successfully fetched {len(nodes)} TOR nodes")
-        
-        # Save to file
-        print(f"\nSaving to {DATABASE_FILE}...")
-        db.save_to_file()
-        print("✓ Database saved")
+        print(f"✓ {len(nodes)} TOR nodes in {DATABASE_FILE} ({'updated' if changed else 'unchanged'}, "
+              f"published {db.relays_published})")
         
         # Show statistics
         stats = db.get_statistics()
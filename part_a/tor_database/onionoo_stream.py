@@ -0,0 +1,119 @@
+"""
+A2: Streaming Onionoo Parser
+Reads an onionoo document (details from the directory, or the bundled
+summary in tor_relays.txt) chunk by chunk and yields one relay at a time,
+so memory stays bounded by a single relay record instead of the whole payload
+"""
+
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_NUMBER = '0123456789.eE+-'
+
+
+class OnionooStream:
+    """
+    Iterates over the objects of one top-level array ("relays" by default).
+    Other top-level arrays (e.g. "bridges") are skipped element by element;
+    top-level scalars such as relays_published are collected in `meta` as
+    they go past, so everything that precedes the array is available once
+    the first relay is yielded, and all of it after iteration ends.
+
+        stream = OnionooStream(response.iter_content(CHUNK_SIZE))
+        for relay in stream:
+            ...
+        stream.meta['relays_published']
+    """
+
+    def __init__(self, chunks, key='relays'):
+        self.chunks = iter(chunks)
+        self.key = key
+        self.meta = {}
+        self.relays = 0
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    @classmethod
+    def from_file(cls, f, key='relays', chunk_size=CHUNK_SIZE):
+        return cls(iter(lambda: f.read(chunk_size), type(f.read(0))()), key)
+
+    def _fill(self):
+        """Append the next chunk to the buffer; False at end of input"""
+        if self._eof:
+            return False
+        if self._pos > CHUNK_SIZE:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self._eof = True
+            self._buffer += self._utf8.decode(b'', final=True)
+            return False
+        self._buffer += self._utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        return True
+
+    def _peek(self):
+        """Next non-whitespace character, or '' at end of input"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars or not char:
+            raise ValueError(f"Malformed onionoo document: expected {chars!r} at offset {self._pos}, got {char!r}")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Decode the next JSON value, reading more input until it is complete"""
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number may continue in the next chunk, so it needs a delimiter after it
+            if (end < len(self._buffer) and self._buffer[end] not in _NUMBER) or not self._fill():
+                self._pos = end
+                return value
+
+    def _array(self, wanted):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            value = self._value()
+            if wanted:
+                yield value
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if self._peek() == '[':
+                for relay in self._array(key == self.key):
+                    self.relays += 1
+                    yield relay
+            else:
+                self.meta[key] = self._value()
+            if self._expect(',}') == '}':
+                return
@@ -0,0 +1,246 @@
+"""
+A2: Relay Prefix Trie
+Longest-prefix matching over the networks relays are hosted in and over
+analyst watchlist CIDRs. A match carries the prefix, AS and relay family,
+so detections can be labelled as they are built instead of joined later
+"""
+
+import ipaddress
+import logging
+import os
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import RELAY_PREFIX_V4, RELAY_PREFIX_V6, WATCHLIST_FILE, PREFIX_CACHE_SIZE
+from part_a.tor_database.relay_index import V4_MAPPED, ip_key, node_addresses
+
+logger = logging.getLogger(__name__)
+
+BITS = 128
+
+
+def network_key(network):
+    """(128-bit key, prefix length) for an ip_network, IPv4 mapped into IPv6 like ip_key()"""
+    if network.version == 4:
+        return V4_MAPPED | int(network.network_address), network.prefixlen + 96
+    return int(network.network_address), network.prefixlen
+
+
+def read_watchlist(filename):
+    """
+    (ip_network, label) for each CIDR in filename, one per line with an
+    optional label after it ("203.0.113.0/24 bulletproof-hoster"); '#'
+    starts a comment. The label defaults to the CIDR itself.
+    """
+    with open(filename, 'r') as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split(None, 1)
+            if not fields:
+                continue
+            try:
+                network = ipaddress.ip_network(fields[0], strict=False)
+            except ValueError:
+                logger.warning(f"{filename}:{number}: not a CIDR: {fields[0]}")
+                continue
+            yield network, fields[1].strip() if len(fields) > 1 else str(network)
+
+
+def _mask(key, length):
+    return key >> (BITS - length) << (BITS - length) if length else 0
+
+
+class _Node:
+    __slots__ = ('key', 'length', 'value', 'children')
+
+    def __init__(self, key, length, value=None):
+        self.key = key
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+
+
+class PrefixTrie:
+    """
+    Path-compressed binary trie keyed by 128-bit addresses. Only nodes that
+    hold a prefix or where prefixes branch exist, so a lookup visits at most
+    one node per stored prefix length on the address's path.
+    """
+
+    def __init__(self):
+        self.root = _Node(0, 0)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, key, length, value):
+        """Store value for key/length, replacing any value already stored there"""
+        key = _mask(key, length)
+        node = self.root
+        while True:
+            if node.length == length:
+                if node.value is None:
+                    self.size += 1
+                node.value = value
+                return
+            bit = (key >> (BITS - 1 - node.length)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _Node(key, length, value)
+                self.size += 1
+                return
+            limit = min(child.length, length)
+            diff = (child.key ^ key).bit_length()
+            common = min(BITS - diff, limit) if diff else limit
+            if common == child.length:
+                node = child
+                continue
+            split = _Node(key if common == length else _mask(key, common), common,
+                          value if common == length else None)
+            split.children[(child.key >> (BITS - 1 - common)) & 1] = child
+            if common != length:
+                split.children[(key >> (BITS - 1 - common)) & 1] = _Node(key, length, value)
+            node.children[bit] = split
+            self.size += 1
+            return
+
+    def matches(self, key):
+        """Values of every stored prefix containing key, least specific first"""
+        found = []
+        node = self.root
+        while node is not None:
+            if node.length and (key ^ node.key) >> (BITS - node.length):
+                break
+            if node.value is not None:
+                found.append(node.value)
+            if node.length == BITS:
+                break
+            node = node.children[(key >> (BITS - 1 - node.length)) & 1]
+        return found
+
+    def lookup(self, key):
+        """Value of the longest stored prefix containing key, or None"""
+        found = self.matches(key)
+        return found[-1] if found else None
+
+
+class RelayPrefixes:
+    """
+    One trie over three kinds of prefix: every relay address (/32, /128),
+    the hosting prefix around it (RELAY_PREFIX_V4 / RELAY_PREFIX_V6) and the
+    watchlist CIDRs. match(ip) merges what the prefixes on the path say:
+    the most specific prefix, AS and family win, watchlist labels add up.
+
+    Results are cached per address, so at packet rate a repeat address
+    costs one dict lookup.
+    """
+
+    def __init__(self, nodes=(), watchlist_file=WATCHLIST_FILE, cache_size=PREFIX_CACHE_SIZE):
+        self.trie = PrefixTrie()
+        self.cache_size = cache_size
+        self.cache = {}
+        self.watchlist = 0
+        self.add_relays(nodes)
+        if watchlist_file and os.path.exists(watchlist_file):
+            self.load_watchlist(watchlist_file)
+
+    def __reduce__(self):
+        # Shard workers rebuild nothing: the trie pickles with the object,
+        # only the per-address cache is left behind
+        return (_restore, (self.trie, self.cache_size, self.watchlist))
+
+    def add_relays(self, nodes):
+        hosting = {}
+        for node in nodes:
+            entry = {'as_number': node.get('as_number'), 'as_name': node.get('as_name'),
+                     'family': node.get('family') or node.get('fingerprint')}
+            for ip, _ in node_addresses(node):
+                try:
+                    address = ipaddress.ip_address(ip)
+                except ValueError:
+                    continue
+                self._add(ipaddress.ip_network(address), dict(entry, relay=True))
+                length = RELAY_PREFIX_V4 if address.version == 4 else RELAY_PREFIX_V6
+                hosting.setdefault(ipaddress.ip_network(f"{address}/{length}", strict=False), []).append(node)
+
+        for network, relays in hosting.items():
+            as_numbers = Counter(node.get('as_number') for node in relays if node.get('as_number'))
+            as_number = as_numbers.most_common(1)[0][0] if as_numbers else None
+            as_name = next((node.get('as_name') for node in relays if node.get('as_number') == as_number), None)
+            families = sorted({node.get('family') or node.get('fingerprint') for node in relays} - {None})
+            self._add(network, {'as_number': as_number, 'as_name': as_name,
+                                'family': families[0] if len(families) == 1 else None,
+                                'families': families, 'relays': len(relays)})
+        self.cache.clear()
+        logger.info(f"Prefix trie holds {len(self.trie)} prefixes ({len(hosting)} hosting prefixes)")
+
+    def load_watchlist(self, filename):
+        """Add the CIDRs of a watchlist file (see read_watchlist())"""
+        added = 0
+        for network, label in read_watchlist(filename):
+            self.add_watch(network, label)
+            added += 1
+        logger.info(f"Loaded {added} watchlist prefixes from {filename}")
+        return added
+
+    def add_watch(self, network, label):
+        if isinstance(network, str):
+            network = ipaddress.ip_network(network, strict=False)
+        self._add(network, {'watchlist': [label]})
+        self.watchlist += 1
+        self.cache.clear()
+
+    def _add(self, network, entry):
+        key, length = network_key(network)
+        entry['prefix'] = str(network)
+        existing = next((found for found in self.trie.matches(key) if found['prefix'] == entry['prefix']), None)
+        if existing is not None:
+            # Same prefix from another source: keep both sides' fields
+            watchlist = existing.get('watchlist', []) + entry.pop('watchlist', [])
+            existing.update(entry)
+            if watchlist:
+                existing['watchlist'] = watchlist
+            return
+        self.trie.insert(key, length, entry)
+
+    def match(self, ip):
+        """
+        Labels for ip: {'prefix', 'as_number', 'as_name', 'family', 'relay',
+        'watchlist'}, or None if no prefix contains it
+        """
+        key = ip_key(ip)
+        if key is None:
+            return None
+        result = self.cache.get(key, False)
+        if result is not False:
+            return result
+
+        result = None
+        for entry in self.trie.matches(key):
+            if result is None:
+                result = {'prefix': None, 'as_number': None, 'as_name': None, 'family': None,
+                          'relay': False, 'watchlist': []}
+            for field in ('prefix', 'as_number', 'as_name', 'family'):
+                if entry.get(field) is not None or field == 'prefix':
+                    result[field] = entry.get(field)
+            result['relay'] = result['relay'] or entry.get('relay', False)
+            result['watchlist'] = result['watchlist'] + entry.get('watchlist', [])
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = result
+        return result
+
+    def watched(self, ip):
+        """Watchlist labels covering ip (empty if none)"""
+        result = self.match(ip)
+        return result['watchlist'] if result else []
+
+
+def _restore(trie, cache_size, watchlist):
+    prefixes = RelayPrefixes.__new__(RelayPrefixes)
+    prefixes.trie = trie
+    prefixes.cache_size = cache_size
+    prefixes.cache = {}
+    prefixes.watchlist = watchlist
+    return prefixes
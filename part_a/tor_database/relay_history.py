@@ -0,0 +1,201 @@
+"""
+A2: Relay History
+Versioned snapshots of the TOR node database, one binary relay store per
+consensus, plus an interval index of when each IP was a running relay,
+guard or exit, so archived captures can be matched against the consensus
+that was in force when each packet was seen
+"""
+
+import bisect
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import HISTORY_DIR, HISTORY_RETENTION_DAYS, HISTORY_OPEN_SNAPSHOTS
+from part_a.tor_database.relay_index import node_addresses, canonical_ip
+from part_a.tor_database.relay_store import RelayStore, write_relay_store
+
+logger = logging.getLogger(__name__)
+
+ROLES = ('running', 'guard', 'exit')
+INTERVALS_FILE = "intervals.json"
+
+
+def node_roles(node):
+    """Roles of a node dict in its consensus"""
+    if not node.get('running'):
+        return ()
+    return ('running',) + (('guard',) if node.get('is_guard') else ()) + (('exit',) if node.get('is_exit') else ())
+
+
+def published_timestamp(relays_published):
+    """Epoch seconds for onionoo's relays_published ("YYYY-MM-DD hh:mm:ss", UTC)"""
+    if not relays_published:
+        return int(time.time())
+    return int(datetime.strptime(relays_published, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+
+
+class RelayHistory:
+    """
+    Snapshots live in `directory` as <published epoch>.bin relay stores and
+    are only mapped when a node record is asked for (at most
+    HISTORY_OPEN_SNAPSHOTS at a time). Role questions are answered from the
+    interval index alone: per role and IP, sorted [start, end) intervals
+    where end is None while the IP still holds the role.
+
+    A time before the first snapshot is answered with the first snapshot,
+    the closest consensus known.
+    """
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self.intervals = {role: {} for role in ROLES}    # role -> ip -> [[start, end], ...]
+        self.published = []                              # snapshot times, ascending
+        self._starts = {}
+        self._open = OrderedDict()
+        self.load()
+
+    def load(self):
+        path = os.path.join(self.directory, INTERVALS_FILE)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.intervals = {role: data.get('intervals', {}).get(role, {}) for role in ROLES}
+        self.published = sorted(int(os.path.basename(name)[:-4])
+                                for name in glob.glob(os.path.join(self.directory, '*.bin')))
+        self._starts = {}
+        return len(self.published)
+
+    def __getstate__(self):
+        # Shard workers map the snapshots they need themselves
+        state = self.__dict__.copy()
+        state['_open'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.published)
+
+    def add_snapshot(self, nodes, relays_published=None, last_update=None):
+        """
+        Record the consensus published at relays_published: write its store
+        and open/close intervals for every IP whose roles changed. Snapshots
+        not newer than the latest one are ignored. Returns True if recorded.
+        """
+        published = published_timestamp(relays_published)
+        if self.published and published <= self.published[-1]:
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+        write_relay_store(nodes, self._snapshot_file(published), last_update)
+
+        current = {role: set() for role in ROLES}
+        for node in nodes:
+            addresses = [ip for ip, _ in node_addresses(node)]
+            for role in node_roles(node):
+                current[role].update(addresses)
+        for role in ROLES:
+            intervals = self.intervals[role]
+            for ip, spans in intervals.items():
+                if spans[-1][1] is None and ip not in current[role]:
+                    spans[-1][1] = published
+            for ip in current[role]:
+                spans = intervals.setdefault(ip, [])
+                if not spans or spans[-1][1] is not None:
+                    spans.append([published, None])
+
+        self.published.append(published)
+        self.prune(published - HISTORY_RETENTION_DAYS * 86400)
+        self._save()
+        logger.info(f"Recorded relay snapshot {relays_published} ({len(nodes)} nodes, {len(self.published)} kept)")
+        return True
+
+    def prune(self, before):
+        """Drop snapshots and closed intervals that ended before `before` (epoch seconds)"""
+        # Keep the snapshot still in force at `before`
+        keep_from = max(0, bisect.bisect_right(self.published, before) - 1)
+        for published in self.published[:keep_from]:
+            try:
+                os.remove(self._snapshot_file(published))
+            except OSError:
+                pass
+        self.published = self.published[keep_from:]
+        for intervals in self.intervals.values():
+            for ip in list(intervals):
+                intervals[ip] = [span for span in intervals[ip] if span[1] is None or span[1] > before]
+                if not intervals[ip]:
+                    del intervals[ip]
+        self._starts = {}
+
+    def _save(self):
+        path = os.path.join(self.directory, INTERVALS_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({'intervals': self.intervals}, f)
+        os.replace(path + ".tmp", path)
+
+    def _snapshot_file(self, published):
+        return os.path.join(self.directory, f"{published}.bin")
+
+    def _clamp(self, timestamp):
+        if self.published and timestamp < self.published[0]:
+            return self.published[0]
+        return timestamp
+
+    def has_role(self, ip, role, timestamp):
+        """Whether ip held role ('running', 'guard' or 'exit') at timestamp, in O(log n)"""
+        spans = self.intervals[role].get(ip)
+        if spans is None and ':' in ip:
+            # Captured IPv6 text may not be in the canonical form the index uses
+            ip = canonical_ip(ip)
+            spans = self.intervals[role].get(ip)
+        if not spans:
+            return False
+        starts = self._starts.get((role, ip))
+        if starts is None:
+            starts = self._starts[(role, ip)] = [span[0] for span in spans]
+        timestamp = self._clamp(timestamp)
+        i = bisect.bisect_right(starts, timestamp) - 1
+        return i >= 0 and (spans[i][1] is None or timestamp < spans[i][1])
+
+    def was_running(self, ip, timestamp):
+        return self.has_role(ip, 'running', timestamp)
+
+    def was_guard(self, ip, timestamp):
+        return self.has_role(ip, 'guard', timestamp)
+
+    def was_exit(self, ip, timestamp):
+        return self.has_role(ip, 'exit', timestamp)
+
+    def in_force(self, timestamp):
+        """Publication time of the consensus in force at timestamp, or None without history"""
+        if not self.published:
+            return None
+        i = bisect.bisect_right(self.published, self._clamp(timestamp)) - 1
+        return self.published[i]
+
+    def snapshot_at(self, timestamp):
+        """RelayStore of the consensus in force at timestamp, mapped on demand"""
+        published = self.in_force(timestamp)
+        if published is None:
+            return None
+        store = self._open.get(published)
+        if store is None:
+            store = self._open[published] = RelayStore(self._snapshot_file(published))
+            while len(self._open) > HISTORY_OPEN_SNAPSHOTS:
+                self._open.popitem(last=False)[1].close()
+        self._open.move_to_end(published)
+        return store
+
+    def node_at(self, ip, timestamp):
+        """Node record for ip in the consensus in force at timestamp, or None"""
+        store = self.snapshot_at(timestamp)
+        return store.get(ip) if store is not None else None
+
+    def close(self):
+        while self._open:
+            self._open.popitem()[1].close()
@@ -0,0 +1,358 @@
+"""
+A2: Relay Index
+Hash indexes over the TOR node list so classifying a packet costs a few
+dict lookups however many relays the consensus has. Every OR and exit
+address of a relay is indexed, IPv4 and IPv6 alike, keyed by the address
+as an integer (IPv4 mapped into the IPv6 space)
+"""
+
+import functools
+import socket
+from collections.abc import Mapping
+
+V4_MAPPED = 0xFFFF << 32
+
+
+@functools.lru_cache(maxsize=65536)
+def _key_of(ip):
+    try:
+        if ':' in ip:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip.strip('[]')), 'big')
+        return V4_MAPPED | int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        return None
+
+
+def ip_key(ip):
+    """128-bit integer for an IPv4/IPv6 address string (ints pass through), None if invalid"""
+    if isinstance(ip, int):
+        return ip
+    if not ip:
+        return None
+    # Cached: captured traffic repeats the same few addresses, so this costs one
+    # hash lookup per packet for IPv4 and IPv6 alike
+    return _key_of(ip)
+
+
+def ip_from_key(key):
+    """Address string for an ip_key() integer"""
+    if key >> 32 == 0xFFFF:
+        return socket.inet_ntop(socket.AF_INET, (key & 0xFFFFFFFF).to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, key.to_bytes(16, 'big'))
+
+
+def canonical_ip(ip):
+    """Normalised address string ('[2001:DB8::1]' -> '2001:db8::1'), or None if invalid"""
+    key = ip_key(ip)
+    return ip_from_key(key) if key is not None else None
+
+
+def split_address(address):
+    """(canonical ip, port string or None) for onionoo's "1.2.3.4:9001" / "[2001:db8::1]:443" """
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        port = port.lstrip(':')
+    elif address.count(':') == 1:
+        host, port = address.split(':')
+    else:
+        host, port = address, ''
+    return canonical_ip(host), port or None
+
+
+def node_addresses(node):
+    """
+    Every (ip, port) a relay is known by: its OR addresses, then exit
+    addresses with port None. Nodes without address lists (older
+    databases) fall back to ip_address/or_port.
+    """
+    addresses = [tuple(address) for address in node.get('or_addresses') or ()]
+    if not addresses and node.get('ip_address'):
+        addresses.append((node['ip_address'], node.get('or_port')))
+    seen = {ip for ip, _ in addresses}
+    for ip in node.get('exit_addresses') or ():
+        if ip not in seen:
+            seen.add(ip)
+            addresses.append((ip, None))
+    return addresses
+
+
+def _port(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _keys(node):
+    """(ip key, port) for each valid address of node"""
+    keys = []
+    for ip, port in node_addresses(node):
+        key = ip_key(ip)
+        if key is not None:
+            keys.append((key, _port(port)))
+    return keys
+
+
+def _top_countries(countries):
+    # Ties broken by name, so an index kept current with update() agrees with a rebuild
+    return sorted(countries.items(), key=lambda x: (-x[1], str(x[0])))[:10]
+
+
+def node_statistics(nodes):
+    """Summary counts for a node list (RelayIndex.statistics)"""
+    countries = {}
+    for node in nodes:
+        country = node.get('country', 'Unknown')
+        countries[country] = countries.get(country, 0) + 1
+
+    return {
+        'total_nodes': len(nodes),
+        'running_nodes': sum(1 for node in nodes if node.get('running')),
+        'guard_nodes': sum(1 for node in nodes if node.get('is_guard')),
+        'exit_nodes': sum(1 for node in nodes if node.get('is_exit')),
+        'countries': len(countries),
+        'top_countries': _top_countries(countries)
+    }
+
+
+# Role lists RelayIndex keeps in node list order: (list, address counts, node flag)
+ROLES = (('guard_nodes', 'guard_ips', 'is_guard'),
+         ('exit_nodes', 'exit_ips', 'is_exit'),
+         ('running_nodes', 'running_ips', 'running'))
+
+
+class AddressMap(Mapping):
+    """
+    Read-only mapping of relay address -> node over an ip_key()-keyed dict.
+    Addresses may be given as strings or integers; iteration yields strings.
+    `nodes` is the full node list, as on RelayStore.
+    """
+
+    def __init__(self, by_key, nodes=()):
+        self.by_key = by_key
+        self.nodes = nodes
+
+    def __getitem__(self, ip):
+        return self.by_key[ip_key(ip)]
+
+    def __contains__(self, ip):
+        return ip_key(ip) in self.by_key
+
+    def get(self, ip, default=None):
+        return self.by_key.get(ip_key(ip), default)
+
+    def __iter__(self):
+        return (ip_from_key(key) for key in self.by_key)
+
+    def __len__(self):
+        return len(self.by_key)
+
+
+class RelayIndex:
+    """
+    Built from a node list (see TORDatabase) and kept current with update().
+    All tables are keyed by ip_key(); lookups accept address strings or keys.
+
+    Where several relays share an address, lookups return the first one in
+    node list order, the same node a linear scan would have found.
+
+    guard_nodes, exit_nodes and running_nodes list the relays in each role;
+    guard_ips, exit_ips and running_ips map each of their address keys to
+    the number of relays in that role using it.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.nodes_by_ip = {}        # ip key -> relays with that address, in node list order
+        self.by_ip = {}
+        self.by_endpoint = {}
+        self.by_fingerprint = {}
+        self.running_guards = {}
+        self.running_exits = {}
+        self.addresses = AddressMap(self.by_ip, nodes)
+        self.countries = {}          # country -> relay count, for statistics
+        for name, ips, _ in ROLES:
+            setattr(self, name, [])
+            setattr(self, ips, {})
+
+        for node in nodes:
+            if node.get('fingerprint'):
+                self.by_fingerprint.setdefault(node['fingerprint'], node)
+            for key in {key for key, _ in _keys(node)}:
+                self.nodes_by_ip.setdefault(key, []).append(node)
+        for key in self.nodes_by_ip:
+            self._index_ip(key)
+        self._add_to_lists(nodes)
+        self.statistics = self._statistics()
+
+    def _index_ip(self, key):
+        """(Re)build the per-address entries from the relays currently at key"""
+        nodes = self.nodes_by_ip.get(key, [])
+        for table in (self.by_ip, self.running_guards, self.running_exits):
+            table.pop(key, None)
+
+        for node in nodes:
+            self.by_ip.setdefault(key, node)
+            for node_key, port in _keys(node):
+                if node_key == key:
+                    self.by_endpoint.setdefault((key, port), node)
+            if node.get('running'):
+                if node.get('is_guard'):
+                    self.running_guards.setdefault(key, node)
+                if node.get('is_exit'):
+                    self.running_exits.setdefault(key, node)
+
+    def _add_to_lists(self, nodes):
+        """Append nodes to their role lists and count them in the address counts and countries"""
+        for node in nodes:
+            country = node.get('country', 'Unknown')
+            self.countries[country] = self.countries.get(country, 0) + 1
+            keys = None
+            for name, ips_name, flag in ROLES:
+                if not node.get(flag):
+                    continue
+                getattr(self, name).append(node)
+                ips = getattr(self, ips_name)
+                keys = keys if keys is not None else {key for key, _ in _keys(node)}
+                for key in keys:
+                    ips[key] = ips.get(key, 0) + 1
+
+    def _remove_from_lists(self, nodes):
+        """Undo _add_to_lists for nodes; only the role lists they are in are filtered"""
+        removed_ids = {id(node) for node in nodes}
+        for node in nodes:
+            country = node.get('country', 'Unknown')
+            self.countries[country] -= 1
+            if not self.countries[country]:
+                del self.countries[country]
+            keys = {key for key, _ in _keys(node)}
+            for _, ips_name, flag in ROLES:
+                if node.get(flag):
+                    ips = getattr(self, ips_name)
+                    for key in keys:
+                        ips[key] -= 1
+                        if not ips[key]:
+                            del ips[key]
+        for name, _, flag in ROLES:
+            if any(node.get(flag) for node in nodes):
+                setattr(self, name, [node for node in getattr(self, name) if id(node) not in removed_ids])
+
+    def _statistics(self):
+        """node_statistics(self.nodes), from the counts kept by update()"""
+        return {
+            'total_nodes': len(self.nodes),
+            'running_nodes': len(self.running_nodes),
+            'guard_nodes': len(self.guard_nodes),
+            'exit_nodes': len(self.exit_nodes),
+            'countries': len(self.countries),
+            'top_countries': _top_countries(self.countries)
+        }
+
+    def copy(self):
+        """
+        Index over the same node dicts with tables of its own, so a diff can
+        be applied with update() while this one keeps serving lookups
+        """
+        index = RelayIndex.__new__(RelayIndex)
+        index.nodes = list(self.nodes)
+        index.nodes_by_ip = {key: list(nodes) for key, nodes in self.nodes_by_ip.items()}
+        for table in ('by_ip', 'by_endpoint', 'by_fingerprint', 'running_guards', 'running_exits'):
+            setattr(index, table, dict(getattr(self, table)))
+        index.addresses = AddressMap(index.by_ip, index.nodes)
+        for name, ips, _ in ROLES:
+            setattr(index, name, list(getattr(self, name)))
+            setattr(index, ips, dict(getattr(self, ips)))
+        index.countries = dict(self.countries)
+        index.statistics = self.statistics
+        return index
+
+    def update(self, removed=(), added=()):
+        """
+        Apply a consensus diff in place: drop the `removed` nodes and append
+        the `added` ones (a changed relay is removed and added). Only the IPs
+        those relays use are re-indexed, and the role lists, address counts
+        and statistics are adjusted for those relays alone.
+        """
+        removed_ids = {id(node) for node in removed}
+        if removed_ids:
+            self.nodes[:] = [node for node in self.nodes if id(node) not in removed_ids]
+        self.nodes.extend(added)
+
+        touched = set()
+        for node in removed:
+            for key, port in _keys(node):
+                if key in self.nodes_by_ip:
+                    self.nodes_by_ip[key] = [other for other in self.nodes_by_ip[key] if other is not node]
+                    if not self.nodes_by_ip[key]:
+                        del self.nodes_by_ip[key]
+                    touched.add(key)
+                # _index_ip only adds endpoints, so drop the removed relays' own first
+                if self.by_endpoint.get((key, port)) is node:
+                    del self.by_endpoint[(key, port)]
+            if self.by_fingerprint.get(node.get('fingerprint')) is node:
+                del self.by_fingerprint[node['fingerprint']]
+        for node in added:
+            for key in {key for key, _ in _keys(node)}:
+                self.nodes_by_ip.setdefault(key, []).append(node)
+                touched.add(key)
+            if node.get('fingerprint'):
+                self.by_fingerprint.setdefault(node['fingerprint'], node)
+
+        for key in touched:
+            self._index_ip(key)
+        self._remove_from_lists(removed)
+        self._add_to_lists(added)
+        self.statistics = self._statistics()
+
+    def replace(self, pairs):
+        """
+        Swap each (old, new) node for new in place, where new has the same
+        indexed fields (addresses, ports, flags, country) as old, so every
+        table entry stays where it is and nothing is re-indexed
+        """
+        new_of = {id(old): new for old, new in pairs}
+        if not new_of:
+            return
+        self.nodes[:] = [new_of.get(id(node), node) for node in self.nodes]
+        for old, new in pairs:
+            for key, port in _keys(old):
+                if key in self.nodes_by_ip:
+                    self.nodes_by_ip[key] = [new if other is old else other for other in self.nodes_by_ip[key]]
+                for table, table_key in ((self.by_ip, key), (self.running_guards, key),
+                                         (self.running_exits, key), (self.by_endpoint, (key, port))):
+                    if table.get(table_key) is old:
+                        table[table_key] = new
+            if self.by_fingerprint.get(old.get('fingerprint')) is old:
+                self.by_fingerprint[old['fingerprint']] = new
+        # Same flags and country, so the counts and statistics are unchanged
+        for name, _, flag in ROLES:
+            if any(old.get(flag) for old, _ in pairs):
+                setattr(self, name, [new_of.get(id(node), node) for node in getattr(self, name)])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, ip):
+        return ip_key(ip) in self.by_ip
+
+    def node_by_ip(self, ip):
+        return self.by_ip.get(ip_key(ip))
+
+    def nodes_at(self, ip):
+        """Every relay with address ip, in node list order"""
+        return list(self.nodes_by_ip.get(ip_key(ip), ()))
+
+    def node_by_endpoint(self, ip, port):
+        """Relay listening on ip:port, or None"""
+        return self.by_endpoint.get((ip_key(ip), _port(port)))
+
+    def node_by_fingerprint(self, fingerprint):
+        return self.by_fingerprint.get(fingerprint)
+
+    def running_guard(self, ip):
+        """Running guard relay at ip, or None"""
+        return self.running_guards.get(ip_key(ip))
+
+    def running_exit(self, ip):
+        """Running exit relay at ip, or None"""
+        return self.running_exits.get(ip_key(ip))
@@ -0,0 +1,548 @@
+"""
+A2: Binary Relay Store
+Compact on-disk form of the TOR node database: fixed-width records sorted
+by IP plus a string table, opened with mmap and searched in place, so a
+detector process starts without parsing JSON and every process shares the
+same pages through the page cache. The lookup hash table, address
+prefilter, role lists and statistics are built once by the writer and
+live in the file too, so attaching costs a few page faults and no
+per-process memory
+"""
+
+import bisect
+import json
+import math
+import mmap
+import os
+import socket
+import struct
+import sys
+from collections.abc import Mapping, Sequence
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from part_a.config.settings import DATABASE_FILE, RELAY_STORE_FILE, RELAY_PREFILTER_FP_RATE
+from part_a.tor_database.bloom_filter import BloomFilter, build_bloom
+from part_a.tor_database.relay_index import RelayIndex, ip_key, node_addresses, node_statistics
+
+MAGIC = b'TORRLY06'
+VERSION = 6
+NO_STRING = 0xFFFFFFFF
+
+# magic, version, record count, distinct addresses, last_update string,
+# records offset, address table offset, fingerprint index offset, string table offset,
+# hash table offset, hash slots, role list offset, guard/exit/running counts, metadata string,
+# prefilter offset, prefilter bits (0 without one), prefilter hashes
+_header = struct.Struct('<8sIIIIQQQQQIQIIIIQQI')
+# ip (16 bytes, IPv4 mapped into IPv6), or_port, flag bits, running, fingerprint,
+# country, lat, lon, bandwidth, then string offsets for nickname, country_name,
+# as_number, as_name, first_seen, last_seen, family, OR addresses and exit addresses
+_record = struct.Struct('<16sHIB20s2sffQ9I')
+# Every OR and exit address: ip, port (0 for exit addresses), record number;
+# sorted by ip and then by the relay's position in the node list written,
+# this is what lookups search
+_address = struct.Struct('<16sHI')
+# Open-addressing hash table over distinct addresses: ip key high/low 64 bits,
+# first address entry + 1 (0 marks an empty slot)
+_slot = struct.Struct('<QQI')
+_unpack_slot = _slot.unpack_from
+_u32 = struct.Struct('<I')
+_u16 = struct.Struct('<H')
+STRING_FIELDS = ('nickname', 'country_name', 'as_number', 'as_name', 'first_seen', 'last_seen', 'family')
+
+RELAY_FLAGS = ('Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir', 'MiddleOnly', 'NoEdConsensus',
+               'Running', 'Stable', 'StaleDesc', 'Sybil', 'V2Dir', 'Valid')
+_FLAG_BITS = {flag: 1 << i for i, flag in enumerate(RELAY_FLAGS)}
+_V4_PREFIX = b'\x00' * 10 + b'\xff\xff'
+_MASK64 = (1 << 64) - 1
+_FIBONACCI = 0x9E3779B97F4A7C15
+
+
+def pack_ip(ip):
+    """16-byte sort key for an IP string (IPv4 is mapped into IPv6), or None if invalid"""
+    try:
+        return _V4_PREFIX + socket.inet_aton(ip) if '.' in ip else socket.inet_pton(socket.AF_INET6, ip)
+    except (OSError, TypeError):
+        return None
+
+
+def unpack_ip(packed):
+    if packed[:12] == _V4_PREFIX:
+        return socket.inet_ntoa(packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def _slot_of(key, shift):
+    """Home slot of an ip key in a table of 2**(64 - shift) slots"""
+    # Only the low 64 bits of the product are kept, so they only need the low 64 bits of the key
+    return ((key >> 64 ^ key) * _FIBONACCI & _MASK64) >> shift
+
+
+def _hash_table(address_rows):
+    """Slot table for the sorted address entries; returns (bytes, slot count)"""
+    firsts = {}
+    for j, (packed, _, _) in enumerate(address_rows):
+        firsts.setdefault(packed, j)
+    bits = max(1, (2 * len(firsts) - 1).bit_length())
+    slots = [None] * (1 << bits)
+    mask = len(slots) - 1
+    for packed, j in firsts.items():
+        key = int.from_bytes(packed, 'big')
+        i = _slot_of(key, 64 - bits)
+        while slots[i] is not None:
+            i = (i + 1) & mask
+        slots[i] = (key >> 64, key & _MASK64, j + 1)
+    empty = _slot.pack(0, 0, 0)
+    return b''.join(_slot.pack(*slot) if slot else empty for slot in slots), len(slots)
+
+
+def write_relay_store(nodes, filename, last_update=None, meta=None, prefilter_fp_rate=RELAY_PREFILTER_FP_RATE):
+    """
+    Write nodes (TORDatabase node dicts) to filename; nodes with unusable IPs
+    are skipped. meta (JSON-serialisable, e.g. the database's last_checked)
+    is stored alongside and read back as RelayStore.meta. A prefilter_fp_rate
+    of 0 leaves the address prefilter out.
+    """
+    strings = {}
+    table = bytearray()
+
+    def string_ref(value):
+        if value is None:
+            return NO_STRING
+        value = str(value)
+        if value not in strings:
+            strings[value] = len(table)
+            data = value.encode('utf-8')[:0xFFFF]
+            table.extend(_u16.pack(len(data)) + data)
+        return strings[value]
+
+    rows = []
+    for rank, node in enumerate(nodes):
+        addresses = [(pack_ip(ip or ''), ip, port) for ip, port in node_addresses(node)]
+        addresses = [address for address in addresses if address[0] is not None]
+        if not addresses:
+            continue
+        rows.append((addresses[0][0], rank, node, addresses))
+    rows.sort(key=lambda row: row[:2])
+
+    records = bytearray()
+    address_rows = []
+    for i, (packed, _, node, addresses) in enumerate(rows):
+        or_addresses = ' '.join(f"{ip}|{port or ''}" for ip, port in node.get('or_addresses') or ()) or None
+        exit_addresses = ' '.join(node.get('exit_addresses') or ()) or None
+        seen = set()
+        for address_packed, _, port in addresses:
+            if (address_packed, int(port or 0)) not in seen:
+                seen.add((address_packed, int(port or 0)))
+                address_rows.append((address_packed, int(port or 0), i))
+        flags = 0
+        for flag in node.get('flags') or []:
+            flags |= _FLAG_BITS.get(flag, 0)
+        for flag, key in (('Guard', 'is_guard'), ('Exit', 'is_exit'), ('Fast', 'is_fast'), ('Stable', 'is_stable')):
+            if node.get(key):
+                flags |= _FLAG_BITS[flag]
+        fingerprint = node.get('fingerprint')
+        lat, lon = node.get('lat'), node.get('lon')
+        records.extend(_record.pack(
+            packed,
+            int(node.get('or_port') or 0),
+            flags,
+            1 if node.get('running') else 0,
+            bytes.fromhex(fingerprint) if fingerprint else b'',
+            (node.get('country') or '').encode('ascii', 'ignore')[:2],
+            math.nan if lat is None else lat,
+            math.nan if lon is None else lon,
+            int(node.get('bandwidth') or 0),
+            *(string_ref(node.get(field)) for field in STRING_FIELDS),
+            string_ref(or_addresses),
+            string_ref(exit_addresses)
+        ))
+    # Records are in primary IP order; relays sharing a secondary address are
+    # found in node list order, the relay RelayIndex would return first.
+    # Stable, so a relay's own entries keep their node_addresses() order.
+    address_rows.sort(key=lambda row: (row[0], rows[row[2]][1]))
+
+    by_fingerprint = sorted(
+        (i for i, (_, _, node, _) in enumerate(rows) if node.get('fingerprint')),
+        key=lambda i: rows[i][2]['fingerprint'].upper()
+    )
+    # Role lists in node list order too, like RelayIndex's guard_nodes etc.
+    in_order = sorted(range(len(rows)), key=lambda i: rows[i][1])
+    roles = [[i for i in in_order if rows[i][2].get(key)] for key in ('is_guard', 'is_exit', 'running')]
+    hash_table, hash_slots = _hash_table(address_rows)
+    bloom, bloom_bits, bloom_hashes = b'', 0, 0
+    if prefilter_fp_rate:
+        bloom, bloom_bits, bloom_hashes = build_bloom((int.from_bytes(row[0], 'big') for row in address_rows),
+                                                      prefilter_fp_rate)
+    meta = dict(meta or {}, statistics=node_statistics([node for _, _, node, _ in rows]),
+                prefilter_fp_rate=prefilter_fp_rate or None)
+
+    last_update_ref = string_ref(last_update)
+    meta_ref = string_ref(json.dumps(meta))
+    records_offset = _header.size
+    addresses_offset = records_offset + len(records)
+    fingerprint_offset = addresses_offset + _address.size * len(address_rows)
+    hash_offset = fingerprint_offset + 4 * len(by_fingerprint)
+    roles_offset = hash_offset + len(hash_table)
+    bloom_offset = roles_offset + 4 * sum(len(role) for role in roles)
+    strings_offset = bloom_offset + len(bloom)
+    header = _header.pack(MAGIC, VERSION, len(rows), len({row[0] for row in address_rows}), last_update_ref,
+                          records_offset, addresses_offset, fingerprint_offset, strings_offset,
+                          hash_offset, hash_slots, roles_offset, *(len(role) for role in roles), meta_ref,
+                          bloom_offset, bloom_bits, bloom_hashes)
+
+    temp_path = filename + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(header)
+        f.write(records)
+        f.write(b''.join(_address.pack(*row) for row in address_rows))
+        f.write(b''.join(_u32.pack(i) for i in by_fingerprint))
+        f.write(hash_table)
+        f.write(b''.join(_u32.pack(i) for role in roles for i in role))
+        f.write(bloom)
+        f.write(table)
+    # Readers that have the old file mapped keep their pages until they reopen
+    os.replace(temp_path, filename)
+    return len(rows)
+
+
+class _Keys(Sequence):
+    """Address entry i's 16-byte IP, so bisect can search the mapped table in place"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.address_count
+
+    def __getitem__(self, i):
+        offset = self.store.addresses_offset + i * _address.size
+        return self.store.map[offset:offset + 16]
+
+
+class _Fingerprints(Sequence):
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.fingerprint_count
+
+    def __getitem__(self, i):
+        record = _u32.unpack_from(self.store.map, self.store.fingerprint_offset + 4 * i)[0]
+        offset = self.store.records_offset + record * _record.size + 23
+        return self.store.map[offset:offset + 20]
+
+
+class _Nodes(Sequence):
+    """All nodes in IP order, decoded on access"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.store.node(j) for j in range(*i.indices(self.store.count))]
+        if i < 0:
+            i += self.store.count
+        if not 0 <= i < self.store.count:
+            raise IndexError(i)
+        return self.store.node(i)
+
+
+class _RecordList(Sequence):
+    """Nodes whose record numbers are stored at offset (a role list), decoded on access"""
+
+    def __init__(self, store, offset, count):
+        self.store = store
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.store.node(_u32.unpack_from(self.store.map, self.offset + 4 * i)[0])
+
+
+class RelayStore(Mapping):
+    """
+    Read-only view of a relay store file: a mapping of IP -> node dict (the
+    first relay with that OR or exit address, IPv4 or IPv6) found through
+    the mapped hash table.
+
+    It also offers RelayIndex's lookup interface, so TORDatabase can use it
+    in place of an index built from JSON.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Identifies the file mapped; writers replace the file rather than rewrite it
+        self.stamp = (stat.st_ino, stat.st_mtime_ns)
+        if len(self.map) < _header.size or self.map[:6] != MAGIC[:6]:
+            self.map.close()
+            raise ValueError(f"{filename} is not a version {VERSION} relay store")
+        (magic, version, self.count, self.ip_count, last_update_ref, self.records_offset,
+         self.addresses_offset, self.fingerprint_offset, self.strings_offset, self.hash_offset,
+         self.hash_slots, roles_offset, guards, exits, running, self._meta_ref,
+         bloom_offset, bloom_bits, bloom_hashes) = _header.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError(f"{filename} is not a version {VERSION} relay store")
+        self.address_count = (self.fingerprint_offset - self.addresses_offset) // _address.size
+        self.fingerprint_count = (self.hash_offset - self.fingerprint_offset) // 4
+        self._hash_mask = self.hash_slots - 1
+        self._hash_shift = 64 - self._hash_mask.bit_length()
+        self.last_update = self._string(last_update_ref)
+        self.keys_view = _Keys(self)
+        self.nodes = _Nodes(self)
+        self.guard_nodes = _RecordList(self, roles_offset, guards)
+        self.exit_nodes = _RecordList(self, roles_offset + 4 * guards, exits)
+        self.running_nodes = _RecordList(self, roles_offset + 4 * (guards + exits), running)
+        self._meta = None
+        self.prefilter = None
+        if bloom_bits:
+            self.prefilter = BloomFilter(self.map, bloom_bits, bloom_hashes, bloom_offset,
+                                         self.meta.get('prefilter_fp_rate'))
+
+    def __reduce__(self):
+        # Worker processes reopen the file instead of copying it
+        return (RelayStore, (self.filename,))
+
+    def close(self):
+        self.map.close()
+
+    def replaced(self):
+        """True if filename now holds a different file than the one mapped"""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != self.stamp
+
+    def _string(self, offset):
+        if offset == NO_STRING:
+            return None
+        start = self.strings_offset + offset
+        length = _u16.unpack_from(self.map, start)[0]
+        return self.map[start + 2:start + 2 + length].decode('utf-8')
+
+    def node(self, i):
+        """Decode record i into a node dict shaped like TORDatabase's JSON nodes"""
+        (packed, or_port, flags, running, fingerprint, country, lat, lon, bandwidth,
+         *refs, or_ref, exit_ref) = _record.unpack_from(self.map, self.records_offset + i * _record.size)
+        flag_list = [flag for flag in RELAY_FLAGS if flags & _FLAG_BITS[flag]]
+        node = {
+            'fingerprint': fingerprint.hex().upper() if any(fingerprint) else None,
+            'ip_address': unpack_ip(packed),
+            'or_port': str(or_port) if or_port else None,
+            'country': country.rstrip(b'\x00').decode('ascii') or None,
+            'lat': None if math.isnan(lat) else lat,
+            'lon': None if math.isnan(lon) else lon,
+            'bandwidth': bandwidth,
+            'flags': flag_list,
+            'running': bool(running),
+            'is_guard': 'Guard' in flag_list,
+            'is_exit': 'Exit' in flag_list,
+            'is_fast': 'Fast' in flag_list,
+            'is_stable': 'Stable' in flag_list
+        }
+        node.update(zip(STRING_FIELDS, (self._string(ref) for ref in refs)))
+        node['or_addresses'] = [[ip, port or None] for ip, _, port in
+                                (address.partition('|') for address in (self._string(or_ref) or '').split())]
+        node['exit_addresses'] = (self._string(exit_ref) or '').split()
+        return node
+
+    @property
+    def meta(self):
+        """Metadata stored by the writer, including precomputed 'statistics'"""
+        if self._meta is None:
+            self._meta = json.loads(self._string(self._meta_ref) or '{}')
+        return self._meta
+
+    @staticmethod
+    def _key(ip):
+        key = ip_key(ip) if isinstance(ip, str) else ip
+        return key if isinstance(key, int) and 0 <= key < 1 << 128 else None
+
+    def _first(self, ip, key=None):
+        """First address entry for ip, or None: one hash probe, usually one slot read"""
+        key = self._key(ip) if key is None else key
+        if key is None:
+            return None
+        high, low = key >> 64, key & _MASK64
+        i = ((high ^ key) * _FIBONACCI & _MASK64) >> self._hash_shift
+        while True:
+            slot_high, slot_low, entry = _unpack_slot(self.map, self.hash_offset + i * 20)
+            if not entry:
+                return None
+            if slot_low == low and slot_high == high:
+                return entry - 1
+            i = (i + 1) & self._hash_mask
+
+    def _range(self, ip):
+        """Address entries [first, end) for ip"""
+        first = self._first(ip)
+        if first is None:
+            return 0, 0
+        packed = self.keys_view[first]
+        end = first + 1
+        while end < self.address_count and self.keys_view[end] == packed:
+            end += 1
+        return first, end
+
+    def _entry(self, j):
+        """(port, record number) of address entry j"""
+        return _address.unpack_from(self.map, self.addresses_offset + j * _address.size)[1:]
+
+    def _flags(self, i):
+        flags, running = struct.unpack_from('<IB', self.map, self.records_offset + i * _record.size + 18)
+        return flags, running
+
+    # Mapping interface: IP -> first node with that address
+
+    def __getitem__(self, ip):
+        first, end = self._range(ip)
+        if first == end:
+            raise KeyError(ip)
+        return self.node(self._entry(first)[1])
+
+    def __contains__(self, ip):
+        # Per-packet test, answered from the shared mapped table: no
+        # per-process set of addresses to build or keep
+        return self._first(ip) is not None
+
+    def screen(self, key):
+        """
+        Whether the ip_key() integer key is a relay address, for packet
+        decoders to drop traffic before building any strings or records:
+        the prefilter rejects most addresses, the hash table confirms the rest
+        """
+        prefilter = self.prefilter
+        if prefilter is not None and not prefilter.might_contain(key):
+            return False
+        if self._first(None, key) is None:
+            if prefilter is not None:
+                prefilter.false_positives += 1
+            return False
+        return True
+
+    def __iter__(self):
+        previous = None
+        for i in range(self.address_count):
+            packed = self.keys_view[i]
+            if packed != previous:
+                previous = packed
+                yield unpack_ip(packed)
+
+    def __len__(self):
+        return self.ip_count
+
+    # RelayIndex interface
+
+    def node_by_ip(self, ip):
+        return self.get(ip)
+
+    def nodes_at(self, ip):
+        """Every relay with address ip, in the original database order"""
+        first, end = self._range(ip)
+        records = []
+        for j in range(first, end):
+            # A relay has one entry per port it uses the address with
+            i = self._entry(j)[1]
+            if i not in records:
+                records.append(i)
+        return [self.node(i) for i in records]
+
+    def node_by_endpoint(self, ip, port):
+        # Exit addresses are stored with port 0, and found with port None like in RelayIndex
+        try:
+            port = int(port) if port is not None else 0
+        except (TypeError, ValueError):
+            return None
+        first, end = self._range(ip)
+        for j in range(first, end):
+            or_port, i = self._entry(j)
+            if or_port == port:
+                return self.node(i)
+        return None
+
+    def node_by_fingerprint(self, fingerprint):
+        try:
+            key = bytes.fromhex(fingerprint)
+        except (TypeError, ValueError):
+            return None
+        fingerprints = _Fingerprints(self)
+        i = bisect.bisect_left(fingerprints, key)
+        if i < len(fingerprints) and fingerprints[i] == key:
+            return self.node(_u32.unpack_from(self.map, self.fingerprint_offset + 4 * i)[0])
+        return None
+
+    def _running_with(self, ip, flag):
+        first, end = self._range(ip)
+        for j in range(first, end):
+            i = self._entry(j)[1]
+            flags, running = self._flags(i)
+            if running and flags & flag:
+                return self.node(i)
+        return None
+
+    def running_guard(self, ip):
+        return self._running_with(ip, _FLAG_BITS['Guard'])
+
+    def running_exit(self, ip):
+        return self._running_with(ip, _FLAG_BITS['Exit'])
+
+    @property
+    def statistics(self):
+        statistics = dict(self.meta.get('statistics', {}))
+        statistics['top_countries'] = [tuple(item) for item in statistics.get('top_countries', [])]
+        return statistics
+
+
+def store_is_current(database_file=DATABASE_FILE, store_file=RELAY_STORE_FILE):
+    """True if store_file exists and was written no earlier than database_file"""
+    if not os.path.exists(store_file):
+        return False
+    return not os.path.exists(database_file) or os.path.getmtime(store_file) >= os.path.getmtime(database_file)
+
+
+def open_relay_nodes(database_file=DATABASE_FILE, store_file=RELAY_STORE_FILE):
+    """
+    Mapping of relay address -> node dict: the binary store when it is
+    current, otherwise an index built from the JSON database
+    """
+    if store_is_current(database_file, store_file):
+        try:
+            return RelayStore(store_file)
+        except (OSError, ValueError):
+            pass
+    with open(database_file, 'r') as f:
+        nodes = json.load(f).get('nodes', [])
+    return RelayIndex(nodes).addresses
+
+
+def reopen_relay_nodes(relay_nodes, database_file=DATABASE_FILE, store_file=RELAY_STORE_FILE):
+    """
+    relay_nodes (from open_relay_nodes) or, if a newer relay store has been
+    written since, that store freshly mapped. The old mapping stays valid
+    for whoever still holds it.
+    """
+    if isinstance(relay_nodes, RelayStore) and not relay_nodes.replaced():
+        return relay_nodes
+    if not store_is_current(database_file, store_file):
+        return relay_nodes
+    try:
+        return RelayStore(store_file)
+    except (OSError, ValueError):
+        return relay_nodes
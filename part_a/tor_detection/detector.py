@@ -3,14 +3,21 @@ import os
 import json
 import logging
 import glob
+import argparse
+import time
+import threading
+import multiprocessing
 from datetime import datetime
-from scapy.all import rdpcap, IP
-import requests
-import ipaddress # <--- Needed for public IP check
 
 # Add necessary paths and config
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from config.settings import *
+from part_a.network_capture.records import STREAM_END
+from part_a.network_capture.pcap_reader import PcapReader
+from part_a.geolocation.geolocation import get_geolocation_service, node_location
+from part_a.tor_database.relay_store import open_relay_nodes, reopen_relay_nodes
+from part_a.tor_database.relay_index import ip_key
+from part_a.tor_database.prefix_trie import RelayPrefixes
 
 import subprocess
 
@@ -23,125 +30,416 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def is_public_ip(ip):
-    try:
-        ip_obj = ipaddress.ip_address(ip)
-        return ip_obj.is_global
-    except Exception:
-        return False
-
 def get_ip_geolocation(ip):
-    if not is_public_ip(ip):
-        return {"lat": None, "lon": None, "country": "-"}
-    try:
-        resp = requests.get(f"http://ip-api.com/json/{ip}?fields=status,lat,lon,country")
-        data = resp.json()
-        if data["status"] == "success":
-            return {"lat": data["lat"], "lon": data["lon"], "country": data["country"]}
-    except Exception:
-        pass
-    return {"lat": None, "lon": None, "country": "-"}
+    """Cached lookup through the shared geolocation service"""
+    return get_geolocation_service().lookup(ip)
 
 def load_tor_node_ips():
+    """Mapping of relay ip -> node for the TOR database, memory-mapped when the binary store is current"""
     try:
-        with open(DATABASE_FILE, 'r') as f:
-            data = json.load(f)
-            nodes = data.get('nodes', [])
-            node_map = {}
-            for node in nodes:
-                ip = node.get('ip_address')
-                country = node.get('country', '')
-                if ip:
-                    node_map[ip] = country
-            return node_map
+        return open_relay_nodes(DATABASE_FILE, RELAY_STORE_FILE)
     except Exception as e:
         logger.error(f"Failed to load TOR nodes: {e}")
         return {}
 
+def relay_prefilter(tor_nodes):
+    """Address prefilter of a mapped relay store, or None (JSON fallback, or store written without one)"""
+    return getattr(tor_nodes, 'prefilter', None)
+
+def relay_prefilter_stats(tor_nodes):
+    prefilter = relay_prefilter(tor_nodes)
+    if prefilter is None:
+        return None
+    stats = prefilter.stats()
+    logger.info(f"Relay prefilter: {stats['rejected']} of {stats['checked']} lookups rejected, "
+                f"{stats['false_positives']} false positive(s)")
+    return stats
+
+def load_relay_prefixes(tor_nodes):
+    """Prefix trie over the relays' addresses and hosting prefixes plus the analyst watchlist"""
+    try:
+        return RelayPrefixes(tor_nodes.nodes)
+    except Exception as e:
+        logger.error(f"Failed to build relay prefixes: {e}")
+        return None
+
 def get_latest_pcap_file():
     files = glob.glob('part_a/logs/packets_*.pcap')
     if not files:
         return None
     return max(files, key=os.path.getctime)
 
-def detect_tor_in_pcap(tor_nodes, pcap_file):
-    packets = rdpcap(pcap_file)
-    detections = []
-    for pkt in packets:
-        if IP in pkt:
-            src_ip = pkt[IP].src
-            dst_ip = pkt[IP].dst
-            # entry_node (user->tor), exit_node (tor->user) logic
-            if src_ip in tor_nodes:
-                geo = get_ip_geolocation(src_ip)
-                entry = {
-                    "ip": src_ip,
-                    "country": geo["country"],
-                    "lat": geo["lat"],
-                    "lon": geo["lon"]
-                }
-                detections.append({
-                    "user_ip": dst_ip,
-                    "entry_node": entry,
-                    "exit_node": None,
-                    "confidence": 100,
-                    "timestamp": datetime.now().isoformat()
-                })
-            elif dst_ip in tor_nodes:
-                geo = get_ip_geolocation(dst_ip)
-                exit = {
-                    "ip": dst_ip,
-                    "country": geo["country"],
-                    "lat": geo["lat"],
-                    "lon": geo["lon"]
-                }
-                detections.append({
-                    "user_ip": src_ip,
-                    "entry_node": None,
-                    "exit_node": exit,
-                    "confidence": 100,
-                    "timestamp": datetime.now().isoformat()
-                })
-    return detections, len(packets)
+def get_latest_capture_files():
+    """Segments of the latest capture run from the ring manifest, or the newest loose pcap"""
+    from part_a.network_capture.pcap_ring import PcapRing
+    segments = PcapRing().latest_run_segments()
+    if segments:
+        return segments
+    pcap_file = get_latest_pcap_file()
+    return [pcap_file] if pcap_file else []
 
-def main():
-    logger.info("Starting TOR traffic detection")
-    tor_nodes = load_tor_node_ips()
-    if not tor_nodes:
-        print("No TOR IPs loaded. Exiting detection.")
-        return
+class DetectionGroups:
+    """
+    Collapses matched packets into one detection per
+    (user_ip, relay_ip, relay_port, direction), carrying packet and byte totals
+    and the first/last capture timestamps. Relay locations come from the
+    node database; relays without one are geolocated once each, when
+    detections are built, not once per packet.
 
-    pcap_file = get_latest_pcap_file()
-    if not pcap_file:
-        print("No capture pcap files found in logs. Run capture first.")
-        return
+    With a RelayHistory, an IP counts as a TOR node only if it was a running
+    relay in the consensus in force at the packet's timestamp, for replaying
+    archived captures.
 
-    logger.info(f"Detecting TOR usage in pcap: {pcap_file}")
-    detections, total_packet_count = detect_tor_in_pcap(tor_nodes, pcap_file)
+    With RelayPrefixes, detections carry the relay's prefix, AS and family,
+    and traffic to or from a watchlist CIDR that is not a relay is grouped
+    too, under the "watchlist" role (see watchlist_hits()).
 
-    if detections:
-        print(f"TOR traffic detected involving {len(detections)} TOR node(s):")
-        for det in detections:
-            if det["entry_node"]:
-                print(f"- ENTRY {det['entry_node']['ip']} (User: {det['user_ip']})")
-            if det["exit_node"]:
-                print(f"- EXIT {det['exit_node']['ip']} (User: {det['user_ip']})")
-        logger.info(f"TOR traffic detected: {detections}")
-        ips_str = " ".join([det["user_ip"] for det in detections])
-        subprocess.run([sys.executable, "part_a/alerting/alert_system.py", ips_str])
+    Addresses are tested through the relay store's prefilter (screen()),
+    unless `screened` says the records were already screened while decoding.
+    """
+
+    def __init__(self, tor_nodes, history=None, prefixes=None, screened=False):
+        self.screened = screened
+        self.tor_nodes = tor_nodes
+        self.history = history
+        self.prefixes = prefixes
+        self.watching = bool(prefixes and prefixes.watchlist)
+        self.groups = {}             # key -> [packets, bytes, first_seen, last_seen]
+        self.geolocations = {}
+
+    @property
+    def tor_nodes(self):
+        return self._tor_nodes
+
+    @tor_nodes.setter
+    def tor_nodes(self, tor_nodes):
+        # Set again when detect_tor_stream swaps in a new relay store
+        self._tor_nodes = tor_nodes
+        screen = getattr(tor_nodes, 'screen', None)
+        if screen is None or self.screened:
+            self.is_relay = tor_nodes.__contains__
+        else:
+            def is_relay(ip):
+                key = ip_key(ip)
+                return key is not None and screen(key)
+            self.is_relay = is_relay
+
+    def add(self, src_ip, dst_ip, src_port, dst_port, timestamp, length, packets=1, last_seen=None):
+        """
+        Account traffic from src to dst if it touches a TOR node. A packet from a
+        TOR node counts towards an entry_node detection, one to a TOR node towards
+        an exit_node detection. Returns the group key if this created a new
+        group, else None.
+        """
+        if self.history is not None:
+            src_relay = self.history.was_running(src_ip, timestamp)
+            dst_relay = not src_relay and self.history.was_running(dst_ip, timestamp)
+        else:
+            src_relay = self.is_relay(src_ip)
+            dst_relay = not src_relay and self.is_relay(dst_ip)
+        if src_relay:
+            key = (dst_ip, src_ip, src_port, "entry_node")
+        elif dst_relay:
+            key = (src_ip, dst_ip, dst_port, "exit_node")
+        elif self.watching and self.prefixes.watched(dst_ip):
+            key = (src_ip, dst_ip, dst_port, "watchlist")
+        elif self.watching and self.prefixes.watched(src_ip):
+            key = (dst_ip, src_ip, src_port, "watchlist")
+        else:
+            return None
+        return self._add(key, packets, length, timestamp, last_seen or timestamp)
+
+    def _add(self, key, packets, length, first_seen, last_seen):
+        group = self.groups.get(key)
+        if group is None:
+            self.groups[key] = [packets, length, first_seen, last_seen]
+            return key
+        group[0] += packets
+        group[1] += length
+        group[2] = min(group[2], first_seen)
+        group[3] = max(group[3], last_seen)
+        return None
+
+    def merge(self, groups):
+        """Fold in the raw groups of another DetectionGroups, e.g. from a shard worker"""
+        for key, (packets, length, first_seen, last_seen) in groups.items():
+            self._add(key, packets, length, first_seen, last_seen)
+
+    def _location(self, relay_ip, timestamp):
+        """Stored location of the relay, from the consensus in force at timestamp when replaying"""
+        node = self.history.node_at(relay_ip, timestamp) if self.history is not None else None
+        node = node or self.tor_nodes.get(relay_ip)
+        return node_location(node) if node else None
+
+    def detection(self, key):
+        user_ip, relay_ip, relay_port, role = key
+        packets, length, first_seen, last_seen = self.groups[key]
+        # Relays are located when the database is built; only fall back to a lookup
+        geo = self._location(relay_ip, first_seen) or self.geolocations.get(relay_ip)
+        if geo is None:
+            geo = self.geolocations[relay_ip] = get_ip_geolocation(relay_ip)
+        node = {
+            "ip": relay_ip,
+            "country": geo["country"],
+            "lat": geo["lat"],
+            "lon": geo["lon"]
+        }
+        detection = {
+            "user_ip": user_ip,
+            "entry_node": node if role == "entry_node" else None,
+            "exit_node": node if role == "exit_node" else None,
+            "relay_port": relay_port,
+            "confidence": 100,
+            "timestamp": datetime.fromtimestamp(first_seen).isoformat(),
+            "first_seen": datetime.fromtimestamp(first_seen).isoformat(),
+            "last_seen": datetime.fromtimestamp(last_seen).isoformat(),
+            "packets": packets,
+            "bytes": length
+        }
+        self._label(detection, relay_ip)
+        return detection
+
+    def _label(self, detection, ip):
+        """Add the prefix, AS, family and watchlist labels of ip"""
+        match = self.prefixes.match(ip) if self.prefixes is not None else None
+        if match:
+            detection.update({field: match[field] for field in ('prefix', 'as_number', 'as_name', 'family', 'watchlist')})
+
+    def watchlist_hits(self):
+        """One dict per watchlist group: traffic to watchlist CIDRs that are not relays"""
+        hits = []
+        for key in sorted((key for key in self.groups if key[3] == "watchlist"), key=lambda key: self.groups[key][2]):
+            user_ip, remote_ip, port, _ = key
+            packets, length, first_seen, last_seen = self.groups[key]
+            hit = {
+                "user_ip": user_ip,
+                "remote_ip": remote_ip,
+                "remote_port": port,
+                "first_seen": datetime.fromtimestamp(first_seen).isoformat(),
+                "last_seen": datetime.fromtimestamp(last_seen).isoformat(),
+                "packets": packets,
+                "bytes": length
+            }
+            self._label(hit, remote_ip)
+            hits.append(hit)
+        return hits
+
+    def detections(self):
+        """One detection dict per relay group, ordered by first capture timestamp"""
+        keys = sorted((key for key in self.groups if key[3] != "watchlist"), key=lambda key: self.groups[key][2])
+        # Resolve every relay of the run in one batch instead of one request each
+        relay_ips = [key[1] for key in keys
+                     if not self._location(key[1], self.groups[key][2]) and key[1] not in self.geolocations]
+        self.geolocations.update(get_geolocation_service().lookup_many(relay_ips))
+        return [self.detection(key) for key in keys]
+
+def _match_pcap(tor_nodes, pcap_file, shard=None, history=None, prefixes=None):
+    # Frames touching no current relay are dropped while decoding, unless
+    # history or the watchlist may still match them
+    watching = bool(prefixes and prefixes.watchlist)
+    screen = getattr(tor_nodes, 'screen', None) if history is None and not watching else None
+    groups = DetectionGroups(tor_nodes, history, prefixes, screened=screen is not None)
+    with PcapReader(pcap_file) as reader:
+        for record in reader.records(shard, screen):
+            groups.add(record.src_ip, record.dst_ip, record.src_port, record.dst_port,
+                       record.timestamp, record.length)
+    return groups, reader.packets
+
+def detect_tor_in_pcap(tor_nodes, pcap_file, prefixes=None, watchlist=None):
+    """
+    Match every IP packet of a pcap/pcapng file, read through mmap without
+    loading it whole. Watchlist hits are appended to `watchlist` if given.
+    """
+    groups, packet_count = _match_pcap(tor_nodes, pcap_file, prefixes=prefixes)
+    if watchlist is not None:
+        watchlist.extend(groups.watchlist_hits())
+    return groups.detections(), packet_count
+
+# TOR node map (and relay history, when replaying, and prefixes) of a shard
+# worker process, set once by the pool initializer
+_shard_tor_nodes = {}
+_shard_history = None
+_shard_prefixes = None
+
+def _init_shard_worker(tor_nodes, history=None, prefixes=None):
+    global _shard_tor_nodes, _shard_history, _shard_prefixes
+    _shard_tor_nodes = tor_nodes
+    _shard_history = history
+    _shard_prefixes = prefixes
+    # A forked worker inherits the parent's prefilter counters; only report its own
+    prefilter = relay_prefilter(tor_nodes)
+    if prefilter is not None:
+        prefilter.take_counts()
+
+def _detect_tor_in_shard(task):
+    # Workers only count; geolocation happens once in the parent after merging
+    pcap_file, shard = task
+    groups, packet_count = _match_pcap(_shard_tor_nodes, pcap_file, shard, _shard_history, _shard_prefixes)
+    prefilter = relay_prefilter(_shard_tor_nodes)
+    return groups.groups, packet_count, prefilter.take_counts() if prefilter else None
+
+def detect_tor_in_pcaps(tor_nodes, pcap_files, workers=ANALYSIS_WORKERS, history=None, prefixes=None,
+                        watchlist=None):
+    """
+    Match a list of pcap files (e.g. the segments of one capture run). With
+    workers != 1 each file is split into record-aligned shards of about
+    ANALYSIS_SHARD_BYTES that are matched in a process pool and their groups
+    merged, so the output is the same as a sequential run. With a
+    RelayHistory, packets are matched against the consensus of their time.
+    Watchlist hits are appended to `watchlist` if given.
+    """
+    workers = workers or os.cpu_count()
+    groups = DetectionGroups(tor_nodes, history, prefixes)
+    total_packet_count = 0
+    if workers == 1:
+        for pcap_file in pcap_files:
+            logger.info(f"Detecting TOR usage in pcap: {pcap_file}")
+            file_groups, file_packet_count = _match_pcap(tor_nodes, pcap_file, history=history, prefixes=prefixes)
+            groups.merge(file_groups.groups)
+            total_packet_count += file_packet_count
     else:
-        print("No TOR traffic detected in the capture.")
-        logger.info("No TOR traffic detected.")
-        subprocess.run([sys.executable, "part_a/alerting/alert_system.py"])
+        tasks = []
+        for pcap_file in pcap_files:
+            with PcapReader(pcap_file) as reader:
+                count = max(1, os.path.getsize(pcap_file) // ANALYSIS_SHARD_BYTES)
+                tasks.extend((pcap_file, shard) for shard in reader.shards(count))
+        logger.info(f"Detecting TOR usage in {len(pcap_files)} pcap(s) as {len(tasks)} shard(s) on {workers} workers")
+        with multiprocessing.Pool(workers, initializer=_init_shard_worker,
+                                  initargs=(tor_nodes, history, prefixes)) as pool:
+            prefilter = relay_prefilter(tor_nodes)
+            for shard_groups, shard_packet_count, prefilter_counts in pool.imap(_detect_tor_in_shard, tasks):
+                groups.merge(shard_groups)
+                total_packet_count += shard_packet_count
+                if prefilter and prefilter_counts:
+                    prefilter.add_counts(prefilter_counts)
+    if watchlist is not None:
+        watchlist.extend(groups.watchlist_hits())
+    return groups.detections(), total_packet_count
 
-    # --- Save detection results to JSON ---
+def detect_tor_in_flows(tor_nodes, flow_file, prefixes=None, watchlist=None):
+    """Match flow records from a flows-mode capture, grouped like packets are"""
+    from part_a.network_capture.flow_aggregator import load_flow_records
+    groups = DetectionGroups(tor_nodes, prefixes=prefixes)
+    total_packet_count = 0
+    for flow in load_flow_records(flow_file):
+        total_packet_count += flow['packets']
+        groups.add(flow['src_ip'], flow['dst_ip'], flow['src_port'], flow['dst_port'],
+                   flow['first_seen'], flow['volume'], packets=flow['packets'], last_seen=flow['last_seen'])
+    if watchlist is not None:
+        watchlist.extend(groups.watchlist_hits())
+    return groups.detections(), total_packet_count
+
+class _PrefixBuilder(threading.Thread):
+    """Builds RelayPrefixes over a swapped-in relay store off the packet path"""
+
+    def __init__(self, relay_nodes):
+        super().__init__(daemon=True)
+        self.relay_nodes = relay_nodes
+        self.prefixes = None
+
+    def run(self):
+        self.prefixes = load_relay_prefixes(self.relay_nodes)
+
+def detect_tor_stream(tor_nodes, packet_queue, on_detection=None, prefixes=None, watchlist=None,
+                      prefilter_stats=None):
+    """
+    Match PacketRecords from packet_queue against TOR nodes as they arrive,
+    until STREAM_END is received.
+
+    Packets are grouped like detect_tor_in_pcap does; on_detection is called
+    once per new relay group, so memory grows with the number of groups rather
+    than the number of packets.
+
+    Every RELAY_RELOAD_INTERVAL seconds a relay store written since is mapped
+    and swapped in between two packets, keeping the groups built so far.
+    Prefixes, if given, are rebuilt over the new store's relays in a
+    background thread and swapped in once complete; until then the old
+    ones keep labelling.
+    Address prefilter statistics, carried across swaps, are written to
+    `prefilter_stats` if given.
+    """
+    groups = DetectionGroups(tor_nodes, prefixes=prefixes)
+    total_packet_count = 0
+    next_reload = time.monotonic() + RELAY_RELOAD_INTERVAL
+    builder = None
+    while True:
+        record = packet_queue.get()
+        if record is STREAM_END:
+            break
+        total_packet_count += 1
+        if builder is not None and not builder.is_alive():
+            groups.prefixes = builder.prefixes or groups.prefixes
+            builder = None
+        if RELAY_RELOAD_INTERVAL and time.monotonic() >= next_reload:
+            next_reload = time.monotonic() + RELAY_RELOAD_INTERVAL
+            relay_nodes = reopen_relay_nodes(groups.tor_nodes, DATABASE_FILE, RELAY_STORE_FILE)
+            if relay_nodes is not groups.tor_nodes:
+                if relay_prefilter(groups.tor_nodes) and relay_prefilter(relay_nodes):
+                    relay_prefilter(relay_nodes).add_counts(relay_prefilter(groups.tor_nodes).take_counts())
+                groups.tor_nodes = relay_nodes
+                if groups.prefixes is not None:
+                    # A build for an older store is left to finish and discarded
+                    builder = _PrefixBuilder(relay_nodes)
+                    builder.start()
+                logger.info(f"Swapped in updated relay store ({len(relay_nodes)} relay addresses)")
+        key = groups.add(record.src_ip, record.dst_ip, record.src_port, record.dst_port,
+                         record.timestamp, record.length)
+        if key and on_detection and key[3] != "watchlist":
+            on_detection(groups.detection(key))
+    if builder is not None:
+        # The stream is over, so the final labels can wait for the current relays
+        builder.join()
+        groups.prefixes = builder.prefixes or groups.prefixes
+    if watchlist is not None:
+        watchlist.extend(groups.watchlist_hits())
+    if prefilter_stats is not None and relay_prefilter(groups.tor_nodes):
+        prefilter_stats.update(relay_prefilter(groups.tor_nodes).stats())
+    return groups.detections(), total_packet_count
+
+def alert_detection(detection):
+    """Raise an alert for a newly seen TOR connection during streaming detection"""
+    from alerting.alert_system import send_alert
+    node = detection["entry_node"] or detection["exit_node"]
+    role = "ENTRY" if detection["entry_node"] else "EXIT"
+    send_alert(f"TOR traffic detected: {role} {node['ip']} (User: {detection['user_ip']})", "INFO")
+
+def run_stream_detection(tor_nodes, interface, duration_sec, prefixes=None, watchlist=None):
+    """Capture and detect concurrently through a bounded queue instead of a pcap file"""
+    from part_a.network_capture.capture import stream_packets
+    from part_a.network_capture.multi_capture import stream_interfaces, interface_list
+    from part_a.network_capture.bpf_filter import resolve_capture_filter, load_relay_endpoints
+    from part_a.network_capture.overload import SheddingQueue
+    # Under overload keep packets on the relays' own OR ports as well as the usual TOR ports
+    _, relay_ports = load_relay_endpoints()
+    packet_queue = SheddingQueue(MAX_PACKETS_IN_MEMORY, tor_ports=set(TOR_PORTS) | relay_ports)
+    capture_stats = {}
+    prefilter_stats = {}
+    # Several interfaces are captured in worker processes and merged into one stream
+    producer = threading.Thread(
+        target=stream_interfaces if len(interface_list(interface)) > 1 else stream_packets,
+        args=(interface, duration_sec, packet_queue, resolve_capture_filter(CAPTURE_FILTER)),
+        kwargs={'backend': CAPTURE_BACKEND, 'stats': capture_stats},
+        daemon=True
+    )
+    producer.start()
+    detections, total_packet_count = detect_tor_stream(tor_nodes, packet_queue, on_detection=alert_detection,
+                                                       prefixes=prefixes, watchlist=watchlist,
+                                                       prefilter_stats=prefilter_stats)
+    producer.join()
+    capture_stats["load_shedding"] = packet_queue.stats()
+    if prefilter_stats:
+        capture_stats["relay_prefilter"] = prefilter_stats
+    return detections, total_packet_count, capture_stats
+
+def save_detection_results(detections, total_packet_count, json_path="part_a/tor_detection/detection_results.json", capture_stats=None, watchlist_hits=None, prefilter_stats=None):
+    tor_packet_count = sum(det.get("packets", 1) for det in detections)
     output = {
         "case_id": f"TOR-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
         "timestamp": datetime.now().isoformat(),
         "investigator": "TOR Analysis System",
         "summary": {
             "total_packets": total_packet_count,
-            "tor_packets": len(detections),
+            "tor_packets": tor_packet_count,
             "connections": len(detections),
             "paths": 0,
             "avg_confidence": 100 if detections else 0
@@ -149,7 +447,7 @@ def main():
         "detections": detections,
         "paths": [],
         "statistics": {
-            "detection_rate": (len(detections)/total_packet_count*100) if total_packet_count else 0,
+            "detection_rate": (tor_packet_count/total_packet_count*100) if total_packet_count else 0,
             "high_confidence": len(detections),
             "medium_confidence": 0,
             "low_confidence": 0,
@@ -158,10 +456,99 @@ def main():
             "unique_exits": len({det['exit_node']['ip'] for det in detections if det['exit_node']})
         }
     }
-    json_path = "part_a/tor_detection/detection_results.json"
+    if capture_stats:
+        output["capture_stats"] = capture_stats
+    if watchlist_hits:
+        output["watchlist_hits"] = watchlist_hits
+    if prefilter_stats:
+        output["relay_prefilter"] = prefilter_stats
+    output["geolocation_cache"] = get_geolocation_service().stats()
     with open(json_path, "w") as f:
         json.dump(output, f, indent=2)
     print(f"[INFO] Detection results written to {json_path}")
 
+def main():
+    parser = argparse.ArgumentParser(description="Detect TOR traffic in captured packets")
+    parser.add_argument("--stream", action="store_true", default=CAPTURE_MODE == "stream",
+                        help="capture and detect live instead of reading the latest pcap")
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS,
+                        help="processes for pcap analysis (1 = in-process, 0 = one per CPU)")
+    parser.add_argument("--as-of-capture", action="store_true",
+                        help="match packets against the consensus in force when they were captured "
+                             "(relay history) instead of the current relay list")
+    parser.add_argument("pcap", nargs="*",
+                        help="pcap/pcapng files to analyse instead of the latest capture run")
+    args = parser.parse_args()
+
+    logger.info("Starting TOR traffic detection")
+    tor_nodes = load_tor_node_ips()
+    if not tor_nodes:
+        print("No TOR IPs loaded. Exiting detection.")
+        return
+    prefixes = load_relay_prefixes(tor_nodes)
+    watchlist_hits = []
+
+    if args.stream:
+        logger.info(f"Streaming TOR detection on {CAPTURE_INTERFACE} for {TIMEOUT} seconds")
+        detections, total_packet_count, capture_stats = run_stream_detection(
+            tor_nodes, CAPTURE_INTERFACE, TIMEOUT, prefixes=prefixes, watchlist=watchlist_hits)
+        print(f"Streaming detection finished: {len(detections)} TOR connection(s) in {total_packet_count} packets")
+        save_detection_results(detections, total_packet_count, capture_stats=capture_stats,
+                               watchlist_hits=watchlist_hits)
+        return
+
+    if CAPTURE_MODE == "flows":
+        if not os.path.exists(FLOW_FILE):
+            print("No flow records found in logs. Run capture first.")
+            return
+        logger.info(f"Detecting TOR usage in flow records: {FLOW_FILE}")
+        detections, total_packet_count = detect_tor_in_flows(tor_nodes, FLOW_FILE, prefixes, watchlist_hits)
+        print(f"TOR traffic detected in {len(detections)} flow(s) out of {total_packet_count} packets")
+        save_detection_results(detections, total_packet_count, watchlist_hits=watchlist_hits,
+                               prefilter_stats=relay_prefilter_stats(tor_nodes))
+        return
+
+    pcap_files = args.pcap or get_latest_capture_files()
+    if not pcap_files:
+        print("No capture pcap files found in logs. Run capture first.")
+        return
+
+    history = None
+    if args.as_of_capture:
+        from part_a.tor_database.relay_history import RelayHistory
+        history = RelayHistory()
+        if history:
+            logger.info(f"Matching against {len(history)} relay snapshot(s) from {HISTORY_DIR}")
+        else:
+            print(f"No relay history in {HISTORY_DIR}, matching against the current relay list")
+            history = None
+
+    detections, total_packet_count = detect_tor_in_pcaps(tor_nodes, pcap_files, args.workers, history,
+                                                         prefixes, watchlist_hits)
+
+    if detections:
+        print(f"TOR traffic detected in {len(detections)} connection(s):")
+        for det in detections:
+            if det["entry_node"]:
+                print(f"- ENTRY {det['entry_node']['ip']}:{det['relay_port']} (User: {det['user_ip']}, {det['packets']} packets)")
+            if det["exit_node"]:
+                print(f"- EXIT {det['exit_node']['ip']}:{det['relay_port']} (User: {det['user_ip']}, {det['packets']} packets)")
+        logger.info(f"TOR traffic detected: {detections}")
+        ips_str = " ".join(sorted({det["user_ip"] for det in detections}))
+        subprocess.run([sys.executable, "part_a/alerting/alert_system.py", ips_str])
+    else:
+        print("No TOR traffic detected in the capture.")
+        logger.info("No TOR traffic detected.")
+        subprocess.run([sys.executable, "part_a/alerting/alert_system.py"])
+    if watchlist_hits:
+        print(f"{len(watchlist_hits)} connection(s) to watchlist prefixes:")
+        for hit in watchlist_hits:
+            print(f"- {hit['remote_ip']}:{hit['remote_port']} in {hit['prefix']} "
+                  f"({', '.join(hit['watchlist'])}; User: {hit['user_ip']}, {hit['packets']} packets)")
+
+    # --- Save detection results to JSON ---
+    save_detection_results(detections, total_packet_count, watchlist_hits=watchlist_hits,
+                           prefilter_stats=relay_prefilter_stats(tor_nodes))
+
 if __name__ == "__main__":
     main()
@@ -3,7 +3,8 @@ B3: Timing Correlation
 Matches entry and exit node connections based on timing proximity
 """
 
-from datetime import datetime, timedelta
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
 import logging
 import os
 
@@ -16,6 +17,24 @@ with open(config_path) as f:
 logging.basicConfig(filename=config['LOG_FILE'], level=getattr(logging, config['LOG_LEVEL']))
 logger = logging.getLogger(__name__)
 
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+def to_microseconds(timestamp):
+    """
+    Integer microseconds since the epoch for an ISO timestamp string, a
+    datetime or epoch seconds (as in capture records). Naive times are
+    local time, as datetime.fromtimestamp(...).isoformat() writes them in
+    flow records and detections, so all three forms share one clock.
+    """
+    if isinstance(timestamp, (int, float)):
+        return round(timestamp * 1_000_000)
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.astimezone()
+    return (timestamp - EPOCH_UTC) // MICROSECOND
+
 class TimingCorrelation:
     def __init__(self, entries, exits):
         """
@@ -28,20 +47,35 @@ class TimingCorrelation:
         self.timing_tolerance = config['TIMING_TOLERANCE']
     
     def correlate(self):
+        """
+        Every (entry, exit) pair at most TIMING_WINDOW + TIMING_TOLERANCE
+        seconds apart, ordered by entry and then exit as given.
+
+        Timestamps are parsed once and the exits sorted by time, so each
+        entry finds its window by binary search: O((N + M) log M + matches)
+        instead of comparing every entry with every exit.
+        """
+        limit = round((self.timing_window + self.timing_tolerance) * 1_000_000)
+        exit_times = sorted((to_microseconds(exit['timestamp']), i) for i, exit in enumerate(self.exits))
+        times = [exit_time for exit_time, _ in exit_times]
+
         correlations = []
         for entry in self.entries:
-            entry_time = datetime.fromisoformat(entry['timestamp'])
-            for exit in self.exits:
-                exit_time = datetime.fromisoformat(exit['timestamp'])
-                delta = abs((exit_time - entry_time).total_seconds())
-                
-                if delta <= self.timing_window + self.timing_tolerance:
-                    logger.info(f"Timing match found: Entry {entry['entry_node']['ip_address']} and Exit {exit['exit_node']['ip_address']} with delta {delta:.2f} seconds")
-                    correlations.append({
-                        'entry': entry,
-                        'exit': exit,
-                        'time_difference': delta
-                    })
+            entry_time = to_microseconds(entry['timestamp'])
+            first = bisect_left(times, entry_time - limit)
+            end = bisect_right(times, entry_time + limit, first)
+            # Back to input order within the window
+            for exit_time, i in sorted(exit_times[first:end], key=lambda item: item[1]):
+                exit = self.exits[i]
+                delta = abs(exit_time - entry_time) / 1_000_000
+                logger.debug(f"Timing match found: Entry {entry['entry_node']['ip_address']} and Exit {exit['exit_node']['ip_address']} with delta {delta:.2f} seconds")
+                correlations.append({
+                    'entry': entry,
+                    'exit': exit,
+                    'time_difference': delta
+                })
+        logger.info(f"Timing correlation: {len(correlations)} match(es) between {len(self.entries)} entries "
+                    f"and {len(self.exits)} exits")
         return correlations
 
 def main():
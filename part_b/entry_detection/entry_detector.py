@@ -18,9 +18,12 @@ logger = logging.getLogger(__name__)
 class EntryNodeDetector:
     """Detects entry nodes (guards) in captured traffic"""
     
-    def __init__(self):
-        self.tor_db = TORDatabase()
-        self.tor_db.load_from_file()
+    def __init__(self, tor_db=None):
+        # A loaded TORDatabase can be shared with the other detectors
+        if tor_db is None:
+            tor_db = TORDatabase()
+            tor_db.load_from_file()
+        self.tor_db = tor_db
         self.guard_nodes = self.tor_db.get_guard_nodes()
         logger.info(f"Loaded {len(self.guard_nodes)} guard nodes")
     
@@ -47,22 +50,25 @@ class EntryNodeDetector:
         """
         dst_ip = packet_info.get('dst_ip')
         
-        # Check if destination is a known guard node
-        for node in self.guard_nodes:
-            if node['ip_address'] == dst_ip and node['running']:
-                logger.info(f"✓ Entry node detected: {dst_ip} ({node['country']})")
-                
-                return {
-                    'is_entry': True,
-                    'entry_node': node,
-                    'user_ip': packet_info.get('src_ip'),
-                    'timestamp': packet_info.get('timestamp'),
-                    'connection': {
-                        'src_port': packet_info.get('src_port'),
-                        'dst_port': packet_info.get('dst_port')
-                    }
-                }
-        
+        # Check if destination is a known running guard node
+        node = self.tor_db.index.running_guard(dst_ip)
+        if node:
+            logger.info(f"✓ Entry node detected: {dst_ip} ({node['country']})")
+            
+            return {
+                'is_entry': True,
+                'entry_node': node,
+                'user_ip': packet_info.get('src_ip'),
+                'timestamp': packet_info.get('timestamp'),
+                'connection': {
+                    'src_port': packet_info.get('src_port'),
+                    'dst_port': packet_info.get('dst_port')
+                },
+                # Only set for flow records (see part_a flow_aggregator)
+                'volume': packet_info.get('volume', 0),
+                'flow': packet_info if 'packets' in packet_info else None
+            }
+    
         return {
             'is_entry': False,
             'entry_node': None
@@ -73,7 +79,8 @@ class EntryNodeDetector:
         Find all entry node connections in captured traffic
         
         Args:
-            captured_packets: List of packet info dictionaries
+            captured_packets: List of packet info dictionaries, or flow records
+                from part_a.network_capture.flow_aggregator.load_flow_records
         
         Returns:
             List of entry node detections
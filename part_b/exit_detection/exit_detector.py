@@ -18,9 +18,12 @@ logger = logging.getLogger(__name__)
 class ExitNodeDetector:
     """Detects exit nodes in captured traffic"""
     
-    def __init__(self):
-        self.tor_db = TORDatabase()
-        self.tor_db.load_from_file()
+    def __init__(self, tor_db=None):
+        # A loaded TORDatabase can be shared with the other detectors
+        if tor_db is None:
+            tor_db = TORDatabase()
+            tor_db.load_from_file()
+        self.tor_db = tor_db
         self.exit_nodes = self.tor_db.get_exit_nodes()
         logger.info(f"Loaded {len(self.exit_nodes)} exit nodes")
     
@@ -45,22 +48,25 @@ class ExitNodeDetector:
         """
         src_ip = packet_info.get('src_ip')
         
-        # Check if source is a known exit node
-        for node in self.exit_nodes:
-            if node['ip_address'] == src_ip and node['running']:
-                logger.info(f"✓ Exit node detected: {src_ip} ({node['country']})")
-                
-                return {
-                    'is_exit': True,
-                    'exit_node': node,
-                    'destination': packet_info.get('dst_ip'),
-                    'timestamp': packet_info.get('timestamp'),
-                    'connection': {
-                        'src_port': packet_info.get('src_port'),
-                        'dst_port': packet_info.get('dst_port')
-                    }
-                }
-        
+        # Check if source is a known running exit node
+        node = self.tor_db.index.running_exit(src_ip)
+        if node:
+            logger.info(f"✓ Exit node detected: {src_ip} ({node['country']})")
+            
+            return {
+                'is_exit': True,
+                'exit_node': node,
+                'destination': packet_info.get('dst_ip'),
+                'timestamp': packet_info.get('timestamp'),
+                'connection': {
+                    'src_port': packet_info.get('src_port'),
+                    'dst_port': packet_info.get('dst_port')
+                },
+                # Only set for flow records (see part_a flow_aggregator)
+                'volume': packet_info.get('volume', 0),
+                'flow': packet_info if 'packets' in packet_info else None
+            }
+    
         return {
             'is_exit': False,
             'exit_node': None
@@ -71,7 +77,8 @@ class ExitNodeDetector:
         Find all exit node connections in captured traffic
         
         Args:
-            captured_packets: List of packet info dictionaries
+            captured_packets: List of packet info dictionaries, or flow records
+                from part_a.network_capture.flow_aggregator.load_flow_records
         
         Returns:
             List of exit node detections
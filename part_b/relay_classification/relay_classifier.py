@@ -0,0 +1,183 @@
+"""
+B6: Relay Classification
+Finds entry (guard) and exit node connections in one pass over captured
+traffic, instead of one pass per role
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from part_a.tor_database.fetch_nodes import TORDatabase
+from part_a.tor_database.relay_index import ip_key, node_addresses
+from datetime import datetime
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+GUARD = 0
+EXIT = 1
+
+
+class RelayClassifier:
+    """
+    Classifies packets or flow records against a single role-tagged index:
+    ip key -> [running guard node, running exit node] (either may be None),
+    built once from the TOR database, so each packet costs one lookup per
+    address. Detections reference the index's node dicts, one per relay,
+    rather than carrying copies.
+
+    Detections have the same shape as EntryNodeDetector.identify_entry_node
+    and ExitNodeDetector.identify_exit_node results. The index is rebuilt
+    when the database swaps in a new relay index (TORDatabase.generation).
+    """
+
+    def __init__(self, tor_db=None):
+        if tor_db is None:
+            tor_db = TORDatabase()
+            tor_db.load_from_file()
+        self.tor_db = tor_db
+        self.roles = {}
+        self.generation = None
+        self._build()
+
+    def _build(self):
+        roles = {}
+        # Node list order, so the relay chosen for a shared address is the one
+        # index.running_guard() / running_exit() would return
+        for node in self.tor_db.index.running_nodes:
+            guard, exit = node.get('is_guard'), node.get('is_exit')
+            if not (guard or exit):
+                continue
+            for ip, _ in node_addresses(node):
+                key = ip_key(ip)
+                if key is None:
+                    continue
+                tagged = roles.setdefault(key, [None, None])
+                if guard and tagged[GUARD] is None:
+                    tagged[GUARD] = node
+                if exit and tagged[EXIT] is None:
+                    tagged[EXIT] = node
+        self.roles = roles
+        self.generation = self.tor_db.generation
+        logger.info(f"Role index holds {len(roles)} guard/exit addresses")
+
+    def identify(self, packet_info):
+        """(entry detection or None, exit detection or None) for one packet or flow record"""
+        if self.generation != self.tor_db.generation:
+            self._build()
+        src = self.roles.get(ip_key(packet_info.get('src_ip')))
+        dst = self.roles.get(ip_key(packet_info.get('dst_ip')))
+        entry = self._entry(packet_info, dst[GUARD]) if dst and dst[GUARD] else None
+        exit = self._exit(packet_info, src[EXIT]) if src and src[EXIT] else None
+        return entry, exit
+
+    def classify(self, captured_packets):
+        """
+        Walk captured_packets (packet info dicts, or flow records from
+        part_a.network_capture.flow_aggregator.load_flow_records) once
+
+        Returns:
+            {'entries': entry detections, 'exits': exit detections}, each in packet order
+        """
+        if self.generation != self.tor_db.generation:
+            self._build()
+        roles = self.roles.get
+        entries = []
+        exits = []
+
+        for packet in captured_packets:
+            # Most traffic touches no relay: two dict lookups and on to the next
+            dst = roles(ip_key(packet.get('dst_ip')))
+            if dst is not None and dst[GUARD] is not None:
+                entries.append(self._entry(packet, dst[GUARD]))
+            src = roles(ip_key(packet.get('src_ip')))
+            if src is not None and src[EXIT] is not None:
+                exits.append(self._exit(packet, src[EXIT]))
+
+        logger.info(f"Found {len(entries)} entry and {len(exits)} exit node connections "
+                    f"in {len(captured_packets)} records")
+        return {'entries': entries, 'exits': exits}
+
+    @staticmethod
+    def _entry(packet_info, node):
+        return {
+            'is_entry': True,
+            'entry_node': node,
+            'user_ip': packet_info.get('src_ip'),
+            'timestamp': packet_info.get('timestamp'),
+            'connection': {
+                'src_port': packet_info.get('src_port'),
+                'dst_port': packet_info.get('dst_port')
+            },
+            'volume': packet_info.get('volume', 0),
+            'flow': packet_info if 'packets' in packet_info else None
+        }
+
+    @staticmethod
+    def _exit(packet_info, node):
+        return {
+            'is_exit': True,
+            'exit_node': node,
+            'destination': packet_info.get('dst_ip'),
+            'timestamp': packet_info.get('timestamp'),
+            'connection': {
+                'src_port': packet_info.get('src_port'),
+                'dst_port': packet_info.get('dst_port')
+            },
+            'volume': packet_info.get('volume', 0),
+            'flow': packet_info if 'packets' in packet_info else None
+        }
+
+
+def main():
+    """Test combined entry/exit classification"""
+    print("="*70)
+    print("PART B - B6: Relay Classification")
+    print("="*70)
+
+    classifier = RelayClassifier()
+    guards = classifier.tor_db.get_guard_nodes()
+    exits = classifier.tor_db.get_exit_nodes()
+
+    # Test with sample packets
+    test_packets = [
+        {
+            'src_ip': '192.168.1.100',
+            'dst_ip': guards[0]['ip_address'] if guards else '1.2.3.4',
+            'src_port': 50000,
+            'dst_port': 9001,
+            'timestamp': datetime.now().isoformat()
+        },
+        {
+            'src_ip': exits[0]['ip_address'] if exits else '1.2.3.4',
+            'dst_ip': '172.217.14.206',
+            'src_port': 9001,
+            'dst_port': 443,
+            'timestamp': datetime.now().isoformat()
+        },
+        {
+            'src_ip': '8.8.8.8',  # Not TOR
+            'dst_ip': '1.1.1.1',
+            'src_port': 443,
+            'dst_port': 50001,
+            'timestamp': datetime.now().isoformat()
+        }
+    ]
+
+    print(f"\nTesting with {len(test_packets)} packets...")
+    result = classifier.classify(test_packets)
+
+    print(f"\n{'='*70}")
+    print(f"RESULTS: {len(result['entries'])} entry and {len(result['exits'])} exit nodes detected")
+    print(f"{'='*70}")
+
+    for entry in result['entries']:
+        print(f"\nEntry: {entry['entry_node']['ip_address']} (User: {entry['user_ip']}, {entry['timestamp']})")
+    for exit in result['exits']:
+        print(f"\nExit: {exit['exit_node']['ip_address']} (Destination: {exit['destination']}, {exit['timestamp']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..",
 
 import logging
 from collections import Counter
+from itertools import accumulate
 import statistics
 
 logging.basicConfig(level=logging.INFO)
@@ -121,38 +122,21 @@ class PatternAnalyzer:
         
         return round(similarity, 2)
     
-    def analyze_traffic(self, entry_packets, exit_packets):
-        """
-        Complete pattern analysis of entry and exit traffic
-        """
+    def _analyze_side(self, sizes, timing, packet_count):
+        return {
+            'packet_count': packet_count,
+            'size_pattern': sizes[:10],  # First 10 packets
+            'tor_cells': self.detect_tor_cells(sizes),
+            'bursts': self.analyze_burst_pattern(timing)
+        }
+    
+    def _analyze(self, entry_sizes, entry_timing, entry_count, exit_sizes, exit_timing, exit_count):
         results = {
-            'entry_analysis': {},
-            'exit_analysis': {},
+            'entry_analysis': self._analyze_side(entry_sizes, entry_timing, entry_count),
+            'exit_analysis': self._analyze_side(exit_sizes, exit_timing, exit_count),
             'correlation': {}
         }
         
-        # Analyze entry traffic
-        entry_sizes = self.extract_packet_sizes(entry_packets)
-        entry_timing = self.extract_timing_pattern(entry_packets)
-        
-        results['entry_analysis'] = {
-            'packet_count': len(entry_packets),
-            'size_pattern': entry_sizes[:10],  # First 10 packets
-            'tor_cells': self.detect_tor_cells(entry_sizes),
-            'bursts': self.analyze_burst_pattern(entry_timing)
-        }
-        
-        # Analyze exit traffic
-        exit_sizes = self.extract_packet_sizes(exit_packets)
-        exit_timing = self.extract_timing_pattern(exit_packets)
-        
-        results['exit_analysis'] = {
-            'packet_count': len(exit_packets),
-            'size_pattern': exit_sizes[:10],
-            'tor_cells': self.detect_tor_cells(exit_sizes),
-            'bursts': self.analyze_burst_pattern(exit_timing)
-        }
-        
         # Compare patterns
         pattern_similarity = self.compare_patterns(entry_sizes, exit_sizes)
         
@@ -164,6 +148,30 @@ class PatternAnalyzer:
         logger.info(f"Pattern analysis complete - Similarity: {pattern_similarity}%")
         
         return results
+    
+    def analyze_traffic(self, entry_packets, exit_packets):
+        """
+        Complete pattern analysis of entry and exit traffic
+        """
+        return self._analyze(
+            self.extract_packet_sizes(entry_packets), self.extract_timing_pattern(entry_packets), len(entry_packets),
+            self.extract_packet_sizes(exit_packets), self.extract_timing_pattern(exit_packets), len(exit_packets)
+        )
+    
+    def flow_timing_pattern(self, flow):
+        """Offsets from the first packet, as extract_timing_pattern gives, from a flow's inter-arrival times"""
+        return list(accumulate(flow.get('intervals', [])))
+    
+    def analyze_flows(self, entry_flow, exit_flow):
+        """
+        Complete pattern analysis from two flow records (see part_a flow_aggregator)
+        instead of full packet lists. Sizes and timing come from the truncated
+        vectors in the records; packet counts are the flows' full counts.
+        """
+        return self._analyze(
+            entry_flow.get('sizes', []), self.flow_timing_pattern(entry_flow), entry_flow.get('packets', 0),
+            exit_flow.get('sizes', []), self.flow_timing_pattern(exit_flow), exit_flow.get('packets', 0)
+        )
 
 
 def main():
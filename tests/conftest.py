@@ -0,0 +1,67 @@
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+# Modules log to files under part_a/logs from import time, as when run from the root
+os.makedirs(os.path.join(ROOT, "part_a", "logs"), exist_ok=True)
+
+
+def make_node(i, ip, port=9001, **fields):
+    """A TORDatabase-shaped node dict"""
+    node = {
+        'fingerprint': '%040X' % (i + 1),
+        'nickname': f'relay{i}',
+        'ip_address': ip,
+        'or_port': port,
+        'or_addresses': [[ip, port]],
+        'exit_addresses': [],
+        'country': 'de',
+        'country_name': 'Germany',
+        'lat': 52.5,
+        'lon': 13.4,
+        'as_number': 'AS3320',
+        'as_name': 'Example AS',
+        'bandwidth': 1000 + i,
+        'flags': ['Running', 'Valid'],
+        'last_seen': '2024-01-01 00:00:00',
+        'running': True,
+        'is_guard': False,
+        'is_exit': False,
+    }
+    node.update(fields)
+    return node
+
+
+@pytest.fixture
+def shared_nodes():
+    """
+    Relays drawn from small address pools, so primary, secondary (IPv6)
+    and exit addresses are shared between relays in every combination
+    """
+    rng = random.Random(3)
+    pool4 = [f'10.0.0.{i}' for i in range(60)]
+    pool6 = [f'2001:db8::{i:x}' for i in range(30)]
+    nodes = []
+    for i in range(400):
+        ip = rng.choice(pool4)
+        port = rng.choice([9001, 443])
+        or_addresses = [[ip, port]]
+        if rng.random() < 0.5:
+            or_addresses.append([rng.choice(pool6), port])
+        if rng.random() < 0.2:
+            or_addresses.append([ip, 9030])
+        guard, exit = rng.random() < 0.5, rng.random() < 0.3
+        nodes.append(make_node(
+            i, ip, port,
+            or_addresses=or_addresses,
+            exit_addresses=[rng.choice(pool4)] if rng.random() < 0.3 else [],
+            running=rng.random() < 0.7,
+            is_guard=guard,
+            is_exit=exit,
+            flags=['Running'] + (['Guard'] if guard else []) + (['Exit'] if exit else []),
+        ))
+    return nodes, pool4 + pool6
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+from part_a.geolocation.async_resolver import (AsyncGeolocationResolver, IpApiBackend, IpApiBatchBackend,
+                                               TokenBucket, start_stub_server)
+from part_a.geolocation.geolocation import GeolocationCache, GeolocationService, UNKNOWN
+
+
+@pytest.fixture(scope='module')
+def base_url():
+    server, base_url = start_stub_server()
+    yield base_url
+    server.shutdown()
+
+
+def fast_bucket():
+    return TokenBucket(rate=1000, burst=1000)
+
+
+class CountingBatchBackend(IpApiBatchBackend):
+    def __init__(self, url):
+        super().__init__(url=url)
+        self.batches = []
+
+    def fetch(self, ips):
+        self.batches.append(list(ips))
+        return super().fetch(ips)
+
+
+def test_batch_backend_dedups_and_splits_batches(base_url):
+    ips = [f'203.0.{i // 256}.{i % 256}' for i in range(250)] + ['0.0.0.1']
+    backend = CountingBatchBackend(f'{base_url}/batch')
+    resolver = AsyncGeolocationResolver(backend, concurrency=4, bucket=fast_bucket())
+    locations = resolver.resolve_sync(ips + ips[:50])
+
+    assert sorted(len(batch) for batch in backend.batches) == [51, 100, 100]
+    assert sorted(ip for batch in backend.batches for ip in batch) == sorted(ips)
+    assert resolver.requests == 3 and resolver.failed_requests == 0
+    assert set(locations) == set(ips)
+    # The stub answers 0.x with status "fail": known to the API, but unresolvable
+    assert locations['0.0.0.1'] is None
+    assert locations['203.0.0.7'] == {'lat': 0.7, 'lon': -0.7, 'country': 'Stubland'}
+
+
+def test_single_backend_sends_each_ip_once(base_url):
+    ips = [f'198.51.100.{i}' for i in range(20)] + ['0.0.0.2']
+    resolver = AsyncGeolocationResolver(IpApiBackend(url=f'{base_url}/json/{{ip}}'), bucket=fast_bucket())
+    locations = resolver.resolve_sync(ips * 3)
+
+    assert resolver.requests == len(ips)
+    assert locations['0.0.0.2'] is None
+    assert locations['198.51.100.19']['lat'] == 1.9
+
+
+def test_failed_requests_are_left_out():
+    server, dead_url = start_stub_server()
+    server.shutdown()
+    server.server_close()
+    resolver = AsyncGeolocationResolver(IpApiBatchBackend(url=f'{dead_url}/batch', timeout=1), bucket=fast_bucket())
+
+    assert resolver.resolve_sync(['203.0.113.1', '203.0.113.2']) == {}
+    assert resolver.requests == resolver.failed_requests == 1
+
+
+def test_token_bucket_limits_request_rate(base_url):
+    bucket = TokenBucket(rate=20, burst=2)
+    resolver = AsyncGeolocationResolver(IpApiBackend(url=f'{base_url}/json/{{ip}}'), concurrency=8, bucket=bucket)
+    start = time.monotonic()
+    resolver.resolve_sync([f'198.51.100.{i}' for i in range(8)])
+
+    # Two requests go out at once, the other six wait 1/20 s each
+    assert time.monotonic() - start >= 6 / 20 * 0.9
+    assert resolver.requests == 8
+
+
+def test_token_bucket_allows_burst():
+    bucket = TokenBucket(rate=1, burst=5)
+
+    async def take(count):
+        for _ in range(count):
+            await bucket.acquire()
+    start = time.monotonic()
+    asyncio.run(take(5))
+    assert time.monotonic() - start < 0.5
+
+
+def test_service_resolves_misses_once_and_caches_them(base_url, tmp_path):
+    backend = CountingBatchBackend(f'{base_url}/batch')
+    resolver = AsyncGeolocationResolver(backend, bucket=fast_bucket())
+    cache = GeolocationCache(db_file=str(tmp_path / 'geo.db'))
+    service = GeolocationService(cache=cache, geoip_db=None, resolver=resolver)
+    ips = [f'8.8.{i // 256}.{i % 256}' for i in range(150)] + ['10.0.0.1']
+
+    first = service.lookup_many(ips + ips[:10])
+    second = service.lookup_many(ips)
+
+    assert first == second
+    assert first['10.0.0.1'] is UNKNOWN
+    assert first['8.8.0.42']['country'] == 'Stubland'
+    # Private IPs never reach the resolver, and the second call is served from the cache
+    assert sorted(len(batch) for batch in backend.batches) == [50, 100]
+    assert service.stats()['api_lookups'] == 150 and service.stats()['api_requests'] == 2
+    service.close()
@@ -0,0 +1,178 @@
+import queue
+import random
+import socket
+import struct
+import threading
+
+import pytest
+
+from conftest import make_node
+from part_a.network_capture.pcap_writer import PcapWriter
+from part_a.network_capture.records import PacketRecord, STREAM_END
+from part_a.tor_database.relay_store import RelayStore, write_relay_store
+from part_a.tor_detection import detector
+
+
+class NoGeolocation:
+    def lookup(self, ip):
+        return {'country': 'Unknown', 'lat': 0, 'lon': 0}
+
+    def lookup_many(self, ips):
+        return {ip: self.lookup(ip) for ip in ips}
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(detector, 'get_geolocation_service', NoGeolocation)
+    nodes = [make_node(i, f'10.0.{i // 250}.{i % 250}', is_guard=True) for i in range(500)]
+    filename = str(tmp_path / 'relays.bin')
+    write_relay_store(nodes, filename)
+    return RelayStore(filename)
+
+
+def frame(src, dst, src_port, dst_port):
+    """Ethernet + IPv4 + TCP headers"""
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, 6, 0, socket.inet_aton(src), socket.inet_aton(dst))
+    tcp = struct.pack('!HHIIBBHHH', src_port, dst_port, 0, 0, 0x50, 0x10, 0, 0, 0)
+    return b'\x00' * 12 + b'\x08\x00' + ip + tcp
+
+
+def traffic(count, seed=0):
+    """(timestamp, src, dst, src_port, dst_port), about one packet in ten to or from a relay"""
+    rng = random.Random(seed)
+    packets = []
+    for i in range(count):
+        user = f'192.168.{rng.randrange(4)}.{rng.randrange(250)}'
+        if rng.random() < 0.1:
+            remote = f'10.0.{rng.randrange(2)}.{rng.randrange(250)}'
+        else:
+            remote = f'8.8.{rng.randrange(250)}.{rng.randrange(250)}'
+        packet = (1700000000 + i * 0.001, user, remote, 40000 + i % 100, 9001)
+        packets.append(packet if rng.random() < 0.5 else (packet[0], remote, user, 9001, packet[3]))
+    return packets
+
+
+def write_pcap(filename, packets):
+    with PcapWriter(filename) as writer:
+        for timestamp, src, dst, src_port, dst_port in packets:
+            writer.write(timestamp, frame(src, dst, src_port, dst_port))
+
+
+def test_sharded_detection_matches_sequential(store, tmp_path, monkeypatch):
+    pcaps = [str(tmp_path / f'capture{i}.pcap') for i in range(2)]
+    for i, pcap in enumerate(pcaps):
+        write_pcap(pcap, traffic(5000, seed=i))
+    monkeypatch.setattr(detector, 'ANALYSIS_SHARD_BYTES', 50000)
+
+    sequential, sequential_count = detector.detect_tor_in_pcaps(store, pcaps, workers=1)
+    sharded, sharded_count = detector.detect_tor_in_pcaps(store, pcaps, workers=3)
+
+    assert sequential_count == sharded_count == 10000
+    assert sequential and sharded == sequential
+
+
+def test_stream_detection_matches_pcap(store, tmp_path):
+    packets = traffic(2000)
+    pcap = str(tmp_path / 'capture.pcap')
+    write_pcap(pcap, packets)
+    expected, _ = detector.detect_tor_in_pcap(store, pcap)
+
+    packet_queue = queue.Queue()
+    for timestamp, src, dst, src_port, dst_port in packets:
+        packet_queue.put(PacketRecord(timestamp, src, dst, src_port, dst_port, 6, 54))
+    packet_queue.put(STREAM_END)
+    seen = []
+    detections, count = detector.detect_tor_stream(store, packet_queue, on_detection=seen.append)
+
+    assert count == 2000
+    assert [(d['user_ip'], d['entry_node'], d['exit_node'], d['packets']) for d in detections] == \
+        [(d['user_ip'], d['entry_node'], d['exit_node'], d['packets']) for d in expected]
+    assert len(seen) == len(detections)
+
+
+def test_sharded_prefilter_counts_each_lookup_once(store, tmp_path, monkeypatch):
+    pcaps = [str(tmp_path / f'capture{i}.pcap') for i in range(2)]
+    for i, pcap in enumerate(pcaps):
+        write_pcap(pcap, traffic(5000, seed=i))
+    monkeypatch.setattr(detector, 'ANALYSIS_SHARD_BYTES', 50000)
+
+    detector.detect_tor_in_pcaps(store, pcaps, workers=1)
+    sequential_counts = store.prefilter.take_counts()
+    # Counters left in the parent must not be inherited by the forked workers
+    store.prefilter.add_counts((1000, 1000, 0))
+    detector.detect_tor_in_pcaps(store, pcaps, workers=3)
+    sharded_counts = store.prefilter.take_counts()
+
+    assert sequential_counts[0] >= 10000
+    assert sharded_counts == (sequential_counts[0] + 1000, sequential_counts[1] + 1000, sequential_counts[2])
+
+
+def test_stream_lookups_go_through_prefilter(store):
+    packet_queue = queue.Queue()
+    for timestamp, src, dst, src_port, dst_port in traffic(1000):
+        packet_queue.put(PacketRecord(timestamp, src, dst, src_port, dst_port, 6, 54))
+    packet_queue.put(STREAM_END)
+    prefilter_stats = {}
+    _, count = detector.detect_tor_stream(store, packet_queue, prefilter_stats=prefilter_stats)
+
+    assert prefilter_stats['checked'] >= count
+    assert prefilter_stats['rejected'] > 0
+
+
+def test_store_swap_rebuilds_prefixes_off_the_packet_path(store, tmp_path, monkeypatch):
+    nodes = [make_node(i, f'10.0.{i // 250}.{i % 250}', is_guard=True, as_number='AS64500') for i in range(500)]
+    filename = str(tmp_path / 'updated.bin')
+    write_relay_store(nodes, filename)
+    updated = RelayStore(filename)
+    monkeypatch.setattr(detector, 'RELAY_RELOAD_INTERVAL', 1e-9)
+    monkeypatch.setattr(detector, 'reopen_relay_nodes', lambda relay_nodes, *files: updated)
+
+    released = threading.Event()
+    build = detector.load_relay_prefixes
+    blocked = []
+
+    def slow_prefixes(relay_nodes):
+        # Stands in for a long build: it only ends once packets kept flowing meanwhile
+        blocked.append(not released.wait(timeout=10))
+        return build(relay_nodes)
+    monkeypatch.setattr(detector, 'load_relay_prefixes', slow_prefixes)
+
+    class Packets(queue.Queue):
+        def get(self, *args, **kwargs):
+            if self.qsize() < 500:
+                released.set()
+            return super().get(*args, **kwargs)
+
+    packet_queue = Packets()
+    for timestamp, src, dst, src_port, dst_port in traffic(2000):
+        packet_queue.put(PacketRecord(timestamp, src, dst, src_port, dst_port, 6, 54))
+    packet_queue.put(STREAM_END)
+    detections, count = detector.detect_tor_stream(store, packet_queue, prefixes=build(store))
+
+    assert count == 2000
+    assert blocked == [False]
+    assert detections and all(detection['as_number'] == 'AS64500' for detection in detections)
+
+
+def test_history_replay_still_groups_watchlist_traffic(store, tmp_path):
+    from part_a.tor_database.prefix_trie import RelayPrefixes
+    from part_a.tor_database.relay_history import RelayHistory
+
+    history = RelayHistory(str(tmp_path / 'history'))
+    history.add_snapshot(list(store.nodes), relays_published='2023-11-14 00:00:00')
+    watchlist_file = tmp_path / 'watchlist.txt'
+    watchlist_file.write_text("203.0.113.0/24 hoster\n")
+    prefixes = RelayPrefixes(store.nodes, watchlist_file=str(watchlist_file))
+
+    packets = traffic(1000) + [(1700000100.0, '192.168.0.7', '203.0.113.9', 50000, 443),
+                               (1700000100.5, '203.0.113.9', '192.168.0.7', 443, 50000)]
+    pcap = str(tmp_path / 'capture.pcap')
+    write_pcap(pcap, packets)
+    hits = []
+    detections, _ = detector.detect_tor_in_pcaps(store, [pcap], workers=1, history=history,
+                                                 prefixes=prefixes, watchlist=hits)
+    expected, _ = detector.detect_tor_in_pcaps(store, [pcap], workers=1)
+
+    assert len(detections) == len(expected)
+    assert [(hit['user_ip'], hit['remote_ip'], hit['packets'], hit['watchlist']) for hit in hits] == \
+        [('192.168.0.7', '203.0.113.9', 2, ['hoster'])]
@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip('requests')
+
+from conftest import make_node
+from part_a.tor_database.fetch_nodes import TORDatabase
+from part_a.tor_database.relay_index import RelayIndex
+
+TABLES = ('by_ip', 'by_endpoint', 'by_fingerprint', 'running_guards', 'running_exits')
+
+
+def relays(count=300):
+    return [make_node(i, f'10.0.{i // 250}.{i % 250}', is_guard=i % 2 == 0, is_exit=i % 3 == 0)
+            for i in range(count)]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = TORDatabase()
+    # Every test relay already has a location
+    monkeypatch.setattr(database, 'locate_nodes', lambda nodes: None)
+    database.apply_nodes(relays())
+    return database
+
+
+def assert_matches_rebuild(index):
+    rebuilt = RelayIndex([dict(node) for node in index.nodes])
+    for table in TABLES:
+        assert {key: node['fingerprint'] for key, node in getattr(index, table).items()} == \
+            {key: node['fingerprint'] for key, node in getattr(rebuilt, table).items()}, table
+    for name in ('guard_nodes', 'exit_nodes', 'running_nodes'):
+        assert [node['fingerprint'] for node in getattr(index, name)] == \
+            [node['fingerprint'] for node in getattr(rebuilt, name)], name
+    for name in ('guard_ips', 'exit_ips', 'running_ips', 'countries'):
+        assert getattr(index, name) == getattr(rebuilt, name), name
+    assert index.statistics == rebuilt.statistics
+
+
+def test_first_apply_adds_everything():
+    database = TORDatabase()
+    database.locate_nodes = lambda nodes: None
+    assert database.apply_nodes(relays()) == (300, 0, 0)
+    assert database.generation == 1
+    assert_matches_rebuild(database.index)
+
+
+def test_unindexed_changes_are_not_reindexed(database, monkeypatch):
+    update = [dict(node, bandwidth=node['bandwidth'] + 1, last_seen='2024-01-02 00:00:00') for node in relays()]
+    # Nothing indexed changed, so no address may be re-indexed
+    monkeypatch.setattr(RelayIndex, '_index_ip', lambda self, key: pytest.fail('re-indexed'))
+    assert database.apply_nodes(update) == (0, 0, 0)
+    monkeypatch.undo()
+
+    assert all(node['last_seen'] == '2024-01-02 00:00:00' for node in database.nodes)
+    assert all(node['last_seen'] == '2024-01-02 00:00:00' for node in database.index.by_ip.values())
+    assert all(node['last_seen'] == '2024-01-02 00:00:00' for node in database.index.guard_nodes)
+    assert_matches_rebuild(database.index)
+
+
+def test_incremental_counts(database):
+    update = relays()[5:]                                     # 5 removed
+    update[0] = dict(update[0], is_exit=not update[0]['is_exit'])   # 1 re-indexed
+    update[1] = dict(update[1], ip_address='10.9.9.9', or_addresses=[['10.9.9.9', 9001]])  # 1 re-indexed
+    update[2] = dict(update[2], bandwidth=1)                  # refreshed only
+    update += [make_node(1000 + i, f'10.8.0.{i}') for i in range(3)]   # 3 added
+
+    assert database.apply_nodes(update) == (3, 5, 2)
+    assert len(database.nodes) == 298
+    assert database.index.node_by_ip('10.9.9.9')['fingerprint'] == update[1]['fingerprint']
+    assert database.index.node_by_ip(relays()[6]['ip_address']) is None
+    assert database.index.node_by_fingerprint(update[2]['fingerprint'])['bandwidth'] == 1
+    assert_matches_rebuild(database.index)
+
+
+def test_published_nodes_are_never_modified(database):
+    index, nodes = database.index, list(database.nodes)
+    snapshot = [dict(node) for node in nodes]
+    database.apply_nodes([dict(node, bandwidth=0, running=False) for node in relays()])
+
+    assert database.index is not index
+    assert [dict(node) for node in nodes] == snapshot
+    assert index.running_guard(nodes[0]['ip_address']) is nodes[0]
+    assert index.statistics['running_nodes'] == len(index.running_nodes) == 300
+    assert database.index.running_guard(nodes[0]['ip_address']) is None
+    assert_matches_rebuild(database.index)
+
+
+def test_update_with_shared_addresses(shared_nodes):
+    nodes, _ = shared_nodes
+    original = RelayIndex(list(nodes))
+    index = original.copy()
+    changed = nodes[::7]
+    index.update(changed, [dict(node, is_guard=not node['is_guard'], running=not node['running'], country='fr')
+                           for node in changed])
+    index.update(nodes[1::7])
+    assert_matches_rebuild(index)
+    assert_matches_rebuild(original)
@@ -0,0 +1,63 @@
+import pytest
+
+from part_a.geolocation import geolocation
+from part_a.geolocation.geolocation import GeolocationCache, UNKNOWN
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(geolocation, 'time', clock)
+    return clock
+
+
+def open_cache(tmp_path, **kwargs):
+    return GeolocationCache(db_file=str(tmp_path / 'geo.db'), ttl=100, negative_ttl=10, **kwargs)
+
+
+def test_hits_come_from_memory_then_disk(tmp_path, clock):
+    location = {'lat': 1.5, 'lon': -2.5, 'country': 'Stubland'}
+    cache = open_cache(tmp_path)
+    assert cache.get('203.0.113.1') is None
+    cache.put('203.0.113.1', location)
+    assert cache.get('203.0.113.1') == location
+    cache.close()
+
+    reopened = open_cache(tmp_path)
+    assert reopened.get('203.0.113.1') == location
+    assert reopened.get('203.0.113.1') == location
+    assert cache.stats()['misses'] == 1 and cache.stats()['memory_hits'] == 1
+    assert reopened.stats() == {'lookups': 2, 'memory_hits': 1, 'disk_hits': 1, 'misses': 0, 'hit_rate': 1.0}
+
+
+def test_entries_expire_after_their_ttl(tmp_path, clock):
+    cache = open_cache(tmp_path)
+    cache.put_many({'203.0.113.1': {'lat': 1.0, 'lon': 2.0, 'country': 'Stubland'}, '203.0.113.2': None})
+    # Unresolvable IPs are cached as UNKNOWN, but for the shorter negative TTL
+    assert cache.get('203.0.113.2') is UNKNOWN
+
+    clock.now += 11
+    assert cache.get('203.0.113.2') is None
+    assert cache.get('203.0.113.1') is not None
+    assert open_cache(tmp_path).get('203.0.113.2') is None
+
+    clock.now += 90
+    assert cache.get('203.0.113.1') is None
+    assert cache.purge_expired() == 2
+
+
+def test_lru_evicts_to_disk(tmp_path, clock):
+    cache = open_cache(tmp_path, lru_size=2)
+    for i in range(3):
+        cache.put(f'203.0.113.{i}', {'lat': i, 'lon': i, 'country': 'Stubland'})
+    assert list(cache.memory) == ['203.0.113.1', '203.0.113.2']
+    assert cache.get('203.0.113.0')['lat'] == 0
+    assert cache.stats()['disk_hits'] == 1
@@ -0,0 +1,62 @@
+import json
+import queue
+import random
+from collections import Counter
+
+from part_a.network_capture import capture, multi_capture
+from part_a.network_capture.flow_aggregator import aggregate_stream
+from part_a.network_capture.records import PacketRecord, STREAM_END
+
+
+def mirrored_traffic(seed=0):
+    """Packets per interface: 'span' mirrors everything on 'uplink' 1 ms later and adds its own"""
+    rng = random.Random(seed)
+    uplink, span = [], []
+    for i in range(3000):
+        # 120 s of traffic, so flows go idle and are expired while capturing
+        timestamp = 1700000000 + i * 0.04
+        record = PacketRecord(timestamp, f'192.168.0.{rng.randrange(20)}', f'10.0.0.{rng.randrange(5)}',
+                              40000 + rng.randrange(10), 9001, 6, rng.choice([60, 1500]))
+        uplink.append(record)
+        span.append(record._replace(timestamp=timestamp + 0.001))
+        if i % 3 == 0:
+            span.append(PacketRecord(timestamp + 0.002, '172.16.0.1', f'10.0.0.{rng.randrange(5)}',
+                                     50000 + rng.randrange(5), 443, 6, 100))
+    return {'uplink': uplink, 'span': span}
+
+
+def flow_keys(flows):
+    return Counter((flow['src_ip'], flow['dst_ip'], flow['src_port'], flow['dst_port'], flow['protocol'],
+                    flow['packets'], flow['volume']) for flow in flows)
+
+
+def test_per_interface_flows_match_single_table(tmp_path, monkeypatch):
+    packets = mirrored_traffic()
+
+    def fake_stream_packets(interface, duration_sec, packet_queue, bpf_filter, backend=None, stats=None):
+        for record in packets[interface]:
+            packet_queue.put(record)
+        packet_queue.put(STREAM_END)
+    # Inherited by the forked capture workers
+    monkeypatch.setattr(capture, 'stream_packets', fake_stream_packets)
+
+    flow_file = str(tmp_path / 'flows.jsonl')
+    stats = {}
+    written = multi_capture.aggregate_interfaces(['uplink', 'span'], 1, flow_file, stats=stats)
+    with open(flow_file) as f:
+        merged = [json.loads(line) for line in f]
+
+    # One table over the traffic with the mirrored copies taken out
+    packet_queue = queue.Queue()
+    for record in sorted(packets['uplink'] + [r for r in packets['span'] if r.src_ip == '172.16.0.1']):
+        packet_queue.put(record)
+    packet_queue.put(STREAM_END)
+    expected_file = str(tmp_path / 'expected.jsonl')
+    aggregate_stream(packet_queue, expected_file)
+    with open(expected_file) as f:
+        expected = [json.loads(line) for line in f]
+
+    assert written == len(merged) == len(expected)
+    assert flow_keys(merged) == flow_keys(expected)
+    assert stats['duplicates_suppressed'] == stats['interfaces']['uplink']['flows']
+    assert stats['interfaces']['span']['packets_aggregated'] == len(packets['span'])
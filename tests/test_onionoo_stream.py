@@ -0,0 +1,63 @@
+import json
+import random
+
+import pytest
+
+from part_a.tor_database.onionoo_stream import OnionooStream
+
+DOCUMENT = {
+    'version': '9.0',
+    'relays_published': '2024-01-01 00:00:00',
+    'relays': [
+        {'nickname': 'rélais', 'fingerprint': 'A' * 40, 'or_addresses': ['10.0.0.1:9001', '[2001:db8::1]:443'],
+         'observed_bandwidth': 123456789, 'consensus_weight_fraction': 1.5e-05, 'running': True,
+         'flags': ['Fast', 'Guard'], 'effective_family': []},
+        {'nickname': 'empty', 'or_addresses': [], 'exit_addresses': ['10.0.0.2'], 'running': False,
+         'platform': 'Tor 0.4.8 on Linux ☃', 'last_seen': None, 'latitude': -33.8688},
+        {'nickname': 'n' * 300, 'bandwidth': 0, 'nested': {'a': [1, 2, {'b': '}]'}]}},
+    ],
+    'bridges_published': '2024-01-01 00:00:00',
+    'bridges': [{'nickname': 'bridge', 'hashed_fingerprint': 'B' * 40}],
+    'relays_truncated': 12,
+}
+
+
+def chunked(data, rng):
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = rng.randint(1, 17)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_chunk_boundaries_anywhere(indent):
+    data = json.dumps(DOCUMENT, indent=indent, ensure_ascii=False).encode('utf-8')
+    rng = random.Random(indent or 0)
+    for _ in range(200):
+        stream = OnionooStream(chunked(data, rng))
+        assert list(stream) == DOCUMENT['relays']
+        assert stream.meta == {key: value for key, value in DOCUMENT.items() if not isinstance(value, list)}
+        assert stream.relays == len(DOCUMENT['relays'])
+
+
+def test_every_single_split_point():
+    data = json.dumps(DOCUMENT, ensure_ascii=False).encode('utf-8')
+    for split in range(1, len(data)):
+        stream = OnionooStream([data[:split], data[split:]])
+        assert list(stream) == DOCUMENT['relays'], split
+        assert stream.meta['relays_truncated'] == 12
+
+
+def test_other_key_and_text_chunks():
+    data = json.dumps(DOCUMENT)
+    stream = OnionooStream(chunked(data, random.Random(1)), key='bridges')
+    assert list(stream) == DOCUMENT['bridges']
+
+
+def test_malformed_document():
+    with pytest.raises(ValueError):
+        list(OnionooStream([b'{"relays": [{"a": 1} {"b": 2}]}']))
+    with pytest.raises(ValueError):
+        list(OnionooStream([b'{"relays": [{"a": 1}']))
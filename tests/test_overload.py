@@ -0,0 +1,30 @@
+from part_a.network_capture.overload import SheddingQueue
+from part_a.network_capture.records import PacketRecord, STREAM_END
+
+
+def record(src, dst, src_port, dst_port, protocol=6):
+    return PacketRecord(1700000000.0, src, dst, src_port, dst_port, protocol, 60)
+
+
+def test_flow_hash_is_direction_free_and_portless_safe():
+    packets = SheddingQueue(10)
+    assert packets._flow_hash(record('10.0.0.1', '10.0.0.2', 40000, 9001)) == \
+        packets._flow_hash(record('10.0.0.2', '10.0.0.1', 9001, 40000))
+    # ICMP between one address and itself has no ports on either side
+    packets._flow_hash(record('10.0.0.1', '10.0.0.1', None, None, protocol=1))
+    packets._flow_hash(record('10.0.0.1', '10.0.0.1', None, 9001))
+
+
+def test_sheds_non_tor_ports_first():
+    packets = SheddingQueue(10, tor_ports={9001}, thresholds=(0.5, 0.9), sample_rate=1)
+    for i in range(10):
+        packets.put(record('10.0.0.1', '10.0.0.2', 40000 + i, 9001 if i % 2 else 443))
+    packets.put(STREAM_END)
+    kept = []
+    while True:
+        item = packets.get()
+        if item is STREAM_END:
+            break
+        kept.append(item)
+    assert all(item.dst_port == 9001 for item in kept[5:])
+    assert packets.stats()['offered'] == 10
@@ -0,0 +1,58 @@
+import ipaddress
+import random
+
+from part_a.tor_database.prefix_trie import PrefixTrie, RelayPrefixes, network_key
+from part_a.tor_database.relay_index import ip_key
+from conftest import make_node
+
+
+def random_network(rng):
+    if rng.random() < 0.5:
+        # Few distinct leading octets, so prefixes nest and share paths
+        address = ipaddress.IPv4Address(rng.choice([10, 172, 192]) << 24 | rng.getrandbits(24))
+        return ipaddress.ip_network(f"{address}/{rng.randint(0, 32)}", strict=False)
+    address = ipaddress.IPv6Address(0x20010db8 << 96 | rng.getrandbits(96))
+    return ipaddress.ip_network(f"{address}/{rng.randint(0, 128)}", strict=False)
+
+
+def test_longest_prefix_match_agrees_with_brute_force():
+    rng = random.Random(7)
+    trie = PrefixTrie()
+    stored = {}
+    for _ in range(2000):
+        network = random_network(rng)
+        trie.insert(*network_key(network), str(network))
+        stored[str(network)] = network
+    assert len(trie) == len(stored)
+
+    # Brute force in the same 128-bit space: IPv4 is mapped into IPv6, so
+    # an IPv6 prefix short enough to cover ::ffff:0:0/96 contains IPv4 too
+    ranges = []
+    for name, network in stored.items():
+        key, length = network_key(network)
+        ranges.append((length, key, key + (1 << (128 - length)), name))
+    ranges.sort()
+
+    probes = [random_network(rng).network_address for _ in range(3000)]
+    probes += [network.network_address for network in stored.values()]
+    for address in probes:
+        key = ip_key(str(address))
+        containing = [name for _, low, high, name in ranges if low <= key < high]
+        assert trie.matches(key) == containing, address
+        assert trie.lookup(key) == (containing[-1] if containing else None), address
+
+
+def test_relay_prefixes_label_relays_and_watchlist(tmp_path):
+    watchlist = tmp_path / 'watchlist.txt'
+    watchlist.write_text("203.0.113.0/24 hoster  # comment\n10.1.0.0/16\nnot-a-cidr\n")
+    nodes = [make_node(1, '10.1.2.3', family='FAM'), make_node(2, '10.1.2.4')]
+    prefixes = RelayPrefixes(nodes, watchlist_file=str(watchlist))
+    assert prefixes.watchlist == 2
+
+    relay = prefixes.match('10.1.2.3')
+    assert relay['relay'] and relay['prefix'] == '10.1.2.3/32'
+    assert relay['family'] == 'FAM' and relay['as_number'] == 'AS3320'
+    assert relay['watchlist'] == ['10.1.0.0/16']
+    assert prefixes.watched('203.0.113.77') == ['hoster']
+    assert prefixes.match('198.51.100.1') is None
+
@@ -0,0 +1,69 @@
+from conftest import make_node
+from part_a.tor_database.relay_index import RelayIndex, ip_key
+from part_a.tor_database.relay_store import RelayStore, write_relay_store
+
+
+def fingerprint(node):
+    return node['fingerprint'] if node else None
+
+
+def open_store(nodes, tmp_path):
+    filename = str(tmp_path / 'relays.bin')
+    write_relay_store(nodes, filename)
+    return RelayStore(filename)
+
+
+def test_lookups_match_relay_index(shared_nodes, tmp_path):
+    nodes, addresses = shared_nodes
+    store = open_store(nodes, tmp_path)
+    index = RelayIndex(nodes)
+
+    for ip in addresses + ['192.0.2.1', '2001:db8:ffff::1']:
+        assert (ip in store) == (ip in index)
+        assert fingerprint(store.node_by_ip(ip)) == fingerprint(index.node_by_ip(ip)), ip
+        assert fingerprint(store.running_guard(ip)) == fingerprint(index.running_guard(ip)), ip
+        assert fingerprint(store.running_exit(ip)) == fingerprint(index.running_exit(ip)), ip
+        assert [fingerprint(node) for node in store.nodes_at(ip)] == \
+            [fingerprint(node) for node in index.nodes_at(ip)], ip
+        for port in (9001, 443, 9030, None):
+            assert fingerprint(store.node_by_endpoint(ip, port)) == \
+                fingerprint(index.node_by_endpoint(ip, port)), (ip, port)
+
+
+def test_shared_secondary_address_resolves_in_node_order(tmp_path):
+    # The second relay sorts first by primary IP but comes later in the node list
+    nodes = [
+        make_node(1, '10.0.0.9', or_addresses=[['10.0.0.9', 9001], ['2001:db8::b63', 9001]]),
+        make_node(2, '10.0.0.1', or_addresses=[['10.0.0.1', 9001], ['2001:db8::b63', 9001]]),
+    ]
+    store = open_store(nodes, tmp_path)
+    assert fingerprint(store.node_by_ip('2001:db8::b63')) == nodes[0]['fingerprint']
+    assert [fingerprint(node) for node in store.nodes_at('2001:db8::b63')] == \
+        [node['fingerprint'] for node in nodes]
+
+
+def test_role_lists_and_fingerprints(shared_nodes, tmp_path):
+    nodes, _ = shared_nodes
+    store = open_store(nodes, tmp_path)
+    index = RelayIndex(nodes)
+
+    for name in ('guard_nodes', 'exit_nodes', 'running_nodes'):
+        assert [fingerprint(node) for node in getattr(store, name)] == \
+            [fingerprint(node) for node in getattr(index, name)], name
+    for node in nodes:
+        assert fingerprint(store.node_by_fingerprint(node['fingerprint'])) == node['fingerprint']
+    assert store.node_by_fingerprint('00' * 20) is None
+    assert store.statistics == index.statistics
+
+
+def test_screen_agrees_with_membership(shared_nodes, tmp_path):
+    nodes, addresses = shared_nodes
+    store = open_store(nodes, tmp_path)
+    others = [f'192.0.2.{i}' for i in range(200)]
+
+    for ip in addresses + others:
+        assert store.screen(ip_key(ip)) == (ip in store), ip
+    stats = store.prefilter.stats()
+    assert stats['checked'] == len(addresses) + len(others)
+    assert stats['rejected'] + stats['false_positives'] == \
+        sum(1 for ip in addresses + others if ip not in store)
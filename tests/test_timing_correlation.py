@@ -0,0 +1,35 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from part_b.correlation.timing_correlation import TimingCorrelation, to_microseconds
+
+
+def test_timestamp_forms_share_one_clock():
+    epoch = 1700000000.123456
+    local = datetime.fromtimestamp(epoch)
+    for timestamp in (epoch, local, local.isoformat(), local.astimezone(timezone.utc).isoformat()):
+        assert to_microseconds(timestamp) == 1700000000123456, timestamp
+
+
+def test_correlate_matches_pairwise_comparison():
+    rng = random.Random(5)
+    start = datetime(2025, 1, 1, 12, 0, 0)
+
+    def connection(role, i):
+        offset = timedelta(seconds=rng.uniform(0, 120), microseconds=rng.randrange(1000000))
+        return {role: {'ip_address': f'10.0.0.{i}'}, 'timestamp': (start + offset).isoformat()}
+
+    entries = [connection('entry_node', i) for i in range(150)]
+    exits = [connection('exit_node', i) for i in range(150)]
+    correlator = TimingCorrelation(entries, exits)
+    limit = correlator.timing_window + correlator.timing_tolerance
+
+    expected = []
+    for entry in entries:
+        for exit in exits:
+            delta = abs(datetime.fromisoformat(exit['timestamp']) - datetime.fromisoformat(entry['timestamp']))
+            if delta.total_seconds() <= limit:
+                expected.append((entry, exit, delta.total_seconds()))
+
+    result = [(match['entry'], match['exit'], match['time_difference']) for match in correlator.correlate()]
+    assert expected and result == expected